@@ -3,6 +3,10 @@ ASGI config for HomePiWeb project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Run with an ASGI server, e.g. ``uvicorn HomePiWeb.asgi:application``; the
+agent-facing device API is then served by the async views in
+``pi_devices/views/api_async.py``.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.2/howto/deployment/asgi/
 """
@@ -12,5 +16,7 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'HomePiWeb.settings')
+# agent 長輪詢等 API 改走 async view（見 HomePiWeb/urls_asgi.py）
+os.environ.setdefault('HOMEPI_ROOT_URLCONF', 'HomePiWeb.urls_asgi')
 
 application = get_asgi_application()
@@ -4,6 +4,7 @@ from django.shortcuts import redirect
 from django.contrib import messages
 from groups.models import Group, GroupMembership
 from django.http import JsonResponse
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
 
 EXEMPT_URL_NAMES = {
     "hls_proxy",
@@ -53,29 +54,50 @@ def _group_create_url():
         return reverse("group_create")
 
 
+def _is_exempt_path(path: str) -> bool:
+    # ✅ 無條件放行：HLS 代理 & Pi Agent API & 靜態檔
+    return (
+        path.startswith("/hls/")
+        or path.startswith("/api/device/")
+        or path.startswith("/device_pull/")
+        or path.startswith("/device_ack")
+        or path.startswith("/static/")
+        or path.startswith("/media/")
+        or path.startswith("/favicon.ico")
+        or path.startswith("/admin/")
+    )
+
+
 class RequireGroupMiddleware:
+    # 同時支援 WSGI / ASGI：ASGI 下 agent 長輪詢不會因這層被綁到執行緒上
+    sync_capable = True
+    async_capable = True
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
-        path = request.path
-
-        # ✅ 無條件放行：HLS 代理 & Pi Agent API & 靜態檔
-        if (
-            path.startswith("/hls/")
-            or path.startswith("/api/device/")
-            or path.startswith("/device_pull/")
-            or path.startswith("/device_ack")
-            or path.startswith("/static/")
-            or path.startswith("/media/")
-            or path.startswith("/favicon.ico")
-            or path.startswith("/admin/")
-        ):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if _is_exempt_path(request.path):
             return self.get_response(request)
+        return self._check_group(request) or self.get_response(request)
+
+    async def __acall__(self, request):
+        if _is_exempt_path(request.path):
+            return await self.get_response(request)
+        resp = await sync_to_async(self._check_group)(request)
+        return resp or await self.get_response(request)
+
+    def _check_group(self, request):
+        """需要擋下時回傳 response，否則回傳 None"""
+        path = request.path
 
         # 其餘才走原本流程
         if not request.user.is_authenticated:
-            return self.get_response(request)
+            return None
 
         try:
             match = resolve(path)
@@ -85,11 +107,11 @@ class RequireGroupMiddleware:
                 else match.url_name
             )
         except Resolver404:
-            return self.get_response(request)
+            return None
 
         # ✅ 放行白名單的 view 名稱
         if view_name in EXEMPT_URL_NAMES:
-            return self.get_response(request)
+            return None
 
         # 沒加入任何群組 → 擋住
         if not user_has_any_group(request.user):
@@ -101,4 +123,4 @@ class RequireGroupMiddleware:
             messages.warning(request, "你尚未加入任何群組，請先建立群組才能繼續操作。")
             return redirect(_group_create_url())
 
-        return self.get_response(request)
+        return None
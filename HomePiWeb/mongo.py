@@ -10,3 +10,12 @@ db = client[settings.MONGO_CONFIG["DB_NAME"]]
 
 # 對應的 collection
 device_ping_logs = db["device_ping_logs"]
+
+# 心跳指標的預先彙總（pi_devices/utils/metrics_rollup.py 維護）
+device_metrics_rollups = {
+    "1m": db["device_metrics_1m"],
+    "1h": db["device_metrics_1h"],
+    "1d": db["device_metrics_1d"],
+}
+# 各層彙總做到哪裡（_id = 解析度）
+device_metrics_rollup_state = db["device_metrics_rollup_state"]
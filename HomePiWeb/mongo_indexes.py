@@ -0,0 +1,120 @@
+# HomePiWeb/mongo_indexes.py
+# -*- coding: utf-8 -*-
+"""
+MongoDB 索引與保留期限（可重複執行）
+
+- device_ping_logs：(device_id, ping_at) 複合索引，給 device_logs / check_offline_devices
+  「某台裝置最新幾筆」用；ping_at 上的 TTL 索引依 MONGO_PING_LOG_TTL_DAYS 自動清舊資料
+- 彙總集合：(device_id, bucket) 唯一索引（$merge 需要），bucket 上依 MONGO_ROLLUP_TTL_DAYS 設 TTL
+TTL 天數改了會用 collMod 更新；設成 0 代表永久保留（移除 TTL 索引）。
+由 manage.py ensure_mongo_indexes 執行，或設定 MONGO_ENSURE_INDEXES_ON_STARTUP 於啟動時背景執行。
+"""
+import logging
+
+from django.conf import settings
+from pymongo.errors import OperationFailure
+
+from .mongo import db, device_metrics_rollups, device_ping_logs
+
+logger = logging.getLogger(__name__)
+
+
+def _ttl_days(name: str) -> float:
+    if name == device_ping_logs.name:
+        return float(getattr(settings, "MONGO_PING_LOG_TTL_DAYS", 30) or 0)
+    rollup_ttl = getattr(settings, "MONGO_ROLLUP_TTL_DAYS", {}) or {}
+    for res, coll in device_metrics_rollups.items():
+        if coll.name == name:
+            return float(rollup_ttl.get(res) or 0)
+    return 0
+
+
+def _ensure_ttl(coll, field: str, index_name: str, days: float) -> str:
+    """建立 / 調整 / 移除 TTL 索引，回傳做了什麼"""
+    current = coll.index_information().get(index_name)
+    if days <= 0:
+        if current:
+            coll.drop_index(index_name)
+            return f"{index_name}: 移除（永久保留）"
+        return f"{index_name}: 未設定（永久保留）"
+
+    seconds = int(days * 86400)
+    if current is None:
+        coll.create_index([(field, 1)], name=index_name, expireAfterSeconds=seconds)
+        return f"{index_name}: 建立（{days:g} 天）"
+    if current.get("expireAfterSeconds") != seconds:
+        db.command(
+            "collMod",
+            coll.name,
+            index={"name": index_name, "expireAfterSeconds": seconds},
+        )
+        return f"{index_name}: 更新為 {days:g} 天"
+    return f"{index_name}: 已存在（{days:g} 天）"
+
+
+def ensure_indexes() -> list[str]:
+    """確保所有索引存在；回傳每個動作的說明"""
+    done = []
+    device_ping_logs.create_index(
+        [("device_id", 1), ("ping_at", -1)], name="device_ping_at"
+    )
+    done.append(f"{device_ping_logs.name}.device_ping_at: OK")
+    done.append(
+        f"{device_ping_logs.name}."
+        + _ensure_ttl(
+            device_ping_logs,
+            "ping_at",
+            "ping_at_ttl",
+            _ttl_days(device_ping_logs.name),
+        )
+    )
+
+    for coll in device_metrics_rollups.values():
+        coll.create_index(
+            [("device_id", 1), ("bucket", 1)], unique=True, name="device_id_1_bucket_1"
+        )
+        done.append(f"{coll.name}.device_id_1_bucket_1: OK")
+        done.append(
+            f"{coll.name}."
+            + _ensure_ttl(coll, "bucket", "bucket_ttl", _ttl_days(coll.name))
+        )
+    return done
+
+
+def collection_report() -> list[dict]:
+    """各集合的大小與索引使用次數（$collStats / $indexStats）"""
+    report = []
+    for coll in [device_ping_logs, *device_metrics_rollups.values()]:
+        item = {"collection": coll.name, "count": 0, "size": 0, "storage": 0}
+        try:
+            stats = next(
+                coll.aggregate([{"$collStats": {"storageStats": {}}}]), {}
+            ).get("storageStats", {})
+            item.update(
+                count=stats.get("count", 0),
+                size=stats.get("size", 0),
+                storage=stats.get("storageSize", 0),
+                index_size=stats.get("totalIndexSize", 0),
+            )
+            item["indexes"] = [
+                {
+                    "name": s["name"],
+                    "ops": int(s.get("accesses", {}).get("ops", 0)),
+                    "since": s.get("accesses", {}).get("since"),
+                }
+                for s in coll.aggregate([{"$indexStats": {}}])
+            ]
+        except OperationFailure as e:
+            # 集合還不存在等情況
+            item["error"] = str(e)
+        report.append(item)
+    return report
+
+
+def ensure_indexes_quietly() -> None:
+    """啟動時背景呼叫用：Mongo 沒開也不要影響服務"""
+    try:
+        for line in ensure_indexes():
+            logger.info(f"mongo index {line}")
+    except Exception as e:
+        logger.warning(f"ensure mongo indexes failed: {e}")
@@ -0,0 +1,271 @@
+# HomePiWeb/mongo_writer.py
+# -*- coding: utf-8 -*-
+"""
+MongoDB 背景批次寫入器（device_ping 的心跳紀錄不再在請求內 insert_one）
+
+- submit(doc)：放進有上限的佇列；佇列滿時最多等 PUT_TIMEOUT 秒（背壓），
+  還是滿就直接寫進 spill 檔，不讓請求卡住
+- 背景執行緒：湊滿 BATCH_SIZE 筆或等了 FLUSH_SECONDS 秒就 insert_many 一次
+- Mongo 連不上：整批寫進 spill 檔（JSON Lines，bson.json_util 格式），
+  之後每 REPLAY_SECONDS 秒試著補寫回 Mongo
+- stats()：佇列深度、寫入/失敗/spill 筆數、最近一次 flush 耗時等，給 metrics 端點用
+設定見 settings.MONGO_WRITER。
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from bson import json_util
+from django.conf import settings
+from pymongo.errors import BulkWriteError
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "BATCH_SIZE": 500,
+    "FLUSH_SECONDS": 1.0,
+    "MAX_QUEUE": 10000,
+    "PUT_TIMEOUT": 0.05,
+    "SPILL_PATH": None,
+    "REPLAY_SECONDS": 30,
+}
+
+
+def _conf(key):
+    return (getattr(settings, "MONGO_WRITER", None) or {}).get(key, DEFAULTS[key])
+
+
+class BufferedMongoWriter:
+    def __init__(
+        self,
+        collection,
+        batch_size: int = 500,
+        flush_seconds: float = 1.0,
+        max_queue: int = 10000,
+        put_timeout: float = 0.05,
+        spill_path: str | None = None,
+        replay_seconds: float = 30,
+    ):
+        self.collection = collection
+        self.batch_size = max(1, int(batch_size))
+        self.flush_seconds = float(flush_seconds)
+        self.put_timeout = float(put_timeout)
+        self.spill_path = str(spill_path) if spill_path else None
+        self.replay_seconds = float(replay_seconds)
+
+        self._q: queue.Queue = queue.Queue(maxsize=max(1, int(max_queue)))
+        self._spill_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._thread: threading.Thread | None = None
+        self._last_replay = 0.0
+        self._stats = {
+            "enqueued": 0,
+            "inserted": 0,
+            "batches": 0,
+            "failed_batches": 0,
+            "overflow": 0,
+            "spilled": 0,
+            "replayed": 0,
+            "dropped": 0,
+            "last_flush_at": None,
+            "last_flush_ms": None,
+            "last_error": "",
+        }
+
+    # ---------- 請求端 ----------
+    def submit(self, doc: dict) -> bool:
+        """排入佇列；回傳 False 代表佇列滿，已改寫進 spill 檔"""
+        self.ensure_started()
+        try:
+            self._q.put(doc, timeout=self.put_timeout)
+        except queue.Full:
+            self._bump("overflow")
+            self._spill([doc])
+            return False
+        self._bump("enqueued")
+        return True
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            data = dict(self._stats)
+        data["queue_depth"] = self._q.qsize()
+        data["max_queue"] = self._q.maxsize
+        data["spill_bytes"] = self._spill_size()
+        data["running"] = bool(self._thread and self._thread.is_alive())
+        return data
+
+    def flush(self) -> int:
+        """在呼叫端執行緒把佇列清空寫出（關機 / 測試用），回傳寫入筆數"""
+        written = 0
+        while True:
+            batch = self._drain(self.batch_size)
+            if not batch:
+                return written
+            if self._write(batch):
+                written += len(batch)
+
+    # ---------- 背景執行緒 ----------
+    def ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._stats_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="mongo-writer", daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.flush)
+
+    def _run(self) -> None:
+        while True:
+            try:
+                batch = self._take_batch()
+                if batch:
+                    self._write(batch)
+                elif self._spill_size() and (
+                    time.monotonic() - self._last_replay >= self.replay_seconds
+                ):
+                    self._replay_spill()
+            except Exception as e:  # 背景執行緒不能死
+                logger.exception(f"mongo writer loop error: {e}")
+                time.sleep(1.0)
+
+    def _take_batch(self) -> list:
+        """湊滿 batch_size 或等滿 flush_seconds 就回傳"""
+        batch = []
+        deadline = time.monotonic() + self.flush_seconds
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._q.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _drain(self, limit: int) -> list:
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self._q.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, batch: list) -> bool:
+        t0 = time.monotonic()
+        try:
+            self.collection.insert_many(batch, ordered=False)
+        except Exception as e:
+            logger.warning(f"mongo insert_many failed ({len(batch)} docs): {e}")
+            with self._stats_lock:
+                self._stats["failed_batches"] += 1
+                self._stats["last_error"] = f"{type(e).__name__}: {e}"
+            self._spill(batch)
+            return False
+
+        with self._stats_lock:
+            self._stats["inserted"] += len(batch)
+            self._stats["batches"] += 1
+            self._stats["last_flush_at"] = time.time()
+            self._stats["last_flush_ms"] = round((time.monotonic() - t0) * 1000, 1)
+        # Mongo 恢復了：順手把先前 spill 的補寫回去
+        if self._spill_size() and (
+            time.monotonic() - self._last_replay >= self.replay_seconds
+        ):
+            self._replay_spill()
+        return True
+
+    # ---------- spill 檔 ----------
+    def _spill_size(self) -> int:
+        if not self.spill_path:
+            return 0
+        try:
+            return os.path.getsize(self.spill_path)
+        except OSError:
+            return 0
+
+    def _spill(self, docs: list, replay: bool = False) -> None:
+        """replay=True：補寫失敗放回去的，不重複計入 spilled"""
+        if not self.spill_path:
+            self._bump("dropped", len(docs))
+            return
+        try:
+            with self._spill_lock:
+                os.makedirs(os.path.dirname(self.spill_path) or ".", exist_ok=True)
+                with open(self.spill_path, "a", encoding="utf-8") as f:
+                    for doc in docs:
+                        f.write(json_util.dumps(doc) + "\n")
+        except OSError as e:
+            logger.error(f"mongo spill write failed: {e}")
+            self._bump("dropped", len(docs))
+            return
+        if not replay:
+            self._bump("spilled", len(docs))
+
+    def _replay_spill(self) -> None:
+        """
+        把 spill 檔補寫回 Mongo。鎖內只做「讀出 + 刪檔」，insert_many 在鎖外：
+        Mongo 逾時可能要幾十秒，不能讓佇列滿時要寫 spill 的請求跟著等。
+        補寫失敗時，還沒寫進去的部分再附加回 spill 檔等下次。
+        """
+        self._last_replay = time.monotonic()
+        with self._spill_lock:
+            try:
+                with open(self.spill_path, "r", encoding="utf-8") as f:
+                    docs = [json_util.loads(line) for line in f if line.strip()]
+                os.remove(self.spill_path)
+            except OSError:
+                return
+        done = 0
+        try:
+            for done in range(0, len(docs), self.batch_size):
+                self._insert_replay(docs[done : done + self.batch_size])
+        except Exception as e:
+            logger.warning(f"mongo spill replay failed: {e}")
+            # 失敗那批可能已寫入一部分（帶 _id），下次重放撞 duplicate key 會被忽略
+            self._spill(docs[done:], replay=True)
+            self._bump("replayed", done)
+            return
+        self._bump("replayed", len(docs))
+
+    def _insert_replay(self, docs: list) -> None:
+        try:
+            self.collection.insert_many(docs, ordered=False)
+        except BulkWriteError as e:
+            # 只有 duplicate key（上次重放中斷前已寫入）就當作成功
+            errors = e.details.get("writeErrors") or []
+            if any(err.get("code") != 11000 for err in errors):
+                raise
+
+    def _bump(self, key: str, n: int = 1) -> None:
+        with self._stats_lock:
+            self._stats[key] += n
+
+
+_ping_log_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_ping_log_writer() -> BufferedMongoWriter:
+    """device_ping_logs 的共用寫入器（依 settings.MONGO_WRITER 建立）"""
+    global _ping_log_writer
+    if _ping_log_writer is None:
+        with _writer_lock:
+            if _ping_log_writer is None:
+                from .mongo import device_ping_logs
+
+                _ping_log_writer = BufferedMongoWriter(
+                    device_ping_logs,
+                    batch_size=_conf("BATCH_SIZE"),
+                    flush_seconds=_conf("FLUSH_SECONDS"),
+                    max_queue=_conf("MAX_QUEUE"),
+                    put_timeout=_conf("PUT_TIMEOUT"),
+                    spill_path=_conf("SPILL_PATH"),
+                    replay_seconds=_conf("REPLAY_SECONDS"),
+                )
+    return _ping_log_writer
@@ -54,7 +54,8 @@ MIDDLEWARE = [
     "HomePiWeb.middleware.RequireGroupMiddleware",
 ]
 
-ROOT_URLCONF = "HomePiWeb.urls"
+# ASGI 啟動時（asgi.py）會改用 HomePiWeb.urls_asgi，把 agent API 換成 async 版
+ROOT_URLCONF = os.getenv("HOMEPI_ROOT_URLCONF", "HomePiWeb.urls")
 
 TEMPLATES = [
     {
@@ -101,6 +102,24 @@ DATABASES = {
     }
 }
 
+# Django cache：設了 REDIS_URL 就用 Redis，多個 worker 才共用得到
+# presence（cache 後端）、裝置驗證快取的版本號、HLS 觀看者紀錄；
+# 沒設時是各行程自己的記憶體 cache，只適合單一行程（runserver / uvicorn 單 worker）
+if os.getenv("REDIS_URL"):
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": os.getenv("REDIS_URL"),
+        }
+    }
+else:
+    CACHES = {
+        "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"}
+    }
+
+# 部署的 worker 行程數；> 1 時上面的 cache 必須是共用的（manage.py check 會擋）
+HOMEPI_WORKERS = int(os.getenv("HOMEPI_WORKERS") or os.getenv("WEB_CONCURRENCY") or 1)
+
 # DATA(Mango)
 MONGO_CONFIG = {
     "HOST": "localhost",
@@ -108,6 +127,68 @@ MONGO_CONFIG = {
     "DB_NAME": "homepi_logs",
 }
 
+# Mongo 資料保留天數（TTL 索引；0 = 永久保留），由 manage.py ensure_mongo_indexes 套用
+MONGO_PING_LOG_TTL_DAYS = int(os.getenv("MONGO_PING_LOG_TTL_DAYS", "30"))
+MONGO_ROLLUP_TTL_DAYS = {"1m": 14, "1h": 400, "1d": 0}
+
+# agent 心跳間隔（秒），彙總時用來估算上線秒數 / 上線比例（pi_agent/http_agent.py 每 30 秒）
+DEVICE_PING_INTERVAL_SECONDS = 30
+
+# 啟動時在背景確保 Mongo 索引（正式環境可開；也可只靠部署時跑 ensure_mongo_indexes）
+MONGO_ENSURE_INDEXES_ON_STARTUP = os.getenv("MONGO_ENSURE_INDEXES_ON_STARTUP") == "1"
+
+# 心跳紀錄的背景批次寫入器（HomePiWeb/mongo_writer.py）
+MONGO_WRITER = {
+    "BATCH_SIZE": 500,  # 湊滿幾筆就 insert_many
+    "FLUSH_SECONDS": 1.0,  # 或最多等幾秒
+    "MAX_QUEUE": 10000,  # 佇列上限（背壓）
+    "PUT_TIMEOUT": 0.05,  # 佇列滿時最多等幾秒，之後改寫 spill 檔
+    # Mongo 連不上時暫存的檔案（JSON Lines），恢復後自動補寫
+    "SPILL_PATH": os.getenv(
+        "MONGO_SPILL_PATH", str(BASE_DIR / "var" / "mongo_spill.jsonl")
+    ),
+    "REPLAY_SECONDS": 30,  # 補寫 spill 檔的間隔
+}
+
+# hls_proxy 的共用快取（pi_devices/utils/hls_cache.py）
+HLS_PROXY_CACHE = {
+    "MAX_BYTES": 64 * 1024 * 1024,  # 快取總大小上限
+    "PLAYLIST_TTL": 0.5,  # playlist 快取秒數（多人同時看只抓一次）
+    "SEGMENT_TTL": 120,  # 片段快取秒數
+    "DISK_DIR": os.getenv("HLS_CACHE_DIR") or None,  # 設了就把片段存成檔案
+    "WAIT_SECONDS": 20,  # 等別人抓同一個檔案最多幾秒
+    "PREFETCH_SEGMENTS": 2,  # playlist 更新後預抓最新幾段（每台裝置同時上限；0 = 關閉）
+    "PREFETCH_WORKERS": 4,  # WSGI 版預抓用的背景執行緒數
+    "MAX_SEGMENT_BYTES": 8 * 1024 * 1024,  # 單一片段上限，超過回 502（整段會讀進記憶體）
+}
+
+# hls_proxy 到各台 Pi 的 keep-alive 連線池（pi_devices/utils/upstream_pool.py）
+HLS_PROXY_POOL = {
+    "MAX_SIZE": 4,  # 每台 Pi 保留幾條閒置連線
+    "MAX_PER_HOST": 8,  # 每台 Pi 同時最多幾個請求（其餘排隊）
+    "IDLE_SECONDS": 60,  # 多久沒用就關掉
+    "MAX_HOSTS": 256,  # 最多同時保留幾台
+}
+
+# 依觀看者自動開關攝影機（pi_devices/utils/viewers.py）
+# 觀看由 live_source / live_player keepalive 記錄（要登入），hls_proxy 不會叫醒攝影機
+# 多 worker 部署時 CACHE 要指向共用的 cache（REDIS_URL），各 worker 才看得到彼此的觀看者
+HLS_ON_DEMAND = {
+    "ENABLED": True,
+    "IDLE_SECONDS": 60,  # 多久沒人看（沒有 keepalive）就排 camera_stop
+    "START_COOLDOWN": 20,  # 排了 camera_start 後幾秒內不重排（也是冷啟動回 503 的期間）
+    "TOUCH_INTERVAL": 1,  # 同一行程每幾秒最多寫一次觀看時間
+    "CACHE": "default",
+}
+
+# 區網直連 Pi 播放（pi_devices/utils/hls_sign.py）：發短效簽章網址，瀏覽器連不到才走 hls_proxy
+HLS_DIRECT = {
+    "ENABLED": True,
+    "TTL": 600,  # 簽章網址有效秒數（過期後 player 會重新要一個）
+    "PROBE_TIMEOUT_MS": 1500,  # 瀏覽器試連 Pi 的逾時
+    "KEEPALIVE_SECONDS": 20,  # 播放時多久回報一次「還在看」（給 HLS_ON_DEMAND）
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
@@ -176,12 +257,52 @@ TEMPLATES[0]["OPTIONS"]["context_processors"] += [
 # 裝置線上視窗（你 ping 已使用）
 DEVICE_ONLINE_WINDOW_SECONDS = 60
 
+# check_offline_devices --loop 的掃描間隔（秒）
+DEVICE_OFFLINE_SWEEP_SECONDS = 30
+
+# 心跳寫入緩衝：一般 ping 只記在緩衝，每 N 秒一次 bulk UPDATE 寫回 last_ping；0 = 每次直接寫
+DEVICE_HEARTBEAT_FLUSH_SECONDS = 5
+
+# 在線狀態（presence）後端：memory（本行程）/ cache（另寫進 Django cache，多 worker 共用）
+DEVICE_PRESENCE_BACKEND = os.getenv("DEVICE_PRESENCE_BACKEND", "memory")
+
+# presence 每隔幾秒用 last_ping 從 DB 重新同步一次（補其他 worker 的心跳；0 = 關閉）
+DEVICE_PRESENCE_RESYNC_SECONDS = 30
+
+# agent 端點的裝置驗證快取（本行程 LRU）：筆數上限（0 = 關閉）與每筆存活秒數
+DEVICE_AUTH_CACHE_SIZE = 10000
+DEVICE_AUTH_CACHE_TTL = 300
+# 裝置驗證快取的版本號放在哪個 cache（Device 變更時換版本號，各 worker 的 LRU 就會重查）
+DEVICE_AUTH_VERSION_CACHE = "default"
+
+# agent 請求本體（gzip 解開後）的大小上限（bytes）
+DEVICE_PROTOCOL_MAX_BODY = 1024 * 1024
+
 # 長輪詢單次等待上限（秒）
 DEVICE_COMMAND_MAX_WAIT_SECONDS = 20
 
 # 指令有效期（秒）
 DEVICE_COMMAND_EXPIRES_SECONDS = 30
 
+# 長輪詢喚醒後端：local（單一行程）/ postgres（LISTEN/NOTIFY，多 worker 部署用）
+DEVICE_COMMAND_SIGNAL_BACKEND = os.getenv("DEVICE_COMMAND_SIGNAL_BACKEND", "local")
+
+# 等待期間的保底重查間隔（秒）；0 = 只靠通知喚醒
+DEVICE_COMMAND_RECHECK_SECONDS = 5
+
+# 單次 device_pull 最多回幾筆指令（agent 以 max_batch 要求批次）
+DEVICE_COMMAND_MAX_BATCH = 10
+
+# 指令合併規則（依 family；同一 payload.slug 尚未被取走的指令才會合併）
+#   set   ：新的 on/off 取代舊的 pending；toggle 遇到 pending 的 set 改寫成反向
+#   toggle：連續兩次 toggle 互相抵銷
+# 拿掉某個 family 即停用該類合併；設成 {} 全部停用
+DEVICE_COMMAND_COALESCE = {
+    "light": {"set": ["light_on", "light_off"], "toggle": "light_toggle"},
+    "locker": {"set": ["locker_lock", "locker_unlock"], "toggle": "locker_toggle"},
+    "camera": {"set": ["camera_start", "camera_stop"]},
+}
+
 # 你現在是 HTTP，不要開 Secure cookie
 # SESSION_COOKIE_SECURE = False
 # CSRF_COOKIE_SECURE = False
@@ -22,6 +22,17 @@ urlpatterns = [
         api_views.hls_proxy,
         name="hls_proxy",
     ),
+    # 背景寫入器 / HLS 快取狀態（staff）
+    path(
+        "admin/metrics/mongo_writer/",
+        api_views.mongo_writer_metrics,
+        name="mongo_writer_metrics",
+    ),
+    path(
+        "admin/metrics/hls_cache/",
+        api_views.hls_cache_metrics,
+        name="hls_cache_metrics",
+    ),
     # Django admin
     path("admin/", admin.site.urls),
     # 使用者/裝置/群組/邀請
@@ -45,16 +56,17 @@ urlpatterns = [
         name="api_device_schedule_ack",
     ),
     # Camera 控制/查詢
-    path(
-        "api/camera/<str:serial>/<str:action>/",
-        api_views.camera_action,
-        name="camera_action",
-    ),
+    # status 要放在 <action> 前面，不然會被當成 action（只收 POST）
     path(
         "api/camera/<str:serial>/status/",
         api_views.camera_status,
         name="camera_status",
     ),
+    path(
+        "api/camera/<str:serial>/<str:action>/",
+        api_views.camera_action,
+        name="camera_action",
+    ),
     # Offcanvas 側邊欄
     path("devices/offcanvas/", device_views.offcanvas_list, name="devices_offcanvas"),
     path("offcanvas/groups/", user_views.offcanvas_groups, name="groups_offcanvas"),
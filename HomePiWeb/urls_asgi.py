@@ -0,0 +1,33 @@
+# HomePiWeb/urls_asgi.py
+"""
+ASGI 專用 URLconf（由 asgi.py 透過 HOMEPI_ROOT_URLCONF 指定）
+
+把 agent 會長時間佔住連線的 API 與 HLS 代理換成 async 版，其餘路由沿用 HomePiWeb.urls。
+路徑與 name 與 WSGI 版一致，agent 與 reverse() 都不受影響。
+"""
+from django.urls import path, re_path
+
+from pi_devices.views import api_async
+
+from .urls import urlpatterns as wsgi_urlpatterns
+
+urlpatterns = [
+    # HLS 代理：async 版，片段傳輸不佔 worker 執行緒
+    re_path(
+        r"^hls/(?P<serial>[^/]+)/(?P<subpath>.+)$",
+        api_async.hls_proxy,
+        name="hls_proxy",
+    ),
+    path("api/device/ping/", api_async.device_ping, name="device_ping"),
+    path("api/device/pull/", api_async.device_pull, name="device_pull_api"),
+    path("api/device/ack/", api_async.device_ack, name="device_ack_api"),
+    path(
+        "api/device/ack_batch/", api_async.device_ack_batch, name="device_ack_batch"
+    ),
+    path(
+        "api/device/schedules/", api_async.device_schedules, name="device_schedules"
+    ),
+    # 舊版無 /api 前綴
+    path("device_pull/", api_async.device_pull, name="device_pull"),
+    path("device_ack/", api_async.device_ack, name="device_ack"),
+] + wsgi_urlpatterns
@@ -1,8 +1,30 @@
 # -*- coding: utf-8 -*-
+"""
+相機模組（devices/camera.py）
+- 預設由 agent 自己管理推流程序（rpicam-vid | ffmpeg），不再 sudo systemctl：
+    - Pipeline 監看兩個子程序，任一個掛掉就整組重啟（退避 2～30 秒）
+    - 狀態（running / pid / restarts / last_exit）存在記憶體，status() 不再開子程序
+    - 片段寫到 tmpfs 環狀緩衝（stream/ring.py），只留最新幾段，不寫 SD 卡
+- 環境變數：
+    HOMEPI_CAMERA_MODE=systemd   沿用舊的 homepi-hls systemd 服務
+    HOMEPI_HLS_SERVICE           systemd 模式的服務名稱（預設 homepi-hls）
+    HOMEPI_HLS_DIR               HLS 輸出目錄（預設 /dev/shm/homepi-hls，serve_hls.py 讀同一個）
+    HOMEPI_HLS_LL=1              輸出 LL-HLS 小段（parts.m3u8，給 stream/llhls.py）
+    HOMEPI_HLS_RING              環狀緩衝保留的片段數
+    HOMEPI_CAMERA_SIZE / HOMEPI_CAMERA_FPS   解析度（預設 1280x720）與 FPS（預設 30）
+"""
 # 導入程式所需的標準函式庫
-import os, socket, subprocess
+import os, signal, socket, subprocess, threading, time
 from pathlib import Path
 
+from stream.ring import SegmentRing, stream_dir
+
+# 預設的串流服務；改用 LL-HLS 時在 .env 設 HOMEPI_HLS_SERVICE=homepi-hls-ll
+DEFAULT_SERVICE = os.getenv("HOMEPI_HLS_SERVICE", "homepi-hls")
+
+# process（agent 自己跑推流程序）或 systemd（舊做法）
+MODE = os.getenv("HOMEPI_CAMERA_MODE", "process").strip().lower()
+
 
 # 封裝底層的子程序執行命令
 def _run(cmd):
@@ -24,6 +46,177 @@ def _ip():
         return "127.0.0.1"
 
 
+# === 推流程序管理 ===
+class Pipeline:
+    """rpicam-vid | ffmpeg 的監看與自動重啟；start() / stop() 可重複呼叫"""
+
+    def __init__(
+        self,
+        out_dir: str,
+        low_latency: bool = False,
+        ring_size: int | None = None,
+        size: str = "1280x720",
+        fps: int = 30,
+    ):
+        self.out_dir = out_dir
+        self.low_latency = bool(low_latency)
+        self.size = size
+        self.fps = int(fps)
+        # 一般模式播放列表 3 段（每段 1 秒）；LL 模式 12 個小段（每個 ~0.33 秒）
+        self.list_size = 12 if self.low_latency else 3
+        self.ring = SegmentRing(out_dir, ring_size or self.list_size + 3)
+        self._lock = threading.Lock()
+        self._want = False
+        self._wake = threading.Event()  # stop() 叫醒退避中的監看執行緒
+        self._procs = []
+        self._thread = None
+        self._state = {
+            "running": False,
+            "pid": None,
+            "restarts": 0,
+            "last_exit": None,
+            "since": None,
+        }
+
+    # ---------- 指令 ----------
+    def _commands(self):
+        width, height = self.size.lower().split("x")
+        capture = [
+            "rpicam-vid", "-t", "0",
+            "--width", width, "--height", height, "--framerate", str(self.fps),
+            "--codec", "h264", "--profile", "baseline", "--level", "4.0",
+            "--intra", str(self.fps), "--inline", "--nopreview",
+            "--libav-format", "h264", "-o", "-",
+        ]
+        if self.low_latency:
+            name, hls_time, flags = "parts", "0.333", "split_by_time+temp_file"
+            pattern = "part_%05d.ts"
+        else:
+            name, hls_time = "index", "1"
+            flags = "append_list+program_date_time+independent_segments+temp_file"
+            pattern = "seg_%05d.ts"
+        encode = [
+            "ffmpeg", "-loglevel", "warning",
+            "-fflags", "+genpts", "-use_wallclock_as_timestamps", "1",
+            "-f", "h264", "-i", "-", "-c:v", "copy", "-an",
+            "-f", "hls", "-hls_time", hls_time,
+            "-hls_list_size", str(self.list_size), "-start_number", "1",
+            # 舊片段由 SegmentRing 刪（不用 delete_segments）
+            "-hls_flags", flags,
+            "-hls_segment_filename", os.path.join(self.out_dir, pattern),
+            os.path.join(self.out_dir, f"{name}.m3u8"),
+        ]
+        return capture, encode
+
+    def _spawn(self):
+        capture, encode = self._commands()
+        cap = subprocess.Popen(
+            capture, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL
+        )
+        try:
+            enc = subprocess.Popen(encode, stdin=cap.stdout)
+        except Exception:
+            cap.kill()
+            raise
+        cap.stdout.close()  # 只讓 ffmpeg 持有讀端，ffmpeg 結束時 rpicam-vid 會收到 SIGPIPE
+        return [cap, enc]
+
+    # ---------- 監看 ----------
+    def _supervise(self):
+        backoff = 2.0
+        while True:
+            with self._lock:
+                if not self._want:
+                    break
+                try:
+                    self.ring.reset()
+                    self._procs = self._spawn()
+                except Exception as e:
+                    self._procs = []
+                    self._state["last_exit"] = f"spawn failed: {e}"
+                else:
+                    self._state.update(
+                        running=True, pid=self._procs[-1].pid, since=time.time()
+                    )
+            started = time.monotonic()
+            while self._procs and all(p.poll() is None for p in self._procs):
+                self.ring.prune()
+                time.sleep(0.5)
+
+            with self._lock:
+                codes = [p.poll() for p in self._procs]
+                self._kill(self._procs)
+                self._procs = []
+                self._state.update(running=False, pid=None)
+                if not self._want:
+                    break
+                if codes:
+                    self._state["last_exit"] = f"exit codes {codes}"
+                self._state["restarts"] += 1
+            # 跑超過 30 秒才掛掉就當偶發，從 2 秒重來；連續失敗則拉長間隔
+            if time.monotonic() - started > 30:
+                backoff = 2.0
+            print(f"camera pipeline: {self._state['last_exit']}, retry in {backoff}s")
+            self._wake.wait(backoff)
+            backoff = min(backoff * 2, 30.0)
+
+    @staticmethod
+    def _kill(procs, timeout: float = 5):
+        # 先送 SIGINT 讓 ffmpeg 收尾，逾時再強制結束
+        for p in procs:
+            if p.poll() is None:
+                p.send_signal(signal.SIGINT)
+        deadline = time.monotonic() + timeout
+        for p in procs:
+            try:
+                p.wait(max(0.1, deadline - time.monotonic()))
+            except subprocess.TimeoutExpired:
+                p.kill()
+                p.wait()
+
+    # ---------- 對外 ----------
+    def start(self):
+        with self._lock:
+            self._want = True
+            self._wake.clear()
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(
+                target=self._supervise, name="camera-pipeline", daemon=True
+            )
+            self._thread.start()
+
+    def stop(self):
+        with self._lock:
+            self._want = False
+            self._wake.set()
+            procs = list(self._procs)
+        # 在鎖外等程序結束；監看執行緒看到 _want=False 就會離開
+        self._kill(procs)
+        if self._thread is not None:
+            self._thread.join(timeout=10)
+
+    def status(self) -> dict:
+        with self._lock:
+            return dict(self._state)
+
+
+_PIPELINE = None
+
+
+def pipeline() -> Pipeline:
+    global _PIPELINE
+    if _PIPELINE is None:
+        _PIPELINE = Pipeline(
+            stream_dir(),
+            low_latency=os.getenv("HOMEPI_HLS_LL", "0") == "1",
+            ring_size=int(os.getenv("HOMEPI_HLS_RING", "0")) or None,
+            size=os.getenv("HOMEPI_CAMERA_SIZE", "1280x720"),
+            fps=int(os.getenv("HOMEPI_CAMERA_FPS", "30")),
+        )
+    return _PIPELINE
+
+
 # Camera 類別，用來表示一個相機設備
 class Camera:
     # 類別的初始化函式
@@ -33,8 +226,8 @@ class Camera:
         self.slug = slug
         # 讀取傳入的設定字典
         self.cfg = config or {}
-        # 服務名稱，預設為 homepi-hls
-        self.service = self.cfg.get("service", "homepi-hls")
+        # 服務名稱，預設為 homepi-hls（或 HOMEPI_HLS_SERVICE）；只有 systemd 模式會用到
+        self.service = self.cfg.get("service", DEFAULT_SERVICE)
         # HLS 伺服器的 IP，如果設定中沒有則使用本機 IP
         self.hls_host = self.cfg.get("hls_host") or _ip()
         # HLS 伺服器的埠號，預設為 8088
@@ -42,37 +235,45 @@ class Camera:
         # HLS 串流的相對路徑，預設為 /index.m3u8
         self.hls_path = self.cfg.get("hls_path", "/index.m3u8")
 
-    # 啟動相機服務
+    # 啟動相機串流
     def start(self):
-        # 執行 sudo systemctl start homepi-hls 命令
-        _run(["sudo", "systemctl", "start", self.service])
+        if MODE == "systemd":
+            _run(["sudo", "systemctl", "start", self.service])
+        else:
+            pipeline().start()
 
-    # 停止相機服務
+    # 停止相機串流
     def stop(self):
-        # 執行 sudo systemctl stop homepi-hls 命令
-        _run(["sudo", "systemctl", "stop", self.service])
+        if MODE == "systemd":
+            _run(["sudo", "systemctl", "stop", self.service])
+        else:
+            pipeline().stop()
 
-    # 檢查服務的運行狀態
+    # 查詢運行狀態
+    # 不回報 hls_url：serve_hls.py 預設只收網站發的簽章網址，播放一律經網站的直播頁
     def status(self) -> dict:
-        # 執行 systemctl is-active 命令來檢查服務是否在運行
-        r = _run(["systemctl", "is-active", self.service])
-        # 判斷指令輸出是否為 'active'，以確定服務是否運行中
-        running = (r.stdout or r.stderr).strip() == "active"
-        # 組合出完整的 HLS 串流 URL
-        url = f"http://{self.hls_host}:{self.hls_port}{self.hls_path}"
-        # 回傳包含運行狀態和串流 URL 的字典
-        return {"running": running, "hls_url": url}
+        if MODE == "systemd":
+            # 執行 systemctl is-active 命令來檢查服務是否在運行
+            r = _run(["systemctl", "is-active", self.service])
+            running = (r.stdout or r.stderr).strip() == "active"
+            return {"running": running}
+        # 程序模式：直接讀記憶體裡的狀態
+        return pipeline().status()
 
 
 # --- 舊介面的包裝，讓 http_agent.py 仍可呼叫 camera.stream_start/stop ---
 # 這個區塊提供了舊版本程式碼的相容性，方便過渡
 def stream_start(service: str | None = None):
-    svc = service or "homepi-hls"
+    if MODE != "systemd":
+        return pipeline().start()
+    svc = service or DEFAULT_SERVICE
     return _run(["sudo", "systemctl", "start", svc])
 
 
 def stream_stop(service: str | None = None):
-    svc = service or "homepi-hls"
+    if MODE != "systemd":
+        return pipeline().stop()
+    svc = service or DEFAULT_SERVICE
     return _run(["sudo", "systemctl", "stop", svc])
 
 
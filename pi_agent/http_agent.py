@@ -16,7 +16,7 @@ from typing import Optional
 from config.loader import load as load_config
 from detect.registry import discover_all
 
-# === HTTP 封裝（ping / pull / ack） ===
+# === HTTP 封裝（ping / pull_batch / ack_batch） ===
 from utils import http
 
 # 自動感光背景執行緒（BH1750 -> LED）
@@ -260,6 +260,132 @@ def run_action(action: str, payload: Optional[dict] = None):
             print("[sched] push state err:", e)
 
 
+def _ack(req_id: str, ok: bool = True, error: str = "", state: Optional[dict] = None) -> dict:
+    """組一筆 ack（主迴圈收集後以 http.ack_batch 一次送出）"""
+    entry = {"req_id": req_id, "ok": ok, "error": error}
+    if state is not None:
+        entry["state"] = state
+    return entry
+
+
+def _handle_command(cmd: dict) -> dict:
+    """執行一筆伺服器指令，回傳對應的 ack"""
+    global _CAPS_SNAPSHOT, _LAST_LIGHT_SLUG
+
+    name = (cmd.get("cmd") or "").strip()
+    req_id = cmd.get("req_id") or ""
+    payload = cmd.get("payload") or {}
+    caps = _CAPS_SNAPSHOT
+
+    try:
+        if name == "rescan_caps":
+            try:
+                caps = discover_all()
+                _CAPS_SNAPSHOT = caps
+                _LAST_LIGHT_SLUG = _first_light_slug(caps) or _LAST_LIGHT_SLUG
+                http.ping(extra={"caps": caps, "state": _build_state_blob(caps)})
+                return _ack(req_id, ok=True, state=_state_for_slug(_LAST_LIGHT_SLUG))
+            except Exception as e:
+                return _ack(req_id, ok=False, error=str(e))
+
+        if name == "auto_light_on":
+            merged = deepcopy(CFG)
+            merged.setdefault("auto_light", {})
+            merged["auto_light"]["enabled"] = True
+            for k in (
+                "sensor",
+                "led",
+                "on_below",
+                "off_above",
+                "sample_every_ms",
+                "require_n_samples",
+            ):
+                if k in payload:
+                    merged["auto_light"][k] = payload[k]
+            try:
+                if not led.list_leds():
+                    led.setup_led(merged)
+            except Exception:
+                led.setup_led(merged)
+
+            _LAST_LIGHT_SLUG = (
+                payload.get("slug") or _LAST_LIGHT_SLUG or _first_light_slug(caps)
+            )
+            set_state_push(_push_state_from_auto)
+            try:
+                stop_auto_light(wait=True)
+            except Exception:
+                pass
+            start_auto_light(merged)
+
+            return _ack(req_id, ok=True, state=_state_for_slug(_LAST_LIGHT_SLUG))
+
+        if name == "auto_light_off":
+            set_state_push(None)
+            stop_auto_light(wait=True)
+            led_name = payload.get("led") or (CFG.get("auto_light", {}) or {}).get(
+                "led"
+            )
+            try:
+                if led_name:
+                    led.light_off(led_name)
+                    print(f"[auto_light] 已停用，自動關燈 {led_name}")
+                else:
+                    for k in list(led.list_leds().keys()):
+                        led.light_off(k)
+                    print("[auto_light] 已停用，未指定 LED，已嘗試關閉所有 LED")
+            except Exception as e:
+                print("[auto_light] 停用時關燈失敗：", e)
+
+            slug = payload.get("slug") or _LAST_LIGHT_SLUG or _first_light_slug(caps)
+            return _ack(req_id, ok=True, state=_state_for_slug(slug))
+
+        handler = COMMANDS.get(name)
+        if handler is None:
+            return _ack(req_id, ok=False, error=f"unknown command: {name}")
+
+        # 先處理 locker 指令的 debug 和 ack
+        if name in ("locker_lock", "locker_unlock", "locker_toggle"):
+            print(f"[DEBUG] 處理 locker 指令: {name}, req_id: {req_id}")
+            target = payload.get("target")
+            slug = payload.get("slug")
+            print(f"[DEBUG] target: {target}, slug: {slug}")
+
+            if not slug:
+                try:
+                    names = list((locker.list_lockers() or {}).keys())
+                    slug = names[0] if names else None
+                    print(f"[DEBUG] 自動取得 slug: {slug}")
+                except Exception as e:
+                    print(f"[DEBUG] 取得 locker 清單失敗: {e}")
+                    slug = None
+
+            if not slug:
+                return _ack(
+                    req_id, ok=False, error="missing slug and no locker available"
+                )
+
+            # 執行硬體操作
+            print(f"[DEBUG] 準備執行硬體操作: {name}")
+            _call_handler(handler, cmd)
+            print(f"[DEBUG] 硬體操作完成: {name}")
+
+            state = locker.get_state(slug)
+            print(f"[DEBUG] locker 狀態: {slug}: {state}")
+            return _ack(req_id, ok=True, state={slug: state})
+
+        # 執行其他指令
+        _call_handler(handler, cmd)
+
+        if name in ("light_on", "light_off", "light_toggle"):
+            slug = payload.get("slug") or _LAST_LIGHT_SLUG or _first_light_slug(caps)
+            return _ack(req_id, ok=True, state=_state_for_slug(slug))
+        return _ack(req_id, ok=True)
+
+    except Exception as e:
+        return _ack(req_id, ok=False, error=str(e))
+
+
 def main():
     global _CAPS_SNAPSHOT, _LAST_LIGHT_SLUG
 
@@ -280,7 +406,6 @@ def main():
         print("[WARN] locker.set_state_push 失敗：", e)
 
     # === 掃描能力 ===
-    caps = None
     try:
         caps = discover_all()
         _CAPS_SNAPSHOT = caps
@@ -300,6 +425,7 @@ def main():
     # === 主迴圈 ===
     last_ping = 0.0
     last_sched_refresh = 0.0
+    send_caps = True  # 第一次 ping 帶完整 caps，之後只帶 caps_hash
 
     while True:
         now = time.time()
@@ -307,12 +433,17 @@ def main():
         if now - last_ping > 30:
             try:
                 extra = {
-                    "state": _build_state_blob(caps),
+                    "state": _build_state_blob(_CAPS_SNAPSHOT),
                     "metrics": get_pi_metrics(),
                 }
                 if _CAPS_SNAPSHOT:
-                    extra["caps"] = _CAPS_SNAPSHOT
-                http.ping(extra=extra)
+                    extra["caps_hash"] = http.caps_hash(_CAPS_SNAPSHOT)
+                    if send_caps:
+                        extra["caps"] = _CAPS_SNAPSHOT
+                pong = http.ping(extra=extra)
+                if pong is not None:
+                    # 伺服器不認得 caps_hash 時會回 send_caps，下一次再帶完整清單
+                    send_caps = bool(pong.get("send_caps"))
             except Exception as e:
                 print("[WARN] ping 失敗：", e)
             last_ping = now
@@ -324,146 +455,23 @@ def main():
                 print("[sched] refresh err:", e)
             last_sched_refresh = now
 
+        # 一次取回多筆指令，依序執行後以一次 ack_batch 回報
         try:
-            cmd = http.pull(max_wait=8)
+            cmds = http.pull_batch(max_wait=8)
         except Exception as e:
             print("[WARN] pull 失敗：", e)
             time.sleep(0.5)
             continue
 
-        if not cmd:
+        if not cmds:
             time.sleep(0.1)
             continue
 
-        name = (cmd.get("cmd") or "").strip()
-        req_id = cmd.get("req_id") or ""
-        payload = cmd.get("payload") or {}
-
+        acks = [_handle_command(cmd) for cmd in cmds]
         try:
-            if name == "rescan_caps":
-                try:
-                    caps = discover_all()
-                    _CAPS_SNAPSHOT = caps
-                    _LAST_LIGHT_SLUG = _first_light_slug(caps) or _LAST_LIGHT_SLUG
-                    http.ping(extra={"caps": caps, "state": _build_state_blob(caps)})
-                    http.ack(req_id, ok=True, state=_state_for_slug(_LAST_LIGHT_SLUG))
-                except Exception as e:
-                    http.ack(req_id, ok=False, error=str(e))
-                continue
-
-            if name == "auto_light_on":
-                merged = deepcopy(CFG)
-                merged.setdefault("auto_light", {})
-                merged["auto_light"]["enabled"] = True
-                for k in (
-                    "sensor",
-                    "led",
-                    "on_below",
-                    "off_above",
-                    "sample_every_ms",
-                    "require_n_samples",
-                ):
-                    if k in payload:
-                        merged["auto_light"][k] = payload[k]
-                try:
-                    if not led.list_leds():
-                        led.setup_led(merged)
-                except Exception:
-                    led.setup_led(merged)
-
-                _LAST_LIGHT_SLUG = (
-                    payload.get("slug") or _LAST_LIGHT_SLUG or _first_light_slug(caps)
-                )
-                set_state_push(_push_state_from_auto)
-                try:
-                    stop_auto_light(wait=True)
-                except Exception:
-                    pass
-                start_auto_light(merged)
-
-                http.ack(req_id, ok=True, state=_state_for_slug(_LAST_LIGHT_SLUG))
-                continue
-
-            if name == "auto_light_off":
-                set_state_push(None)
-                stop_auto_light(wait=True)
-                led_name = payload.get("led") or (CFG.get("auto_light", {}) or {}).get(
-                    "led"
-                )
-                try:
-                    if led_name:
-                        led.light_off(led_name)
-                        print(f"[auto_light] 已停用，自動關燈 {led_name}")
-                    else:
-                        for k in list(led.list_leds().keys()):
-                            led.light_off(k)
-                        print("[auto_light] 已停用，未指定 LED，已嘗試關閉所有 LED")
-                except Exception as e:
-                    print("[auto_light] 停用時關燈失敗：", e)
-
-                slug = (
-                    payload.get("slug") or _LAST_LIGHT_SLUG or _first_light_slug(caps)
-                )
-                http.ack(req_id, ok=True, state=_state_for_slug(slug))
-                continue
-
-            handler = COMMANDS.get(name)
-            if handler is None:
-                http.ack(req_id, ok=False, error=f"unknown command: {name}")
-                continue
-
-            # 先處理 locker 指令的 debug 和 ack
-            if name in ("locker_lock", "locker_unlock", "locker_toggle"):
-                print(f"[DEBUG] 處理 locker 指令: {name}, req_id: {req_id}")
-                target = payload.get("target")
-                slug = payload.get("slug")
-                print(f"[DEBUG] target: {target}, slug: {slug}")
-                
-                if not slug:
-                    try:
-                        names = list((locker.list_lockers() or {}).keys())
-                        slug = names[0] if names else None
-                        print(f"[DEBUG] 自動取得 slug: {slug}")
-                    except Exception as e:
-                        print(f"[DEBUG] 取得 locker 清單失敗: {e}")
-                        slug = None
-                
-                if not slug:
-                    print(f"[DEBUG] 準備發送 ack (失敗): req_id={req_id}, error=missing slug")
-                    http.ack(
-                        req_id, ok=False, error="missing slug and no locker available"
-                    )
-                    print(f"[DEBUG] ack 已發送 (失敗)")
-                    continue
-                
-                # 執行硬體操作
-                print(f"[DEBUG] 準備執行硬體操作: {name}")
-                _call_handler(handler, cmd)
-                print(f"[DEBUG] 硬體操作完成: {name}")
-                
-                print(f"[DEBUG] 取得 locker 狀態: slug={slug}")
-                state = locker.get_state(slug)
-                print(f"[DEBUG] locker 狀態: {state}")
-                
-                print(f"[DEBUG] 準備發送 ack (成功): req_id={req_id}, state={slug}: {state}")
-                http.ack(req_id, ok=True, state={slug: state})
-                print(f"[DEBUG] ack 已發送 (成功)")
-                continue
-
-            # 執行其他指令
-            _call_handler(handler, cmd)
-
-            if name in ("light_on", "light_off", "light_toggle"):
-                slug = (
-                    payload.get("slug") or _LAST_LIGHT_SLUG or _first_light_slug(caps)
-                )
-                http.ack(req_id, ok=True, state=_state_for_slug(slug))
-
+            http.ack_batch(acks)
         except Exception as e:
-            try:
-                http.ack(req_id, ok=False, error=str(e))
-            except Exception:
-                print("[ERROR] ack 失敗：", e)
+            print("[ERROR] ack 失敗：", e)
 
 
 def get_pi_metrics():
@@ -1,14 +1,64 @@
 # 引入 Python 內建的模組
 from http.server import SimpleHTTPRequestHandler  # 提供基本的 HTTP 檔案服務功能
-from socketserver import TCPServer  # 用於建立 TCP 伺服器的基礎框架
+from http.server import ThreadingHTTPServer  # 每個連線一條執行緒（阻塞式重新載入會佔住連線）
 import os  # 用於和作業系統互動，例如檔案路徑操作
 import posixpath  # 用於處理符合 POSIX 標準的路徑（URL-like）
+import re  # 解析 Range 標頭
+import stat  # 判斷是否為一般檔案
+import threading  # 播放列表快取的鎖
 import urllib.parse  # 用於解析 URL
 
+from stream.llhls import PLAYLIST as LL_PLAYLIST, LLHLSPackager
+from stream.ring import stream_dir
+from stream import signing
+
 # --- 全域設定 ---
 # 設定 HLS 串流檔案（.m3u8 和 .ts）所在的根目錄
-# 伺服器會將此目錄作為提供檔案的基礎路徑
-HLS_ROOT = os.path.expanduser("~/pi_agent/stream")
+# 伺服器會將此目錄作為提供檔案的基礎路徑；與 agent 的推流程序共用 stream_dir()
+# （預設 tmpfs 的 /dev/shm/homepi-hls，可用環境變數 HOMEPI_HLS_DIR 指定）
+HLS_ROOT = stream_dir()
+
+# LL-HLS 打包器（homepi-hls-ll@.service 產生 parts.m3u8 時才有內容）
+# 完整片段長度（秒）可用環境變數 HLS_LL_SEGMENT 調整
+LL = LLHLSPackager(HLS_ROOT, float(os.getenv("HLS_LL_SEGMENT", "1.0")))
+
+# 簽章網址：網站發的 /s/<exp>/<stream>/<sig>/ 前綴（stream/signing.py），
+# 區網直連的瀏覽器與網站的 hls_proxy 都會帶。預設沒簽章的請求只收 HLS_TRUSTED_HOSTS
+# （逗號分隔，預設只有本機）；網站還沒更新、要收任何人的舊網址時設 HLS_REQUIRE_SIGNATURE=0
+REQUIRE_SIGNATURE = os.getenv("HLS_REQUIRE_SIGNATURE", "1") != "0"
+TRUSTED_HOSTS = {
+    h.strip()
+    for h in os.getenv("HLS_TRUSTED_HOSTS", "127.0.0.1").split(",")
+    if h.strip()
+}
+
+
+# --- 播放列表記憶體快取 ---
+class PlaylistCache:
+    """
+    .m3u8 很小但每個 viewer 每秒都會來讀；內容存在記憶體，
+    檔案的 (inode, mtime, 大小) 變了才重讀（ffmpeg temp_file 是整檔替換，inode 會變）。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._items = {}  # path -> (簽章, 內容)
+
+    def get(self, path):
+        st = os.stat(path)  # 檔案不存在就丟 FileNotFoundError 給呼叫端
+        sig = (st.st_ino, st.st_mtime_ns, st.st_size)
+        with self._lock:
+            item = self._items.get(path)
+        if item is not None and item[0] == sig:
+            return item[1], st
+        with open(path, "rb") as f:
+            data = f.read()
+        with self._lock:
+            self._items[path] = (sig, data)
+        return data, st
+
+
+PLAYLISTS = PlaylistCache()
 
 
 # --- 自訂請求處理器 ---
@@ -21,8 +71,15 @@ class CORSRequestHandler(SimpleHTTPRequestHandler):
     2. 正確的 MIME 類型：確保 .m3u8 和 .ts 檔案被瀏覽器正確識別。
     3. m3u8 播放列表的快取控制：強制瀏覽器每次都請求最新的播放列表。
     4. 安全的路徑處理：防止惡意使用者透過 URL 存取伺服器上的任意檔案。
+    5. 片段用 sendfile 零複製送出、支援 Range（206）；播放列表從記憶體快取回應。
+    6. HTTP/1.1 keep-alive：網站的 hls_proxy 會重複使用同一條連線。
+    7. 簽章網址（區網直連與 hls_proxy）：驗證 /s/<exp>/<stream>/<sig>/ 前綴後去掉，
+       其餘照一般檔案處理。
     """
 
+    # keep-alive 需要每個回應都有 Content-Length
+    protocol_version = "HTTP/1.1"
+
     # --- 私有輔助方法：設定 CORS 相關的 HTTP Headers ---
     def _set_cors(self):
         """
@@ -57,11 +114,127 @@ class CORSRequestHandler(SimpleHTTPRequestHandler):
         """
         # 回應 200 OK，表示伺服器理解此請求
         self.send_response(200, "OK")
-        # 加上 CORS 標頭，告知瀏覽器允許跨域存取
-        self._set_cors()
+        # 沒有內容（keep-alive 下也要明確告知長度）；CORS 標頭由 end_headers 加上
+        self.send_header("Content-Length", "0")
         # 結束標頭寫入
         self.end_headers()
 
+    # --- LL-HLS：阻塞式重新載入與預載提示 ---
+    def do_GET(self):
+        """
+        ll.m3u8 由記憶體裡的打包器提供：帶 _HLS_msn（與 _HLS_part）時，
+        等到清單含有該片段 / 小段才回應；預載提示的小段還沒產生時也先等它。
+        其他檔案照舊交給父類別。
+        """
+        if not self._authorize():
+            return
+        url = urllib.parse.urlsplit(self.path)
+        name = posixpath.basename(url.path)
+        if name == LL_PLAYLIST:
+            return self._send_ll_playlist(urllib.parse.parse_qs(url.query))
+        if name.startswith("ll") and name.endswith(".ts"):
+            LL.wait_part(name)
+        return self._send_file(head=False)
+
+    def do_HEAD(self):
+        if not self._authorize():
+            return
+        return self._send_file(head=True)
+
+    # --- 簽章網址 ---
+    def _authorize(self):
+        """
+        有 /s/<exp>/<stream>/<sig>/ 前綴：驗證後把 self.path 換成去掉前綴的路徑；
+        簽章錯誤、過期或檔案不屬於該串流回 403。沒有前綴的請求依 HLS_REQUIRE_SIGNATURE 決定。
+        """
+        url = urllib.parse.urlsplit(self.path)
+        ok, rest = signing.split(url.path)
+        if ok is None:
+            if REQUIRE_SIGNATURE and self.client_address[0] not in TRUSTED_HOSTS:
+                self.send_error(403, "Signature required")
+                return False
+            return True
+        if not ok:
+            self.send_error(403, "Invalid or expired signature")
+            return False
+        self.path = rest + (f"?{url.query}" if url.query else "")
+        return True
+
+    # --- 檔案回應：取代父類別的 send_head + copyfile ---
+    def _send_file(self, head):
+        """
+        .m3u8 從 PlaylistCache 拿；其他檔案用 socket.sendfile（Linux 上是 os.sendfile，
+        資料不經過 Python 緩衝區）。支援單一區段的 Range，不提供目錄列表。
+        """
+        path = self.translate_path(self.path)
+        ctype = self.guess_type(path)
+        if path.endswith(".m3u8"):
+            try:
+                data, st = PLAYLISTS.get(path)
+            except OSError:
+                return self.send_error(404, "File not found")
+            self.send_response(200)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(data)))
+            self.send_header("Last-Modified", self.date_time_string(st.st_mtime))
+            self.end_headers()
+            if not head:
+                self.wfile.write(data)
+            return
+
+        try:
+            f = open(path, "rb")
+        except OSError:
+            return self.send_error(404, "File not found")
+        with f:
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode):
+                return self.send_error(404, "File not found")
+            size = st.st_size
+            start, end = 0, size - 1
+            rng = _byte_range(self.headers.get("Range"), size)
+            if rng == "invalid":
+                self.send_response(416)
+                self.send_header("Content-Range", f"bytes */{size}")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            if rng:
+                start, end = rng
+                self.send_response(206)
+                self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+            else:
+                self.send_response(200)
+            length = end - start + 1
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(length))
+            self.send_header("Accept-Ranges", "bytes")
+            self.send_header("Last-Modified", self.date_time_string(st.st_mtime))
+            self.end_headers()
+            if not head and length > 0:
+                self.wfile.flush()
+                self.connection.sendfile(f, start, length)
+
+    def _send_ll_playlist(self, query):
+        def arg(key):
+            v = (query.get(key) or [""])[0]
+            return int(v) if v.isdigit() else None
+
+        msn, part = arg("_HLS_msn"), arg("_HLS_part")
+        if part is not None and msn is None:
+            return self.send_error(400, "_HLS_part without _HLS_msn")
+        body = LL.wait_for(msn, part)
+        if body is None:
+            # msn 超前太多回 400；逾時 / 串流還沒開始回 503
+            ahead = msn is not None and LL.segments and msn > LL.segments[-1].msn + 2
+            return self.send_error(400 if ahead else 503)
+        data = body.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/vnd.apple.mpegurl")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
     # --- 覆寫方法：修正 HLS 檔案的 Content-Type ---
     def guess_type(self, path):
         """
@@ -86,7 +259,7 @@ class CORSRequestHandler(SimpleHTTPRequestHandler):
         self._set_cors()
 
         # 特別處理 .m3u8 播放列表檔案
-        if self.path.endswith(".m3u8"):
+        if urllib.parse.urlsplit(self.path).path.endswith(".m3u8"):
             # .m3u8 檔案會持續更新，必須告訴瀏覽器和中間代理伺服器「不要快取」此檔案，
             # 才能確保播放器能拿到最新的影片分段列表。
             self.send_header("Cache-Control", "no-cache, no-store, must-revalidate")
@@ -120,22 +293,49 @@ class CORSRequestHandler(SimpleHTTPRequestHandler):
         return full
 
 
-# --- 主程式進入點 ---
-# 確保這段程式碼只在直接執行此 .py 檔案時才會運行
-if __name__ == "__main__":
-    # 將目前的工作目錄切換到 HLS 檔案的根目錄
-    # 這是因為 SimpleHTTPRequestHandler 的預設行為是從當前工作目錄提供檔案
+# --- Range 標頭解析 ---
+def _byte_range(header, size):
+    """
+    解析單一區段的 Range（bytes=a-b / a- / -n），回傳 (start, end)；
+    沒有或看不懂的 Range 回 None（照整檔送），超出檔案範圍回 "invalid"（416）。
+    """
+    m = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", header or "")
+    if not m or (not m.group(1) and not m.group(2)):
+        return None
+    if m.group(1):
+        start = int(m.group(1))
+        end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+    else:
+        start, end = max(0, size - int(m.group(2))), size - 1
+    if start >= size or start > end:
+        return "invalid"
+    return start, end
+
+
+# --- 主程式 ---
+def main():
+    # 將目前的工作目錄切換到 HLS 檔案的根目錄（tmpfs 開機後是空的，先建立）
+    os.makedirs(HLS_ROOT, exist_ok=True)
     os.chdir(HLS_ROOT)
 
     # 允許伺服器地址重用。這樣在重啟伺服器時，可以立即綁定同一個埠號，
     # 無需等待作業系統釋放，方便開發和除錯。
-    TCPServer.allow_reuse_address = True
+    ThreadingHTTPServer.allow_reuse_address = True
+    ThreadingHTTPServer.daemon_threads = True
+
+    # 啟動 LL-HLS 打包器的背景執行緒（沒有 parts.m3u8 時只是空轉等待）
+    LL.start()
 
-    # 建立一個 TCPServer 實例
+    # 建立一個多執行緒的 HTTP 伺服器實例
     # - 綁定在 "0.0.0.0" 表示監聽所有可用的網路介面（不只是 localhost）
     # - 監聽 8088 埠號
     # - 使用我們上面自訂的 CORSRequestHandler 來處理所有傳入的請求
-    with TCPServer(("0.0.0.0", 8088), CORSRequestHandler) as httpd:
+    with ThreadingHTTPServer(("0.0.0.0", 8088), CORSRequestHandler) as httpd:
         print("HLS static server listening on :8088, root =", HLS_ROOT)
         # 啟動伺服器，使其永久運行，直到手動中斷（例如按下 Ctrl+C）
         httpd.serve_forever()
+
+
+# 確保這段程式碼只在直接執行此 .py 檔案時才會運行
+if __name__ == "__main__":
+    main()
@@ -1,40 +1,12 @@
 # /home/qkauia/pi_agent/stream/http_hls.py
-from http.server import SimpleHTTPRequestHandler
-from socketserver import TCPServer
+# 舊的單執行緒靜態伺服器已由 serve_hls.py 取代（多執行緒、sendfile、Range、播放列表快取）；
+# 保留這個入口給還在用 `python3 stream/http_hls.py` 的舊設定，行為與 serve_hls.py 相同。
 import os
+import sys
 
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
-class CORSRequestHandler(SimpleHTTPRequestHandler):
-    # 用 HTTP/1.1（較穩 + 支援 206 partial content）
-    protocol_version = "HTTP/1.1"
-
-    def end_headers(self):
-        self.send_header("Access-Control-Allow-Origin", "*")
-        # 允許 Range 頭，避免 preflight 卡住
-        self.send_header(
-            "Access-Control-Allow-Headers",
-            "Origin, Accept, Content-Type, Range, Referer, User-Agent",
-        )
-        self.send_header("Access-Control-Allow-Methods", "GET, OPTIONS")
-        # 避免快取舊的 m3u8
-        self.send_header("Cache-Control", "no-store, max-age=0")
-        return super().end_headers()
-
-    def do_OPTIONS(self):
-        # 回應預檢要求
-        self.send_response(204)
-        self.end_headers()
-
-    def guess_type(self, path):
-        if path.endswith(".m3u8"):
-            return "application/vnd.apple.mpegurl"
-        if path.endswith(".ts"):
-            return "video/mp2t"
-        return super().guess_type(path)
-
+from serve_hls import CORSRequestHandler, main  # noqa: E402,F401
 
 if __name__ == "__main__":
-    os.chdir("/home/qkauia/pi_agent/stream")
-    TCPServer.allow_reuse_address = True
-    with TCPServer(("0.0.0.0", 8088), CORSRequestHandler) as httpd:
-        httpd.serve_forever()
+    main()
@@ -0,0 +1,247 @@
+# -*- coding: utf-8 -*-
+"""
+LL-HLS（低延遲 HLS）打包器：把 ffmpeg 切出來的小段 TS 組成 EXT-X-PART 播放清單
+
+ffmpeg（homepi-hls-ll@.service）每 ~0.33 秒切一個 part_*.ts 並更新 parts.m3u8；
+這裡在 serve_hls.py 的背景執行緒裡輪詢它：
+- 每個小段改名成 ll<run>_<msn>_<i>.ts（EXT-X-PART），湊滿 SEGMENT_SECONDS 秒
+  就把這幾段接成完整片段 ll<run>_<msn>.ts（TS 可直接串接）
+- <run> 是啟動時間，攝影機重啟後檔名不會和上一輪撞（hls_proxy 會快取片段）
+- 播放清單 ll.m3u8 只存在記憶體；wait_for(msn, part) 給 serve_hls.py 做
+  阻塞式重新載入（_HLS_msn / _HLS_part），新小段一出來就喚醒等待者
+- EXT-X-PRELOAD-HINT 指向下一個小段，請求它時 wait_part() 會等到檔案出現
+"""
+import math
+import os
+import re
+import threading
+import time
+
+PLAYLIST = "ll.m3u8"
+SOURCE = "parts.m3u8"  # ffmpeg 輸出的小段清單
+
+_PART_RE = re.compile(r"^ll[0-9a-z]+_(\d+)_(\d+)\.ts$")
+
+
+def _has_idr(data: bytes) -> bool:
+    """粗略判斷這段 TS 裡有沒有 H.264 IDR（start code 後 NAL type 5）"""
+    i = data.find(b"\x00\x00\x01")
+    while 0 <= i < len(data) - 3:
+        if data[i + 3] & 0x1F == 5:
+            return True
+        i = data.find(b"\x00\x00\x01", i + 3)
+    return False
+
+
+def _parse_source(text: str) -> list:
+    """ffmpeg parts.m3u8 → [(檔名, 秒數), ...]"""
+    parts, dur = [], None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith("#EXTINF:"):
+            try:
+                dur = float(line[8:].split(",")[0])
+            except ValueError:
+                dur = None
+        elif line and not line.startswith("#") and dur is not None:
+            parts.append((os.path.basename(line), dur))
+            dur = None
+    return parts
+
+
+class _Segment:
+    def __init__(self, msn: int):
+        self.msn = msn
+        self.parts = []  # [(檔名, 秒數, 是否含 IDR), ...]
+        self.data = []  # 小段內容，完成時接成完整片段
+        self.complete = False
+
+    @property
+    def duration(self) -> float:
+        return sum(p[1] for p in self.parts)
+
+
+class LLHLSPackager:
+    def __init__(
+        self,
+        root: str,
+        segment_seconds: float = 1.0,
+        part_target: float = 0.334,
+        list_segments: int = 6,
+        poll: float = 0.05,
+    ):
+        self.root = root
+        self.segment_seconds = float(segment_seconds)
+        self.part_target = float(part_target)
+        self.list_segments = max(3, int(list_segments))
+        self.poll = float(poll)
+        self.cond = threading.Condition()
+        self._reset()
+
+    def _reset(self):
+        self.run = format(int(time.time()), "x")
+        self.segments = []
+        self.next_msn = 0
+        self.last_source = None  # 最後處理過的 ffmpeg 小段檔名
+        self.playlist = None
+
+    # ---------- 背景輪詢 ----------
+    def start(self) -> threading.Thread:
+        t = threading.Thread(target=self._loop, name="llhls", daemon=True)
+        t.start()
+        return t
+
+    def _loop(self):
+        mtime = None
+        src = os.path.join(self.root, SOURCE)
+        while True:
+            try:
+                m = os.stat(src).st_mtime_ns
+                if m != mtime:
+                    mtime = m
+                    with open(src, encoding="utf-8") as f:
+                        self.update(_parse_source(f.read()))
+            except FileNotFoundError:
+                with self.cond:
+                    if self.segments:
+                        self._cleanup(self.segments)
+                        self._reset()  # ffmpeg 停了：清空，下次從新的 run 開始
+            except Exception as e:
+                print("llhls update failed:", e)
+            time.sleep(self.poll)
+
+    def update(self, source_parts: list) -> int:
+        """吃進 ffmpeg 清單，處理還沒看過的小段；回傳新增的數量"""
+        names = [n for n, _ in source_parts]
+        with self.cond:
+            if self.last_source is not None and self.last_source not in names:
+                # 清單裡找不到上次的最後一段：ffmpeg 重啟或跳太多，重新開始
+                self._cleanup(self.segments)
+                self._reset()
+            if self.last_source:
+                start = names.index(self.last_source) + 1
+            else:
+                start = max(0, len(names) - 6)  # 剛啟動：只從最近幾個小段開始
+            added = 0
+            for name, dur in source_parts[start:]:
+                try:
+                    with open(os.path.join(self.root, name), "rb") as f:
+                        data = f.read()
+                except FileNotFoundError:
+                    continue  # 已被 ffmpeg 刪掉
+                self._add_part(data, dur)
+                self.last_source = name
+                added += 1
+            if added:
+                self.playlist = self.render()
+                self.cond.notify_all()
+        return added
+
+    def _add_part(self, data: bytes, dur: float):
+        seg = self.segments[-1] if self.segments else None
+        if seg is None or seg.complete:
+            seg = _Segment(self.next_msn)
+            self.next_msn += 1
+            self.segments.append(seg)
+        name = f"ll{self.run}_{seg.msn}_{len(seg.parts)}.ts"
+        self._write(name, data)
+        seg.parts.append((name, dur, _has_idr(data)))
+        seg.data.append(data)
+        self.part_target = max(self.part_target, math.ceil(dur * 1000) / 1000)
+        # 差不到半個小段就算湊滿（0.333 × 3 不會剛好等於 1.0）
+        if seg.duration >= self.segment_seconds - dur / 2:
+            self._write(f"ll{self.run}_{seg.msn}.ts", b"".join(seg.data))
+            seg.data = []
+            seg.complete = True
+            old = self.segments[: -self.list_segments]
+            if old:
+                self.segments = self.segments[-self.list_segments :]
+                self._cleanup(old)
+
+    def _write(self, name: str, data: bytes):
+        path = os.path.join(self.root, name)
+        with open(path + ".tmp", "wb") as f:
+            f.write(data)
+        os.replace(path + ".tmp", path)
+
+    def _cleanup(self, segments: list):
+        for seg in segments:
+            files = [p[0] for p in seg.parts] + [f"ll{self.run}_{seg.msn}.ts"]
+            for name in files:
+                try:
+                    os.remove(os.path.join(self.root, name))
+                except OSError:
+                    pass
+
+    # ---------- 播放清單 ----------
+    def _next_part(self):
+        """下一個小段的 (msn, index)，給 EXT-X-PRELOAD-HINT 用"""
+        seg = self.segments[-1]
+        if seg.complete:
+            return seg.msn + 1, 0
+        return seg.msn, len(seg.parts)
+
+    def render(self) -> str:
+        done = [s for s in self.segments if s.complete]
+        target = max([1.0] + [s.duration for s in done])
+        lines = [
+            "#EXTM3U",
+            "#EXT-X-VERSION:6",
+            f"#EXT-X-TARGETDURATION:{math.ceil(round(target, 3))}",
+            "#EXT-X-SERVER-CONTROL:CAN-BLOCK-RELOAD=YES,"
+            f"PART-HOLD-BACK={self.part_target * 3:.3f}",
+            f"#EXT-X-PART-INF:PART-TARGET={self.part_target:.3f}",
+            f"#EXT-X-MEDIA-SEQUENCE:{self.segments[0].msn}",
+        ]
+        # 小段只列最後 3 個片段內的（規格建議），更早的只列完整片段
+        with_parts = {s.msn for s in self.segments[-3:]}
+        for seg in self.segments:
+            if seg.msn in with_parts:
+                for name, dur, idr in seg.parts:
+                    attr = ",INDEPENDENT=YES" if idr else ""
+                    lines.append(f'#EXT-X-PART:DURATION={dur:.3f},URI="{name}"{attr}')
+            if seg.complete:
+                lines.append(f"#EXTINF:{seg.duration:.3f},")
+                lines.append(f"ll{self.run}_{seg.msn}.ts")
+        msn, idx = self._next_part()
+        lines.append(f'#EXT-X-PRELOAD-HINT:TYPE=PART,URI="ll{self.run}_{msn}_{idx}.ts"')
+        return "\n".join(lines) + "\n"
+
+    # ---------- 阻塞式重新載入 ----------
+    def _has(self, msn: int, part: int | None) -> bool:
+        # 呼叫端已持有 self.cond
+        if not self.segments:
+            return False
+        last = self.segments[-1]
+        if msn < last.msn:
+            return True
+        if msn > last.msn:
+            return False
+        if part is None:
+            return last.complete
+        return last.complete or len(last.parts) > part
+
+    def wait_for(self, msn: int | None = None, part: int | None = None, timeout=None):
+        """
+        等到播放清單含有第 msn 個片段（給 part 時是其第 part 個小段）再回傳內容；
+        msn 超前太多（> 下一個 +1）回 None 讓呼叫端回 400，逾時回 None。
+        """
+        timeout = self.part_target * 9 if timeout is None else timeout
+        with self.cond:
+            if msn is None:
+                self.cond.wait_for(lambda: self.playlist is not None, timeout)
+                return self.playlist
+            if self.segments and msn > self.segments[-1].msn + 2:
+                return None
+            if self.cond.wait_for(lambda: self._has(msn, part), timeout):
+                return self.playlist
+            return None
+
+    def wait_part(self, name: str, timeout=None) -> bool:
+        """預載提示（PRELOAD-HINT）指的小段還沒產生時，等它出現"""
+        if not _PART_RE.match(name):
+            return os.path.exists(os.path.join(self.root, name))
+        timeout = self.part_target * 3 if timeout is None else timeout
+        path = os.path.join(self.root, name)
+        with self.cond:
+            return self.cond.wait_for(lambda: os.path.exists(path), timeout)
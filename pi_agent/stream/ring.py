@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""
+HLS 片段的 tmpfs 環狀緩衝
+
+- 片段寫在記憶體檔案系統（預設 /dev/shm/homepi-hls），不寫 SD 卡
+- 只保留最新的 size 個片段，更舊的直接刪掉；ffmpeg 用 temp_file 先寫 .tmp 再改名，
+  所以目錄裡看得到的片段一定是完整的，刪除也是單一的 unlink
+- agent（devices/camera.py）寫入、serve_hls.py 讀取，兩邊都用 stream_dir() 找目錄
+"""
+import os
+import re
+
+# 片段檔名：seg_00001.ts（一般）/ part_00001.ts（LL-HLS 小段）
+_SEGMENT_RE = re.compile(r"^(seg|part)_(\d+)\.ts$")
+
+
+def stream_dir() -> str:
+    """HLS 輸出目錄：環境變數 HOMEPI_HLS_DIR 優先，其次 tmpfs，最後 ~/pi_agent/stream"""
+    path = os.getenv("HOMEPI_HLS_DIR")
+    if path:
+        return os.path.expanduser(path)
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm/homepi-hls"
+    return os.path.expanduser("~/pi_agent/stream")
+
+
+class SegmentRing:
+    def __init__(self, root: str, size: int = 12):
+        self.root = root
+        self.size = max(3, int(size))
+
+    def _segments(self) -> list:
+        """目前的片段，依編號由舊到新：[(編號, 檔名), ...]"""
+        found = []
+        try:
+            names = os.listdir(self.root)
+        except FileNotFoundError:
+            return []
+        for name in names:
+            m = _SEGMENT_RE.match(name)
+            if m:
+                found.append((int(m.group(2)), name))
+        found.sort()
+        return found
+
+    def prune(self) -> int:
+        """刪掉超出 size 的舊片段，回傳刪除數量"""
+        removed = 0
+        for _, name in self._segments()[: -self.size]:
+            try:
+                os.remove(os.path.join(self.root, name))
+                removed += 1
+            except FileNotFoundError:
+                pass
+        return removed
+
+    def reset(self) -> None:
+        """開始推流前清空上一輪的播放列表、片段與暫存檔"""
+        os.makedirs(self.root, exist_ok=True)
+        for name in os.listdir(self.root):
+            if name.endswith((".m3u8", ".ts", ".tmp")):
+                try:
+                    os.remove(os.path.join(self.root, name))
+                except OSError:
+                    pass
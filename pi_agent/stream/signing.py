@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+"""
+HLS 簽章網址驗證（網站端見 pi_devices/utils/hls_sign.py）
+
+網址：/s/<exp>/<stream>/<sig>/<檔名>
+- sig = HMAC-SHA256(key, "<序號（大寫）>:<exp>:<stream>")，
+  key = HMAC-SHA256(TOKEN, "homepi-hls")
+- stream 是哪一路串流，檔名必須屬於這一路（STREAM_FILES），不然同一個簽章不能用
+- SERIAL / TOKEN 與 agent 共用 .env；exp 是 Unix 秒數，過期就不收
+- 片段用相對路徑，瀏覽器會自動帶上同一個 /s/<exp>/<stream>/<sig>/ 前綴
+"""
+import hashlib
+import hmac
+import os
+import re
+import time
+
+PREFIX_RE = re.compile(r"^/s/(\d{1,12})/([a-z]{1,16})/([0-9a-f]{64})/([^/]+)$")
+
+# 每一路串流可以拿的檔案：index = ffmpeg 的一般 HLS，ll = stream/llhls.py 的 LL-HLS
+STREAM_FILES = {
+    "index": re.compile(r"index\.m3u8|seg_\d+\.ts"),
+    "ll": re.compile(r"ll\.m3u8|ll[0-9a-f]+_\d+(?:_\d+)?\.ts"),
+}
+
+
+def signing_key(token: str) -> bytes:
+    return hmac.new(token.encode("utf-8"), b"homepi-hls", hashlib.sha256).digest()
+
+
+def signature(token: str, serial: str, exp: int, stream: str) -> str:
+    msg = f"{serial.upper()}:{int(exp)}:{stream}".encode("utf-8")
+    return hmac.new(signing_key(token), msg, hashlib.sha256).hexdigest()
+
+
+def split(path: str):
+    """
+    拆出簽章前綴：不是 /s/ 開頭回 (None, path)；
+    是的話回 (是否有效, 去掉前綴的路徑)。
+    """
+    if not path.startswith("/s/"):
+        return None, path
+    m = PREFIX_RE.match(path)
+    if not m:
+        return False, path  # 格式不對（舊版網址、子目錄）一律不收
+    exp, stream, sig, name = int(m.group(1)), m.group(2), m.group(3), m.group(4)
+    rest = "/" + name
+    files = STREAM_FILES.get(stream)
+    if files is None or not files.fullmatch(name):
+        return False, rest
+    token, serial = os.getenv("TOKEN", ""), os.getenv("SERIAL", "")
+    if not token or not serial or exp < time.time():
+        return False, rest
+    return hmac.compare_digest(sig, signature(token, serial, exp, stream)), rest
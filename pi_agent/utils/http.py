@@ -8,10 +8,18 @@ utils/http.py
 """
 
 import os
+import gzip
+import json
+import hashlib
 import requests
 from typing import Optional, Union
 from dotenv import load_dotenv
 
+try:
+    import msgpack
+except ImportError:  # 沒裝 msgpack 就一律送 JSON
+    msgpack = None
+
 # 從 .env 檔案載入環境變數。這是一個很好的資安實踐，
 # 可以避免將敏感資訊（如裝置序列號、Token）硬寫在程式碼中。
 load_dotenv()
@@ -32,14 +40,58 @@ API_BASE = os.getenv("API_BASE", "http://172.28.104.118:8888/")
 PING_PATH = "/api/device/ping/"
 PULL_PATH = "/api/device/pull/"
 ACK_PATH = "/api/device/ack/"
+ACK_BATCH_PATH = "/api/device/ack_batch/"
 SCHEDULES_PATH = "/api/device/schedules/"
 SCHEDULE_ACK_PATH = "/api/device/schedule_ack/"
+# 一次 pull 最多取回幾筆指令（伺服器端另有上限 DEVICE_COMMAND_MAX_BATCH）
+PULL_MAX_BATCH = int(os.getenv("PULL_MAX_BATCH", "10"))
+
+# 請求本體超過這個大小（bytes）且伺服器支援 v2 時才 gzip
+GZIP_MIN_BYTES = int(os.getenv("GZIP_MIN_BYTES", "1024"))
+# 伺服器支援時是否改用 msgpack（設 0 可強制 JSON，方便抓封包除錯）
+USE_MSGPACK = os.getenv("USE_MSGPACK", "1") != "0"
 
 # 建立一個 requests session 來重用 TCP 連線，可以提升效能。
 _session = requests.Session()
 # 在所有請求的標頭中設定 Content-Type，讓伺服器知道我們發送的是 JSON 格式。
 _session.headers.update({"Content-Type": "application/json"})
 
+# 與伺服器協商出的傳輸格式（由 ping 的 pong 更新；舊伺服器不回就維持 v1）
+_wire = {"protocol": 1, "gzip": False, "msgpack": False}
+
+
+def _negotiate(pong: dict) -> None:
+    """依 pong 的 protocol / encodings / content_types 決定之後怎麼送"""
+    version = int(pong.get("protocol") or 1)
+    _wire["protocol"] = version
+    _wire["gzip"] = version >= 2 and "gzip" in (pong.get("encodings") or [])
+    _wire["msgpack"] = (
+        version >= 2
+        and USE_MSGPACK
+        and msgpack is not None
+        and "application/msgpack" in (pong.get("content_types") or [])
+    )
+
+
+def _post(url: str, payload: dict, timeout: float) -> requests.Response:
+    """
+    內部函式：依協商結果編碼後送出。
+    v1 = JSON；v2 可能是 msgpack，且本體夠大時 gzip 壓縮。
+    """
+    if _wire["protocol"] < 2:
+        return _session.post(url, json=payload, timeout=timeout)
+
+    headers = {}
+    if _wire["msgpack"]:
+        body = msgpack.packb(payload, use_bin_type=True)
+        headers["Content-Type"] = "application/msgpack"
+    else:
+        body = json.dumps(payload, separators=(",", ":")).encode("utf-8")
+    if _wire["gzip"] and len(body) >= GZIP_MIN_BYTES:
+        body = gzip.compress(body)
+        headers["Content-Encoding"] = "gzip"
+    return _session.post(url, data=body, headers=headers, timeout=timeout)
+
 
 def _print_resp(prefix: str, r: requests.Response) -> None:
     """
@@ -53,34 +105,50 @@ def _print_resp(prefix: str, r: requests.Response) -> None:
         print(f"{prefix}: HTTP {r.status_code} ->", r.text)
 
 
-def ping(extra: Optional[dict] = None) -> bool:
+def caps_hash(caps: list) -> str:
+    """
+    能力清單的內容雜湊（與伺服器 pi_devices/views/api.py::caps_hash 算法相同）。
+    平常 ping 只帶這個值，伺服器不認得時才回 send_caps 要完整清單。
+    """
+    raw = json.dumps(caps, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def ping(extra: Optional[dict] = None) -> Optional[dict]:
     """
     向伺服器發送「心跳」訊號，表明裝置還活著。
-    可以選擇性地附帶裝置的當前狀態 (caps/state) 等額外資訊。
+    可以選擇性地附帶裝置的當前狀態 (caps/caps_hash/state) 等額外資訊。
 
     Args:
         extra: 包含額外資訊的字典。
 
     Returns:
-        bool: 如果心跳成功回傳 True，否則為 False。
+        Optional[dict]: 成功時回傳伺服器的 pong（可能含 send_caps=True），失敗為 None。
     """
     url = f"{API_BASE}{PING_PATH}"
     payload = {"serial_number": SERIAL, "token": TOKEN}
     if extra:
         payload.update(extra)
-        payload["extra"] = extra
+        if _wire["protocol"] < 2:
+            # 舊伺服器只從 extra 讀 metrics；v2 每個欄位只送一次
+            payload["extra"] = extra
     try:
-        r = _session.post(url, json=payload, timeout=5)
+        r = _post(url, payload, timeout=5)
     except Exception as e:
         print("ping err (conn):", e)
-        return False
+        return None
 
     if r.ok:
         _print_resp("ping ok", r)
-        return True
+        try:
+            pong = r.json() or {}
+        except Exception:
+            return {}
+        _negotiate(pong)
+        return pong
 
     _print_resp("ping err", r)
-    return False
+    return None
 
 
 def pull(max_wait: int = 20) -> Optional[dict]:
@@ -96,9 +164,9 @@ def pull(max_wait: int = 20) -> Optional[dict]:
     """
     url = f"{API_BASE}{PULL_PATH}"
     try:
-        r = _session.post(
+        r = _post(
             url,
-            json={"serial_number": SERIAL, "token": TOKEN, "max_wait": max_wait},
+            {"serial_number": SERIAL, "token": TOKEN, "max_wait": max_wait},
             timeout=max_wait + 5,
         )
     except Exception as e:
@@ -122,6 +190,52 @@ def pull(max_wait: int = 20) -> Optional[dict]:
     return data
 
 
+def pull_batch(max_wait: int = 20, max_batch: int = PULL_MAX_BATCH) -> list:
+    """
+    長輪詢拉取指令（批次版）：一次回傳最多 max_batch 筆待執行指令。
+
+    Args:
+        max_wait: 等待伺服器回應的最長時間（秒）。
+        max_batch: 最多取回幾筆。
+
+    Returns:
+        list: 指令字典清單（依建立順序）；沒有指令或發生錯誤時為空清單。
+    """
+    url = f"{API_BASE}{PULL_PATH}"
+    try:
+        r = _post(
+            url,
+            {
+                "serial_number": SERIAL,
+                "token": TOKEN,
+                "max_wait": max_wait,
+                "max_batch": max_batch,
+            },
+            timeout=max_wait + 5,
+        )
+    except Exception as e:
+        print("pull err (conn):", e)
+        return []
+
+    if r.status_code == 204:
+        return []
+    if not r.ok:
+        _print_resp("pull err", r)
+        return []
+
+    try:
+        data = r.json()
+    except Exception:
+        print("pull err: bad json:", r.text)
+        return []
+
+    print("pull got:", data)
+    # 舊版伺服器不認得 max_batch，只會回單筆格式
+    if "cmds" not in data:
+        return [data] if data.get("cmd") else []
+    return [c for c in data.get("cmds") or [] if isinstance(c, dict)]
+
+
 def ack(req_id: str, ok: bool = True, error: str = "", state: Optional[dict] = None):
     """
     回報指令的執行結果給伺服器。
@@ -150,7 +264,7 @@ def ack(req_id: str, ok: bool = True, error: str = "", state: Optional[dict] = N
     print(f"[DEBUG] ack URL: {url}")
 
     try:
-        r = _session.post(url, json=payload, timeout=5)
+        r = _post(url, payload, timeout=5)
         print(f"[DEBUG] ack HTTP 回應: status_code={r.status_code}")
     except Exception as e:
         print(f"[DEBUG] ack 連線錯誤: {e}")
@@ -165,6 +279,40 @@ def ack(req_id: str, ok: bool = True, error: str = "", state: Optional[dict] = N
         print("ack ok")
 
 
+def ack_batch(acks: list) -> None:
+    """
+    一次回報多筆指令的執行結果。
+
+    Args:
+        acks: [{"req_id", "ok", "error", "state"}, ...]，依執行順序排列。
+    """
+    acks = [a for a in acks if a and a.get("req_id")]
+    if not acks:
+        return
+    if len(acks) == 1:
+        a = acks[0]
+        ack(a["req_id"], ok=a.get("ok", True), error=a.get("error", ""), state=a.get("state"))
+        return
+
+    url = f"{API_BASE}{ACK_BATCH_PATH}"
+    payload = {"serial_number": SERIAL, "token": TOKEN, "acks": acks}
+    try:
+        r = _post(url, payload, timeout=5)
+    except Exception as e:
+        print("ack_batch err (conn):", e)
+        return
+
+    if r.status_code == 404:
+        # 舊版伺服器沒有批次端點：逐筆回報
+        for a in acks:
+            ack(a["req_id"], ok=a.get("ok", True), error=a.get("error", ""), state=a.get("state"))
+        return
+    if not r.ok:
+        _print_resp("ack_batch err", r)
+    else:
+        _print_resp("ack_batch ok", r)
+
+
 def fetch_schedules() -> list:
     """
     向伺服器請求未來的排程清單。
@@ -175,7 +323,7 @@ def fetch_schedules() -> list:
     url = f"{API_BASE}{SCHEDULES_PATH}"
     payload = {"serial_number": SERIAL, "token": TOKEN}
     try:
-        r = _session.post(url, json=payload, timeout=5)
+        r = _post(url, payload, timeout=5)
     except Exception as e:
         print("fetch_schedules err (conn):", e)
         return []
@@ -216,7 +364,7 @@ def schedule_ack(schedule_id: int, ok: bool, error: str = ""):
         "error": error,
     }
     try:
-        r = _session.post(url, json=payload, timeout=5)
+        r = _post(url, payload, timeout=5)
     except Exception as e:
         print("schedule_ack err (conn):", e)
         return
@@ -124,11 +124,7 @@ class DeviceAdmin(admin.ModelAdmin):
 
     @admin.display(boolean=True, description="在線", ordering="last_ping")
     def online(self, obj: Device):
-        if not obj.last_ping:
-            return False
-        return obj.last_ping >= timezone.now() - timedelta(
-            seconds=ONLINE_WINDOW_SECONDS
-        )
+        return obj.is_online(ONLINE_WINDOW_SECONDS)
 
     @admin.display(description="能力數")
     def capabilities_count(self, obj: Device):
@@ -1,7 +1,25 @@
+import threading
+
 from django.apps import AppConfig
+from django.conf import settings
 
 
 class PiDevicesConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "pi_devices"
     verbose_name = "裝置與能力"
+
+    def ready(self):
+        from . import checks  # noqa: F401（註冊部署檢查）
+        from .utils import device_auth
+
+        # Device 存檔/刪除時清掉驗證快取
+        device_auth.connect_signals()
+
+        if getattr(settings, "MONGO_ENSURE_INDEXES_ON_STARTUP", False):
+            from HomePiWeb.mongo_indexes import ensure_indexes_quietly
+
+            # 背景執行：Mongo 慢或沒開都不要卡住啟動
+            threading.Thread(
+                target=ensure_indexes_quietly, name="mongo-indexes", daemon=True
+            ).start()
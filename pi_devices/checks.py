@@ -0,0 +1,44 @@
+# pi_devices/checks.py
+# -*- coding: utf-8 -*-
+"""
+部署檢查（manage.py check / migrate 時執行）
+
+裝置驗證快取的版本號、HLS 觀看者紀錄都放在 Django cache；
+多個 worker 時若用各行程自己的記憶體 cache，彼此看不到：
+別的 worker 解除綁定後這裡仍用舊的主人、還有人在看的攝影機被當成閒置關掉。
+"""
+from django.conf import settings
+from django.core.checks import Error, Tags, register
+
+_LOCAL_BACKENDS = (
+    "django.core.cache.backends.locmem.LocMemCache",
+    "django.core.cache.backends.dummy.DummyCache",
+)
+
+
+@register(Tags.caches)
+def check_shared_caches(app_configs=None, **kwargs):
+    workers = int(getattr(settings, "HOMEPI_WORKERS", 1) or 1)
+    if workers <= 1:
+        return []
+    aliases = {
+        "DEVICE_AUTH_VERSION_CACHE": getattr(
+            settings, "DEVICE_AUTH_VERSION_CACHE", "default"
+        ),
+        "HLS_ON_DEMAND['CACHE']": (
+            getattr(settings, "HLS_ON_DEMAND", None) or {}
+        ).get("CACHE", "default"),
+    }
+    errors = []
+    for setting, alias in aliases.items():
+        backend = settings.CACHES.get(alias, {}).get("BACKEND", "")
+        if backend in _LOCAL_BACKENDS:
+            errors.append(
+                Error(
+                    f"{setting} 指向的 cache '{alias}' 是單一行程的 {backend}，"
+                    f"但 HOMEPI_WORKERS={workers}",
+                    hint="設定 REDIS_URL（或其他共用 cache），或只跑一個 worker",
+                    id="pi_devices.E001",
+                )
+            )
+    return errors
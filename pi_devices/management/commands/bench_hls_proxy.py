@@ -0,0 +1,108 @@
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from django.core.management.base import BaseCommand
+
+from pi_devices.utils.upstream_pool import UpstreamPool
+
+
+class Command(BaseCommand):
+    help = (
+        "比較 hls_proxy 抓片段時「每次新連線」與「upstream_pool keep-alive」的延遲。\n"
+        "預設在本機起一個假的 HLS 伺服器（模擬 Pi 的 8088）；\n"
+        "加 --url http://<pi-ip>:8088 可直接對真的 Pi 量：\n"
+        "  python manage.py bench_hls_proxy -n 300 --segment-kb 256"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", help="HLS 來源（不給就起本機假伺服器）")
+        parser.add_argument("--segment", default="seg_00001.ts")
+        parser.add_argument("-n", "--requests", type=int, default=200)
+        parser.add_argument(
+            "--segment-kb", type=int, default=256, help="假伺服器的片段大小"
+        )
+
+    def handle(self, *args, **opts):
+        server = None
+        base = opts["url"]
+        if not base:
+            server = _start_stand_in(opts["segment_kb"] * 1024)
+            base = f"http://127.0.0.1:{server.server_address[1]}"
+        url = f"{base.rstrip('/')}/{opts['segment']}"
+        n = opts["requests"]
+
+        try:
+            plain = _measure(lambda: requests.get(url, timeout=(3, 20)), n)
+            pool = UpstreamPool(max_size=4)
+            pooled = _measure(lambda: pool.get(url, timeout=(3, 20)), n)
+            pool.close()
+        finally:
+            if server is not None:
+                server.shutdown()
+
+        self.stdout.write(f"來源          : {url}（{n} 次）")
+        self._report("每次新連線", plain)
+        self._report("連線池", pooled)
+        if plain and pooled:
+            gain = 1 - statistics.median(pooled) / statistics.median(plain)
+            self.stdout.write(self.style.SUCCESS(f"p50 改善      : {gain:.0%}"))
+
+    def _report(self, label, lat):
+        if not lat:
+            self.stdout.write(self.style.ERROR(f"{label}: 全部失敗"))
+            return
+        lat = sorted(lat)
+        p95 = lat[min(len(lat) - 1, int(len(lat) * 0.95))]
+        self.stdout.write(
+            f"{label:<10}: p50 {statistics.median(lat) * 1000:.2f}ms / "
+            f"p95 {p95 * 1000:.2f}ms / max {lat[-1] * 1000:.2f}ms"
+        )
+
+
+def _measure(fetch, n: int) -> list:
+    lat = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        try:
+            r = fetch()
+            r.content
+            if r.status_code != 200:
+                continue
+        except requests.RequestException:
+            continue
+        lat.append(time.perf_counter() - t0)
+    return lat
+
+
+def _start_stand_in(segment_bytes: int) -> ThreadingHTTPServer:
+    """本機假 HLS 伺服器：HTTP/1.1 keep-alive，任何 .ts 都回固定大小的內容"""
+    payload = b"\x47" * segment_bytes  # TS sync byte
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            if self.path.endswith(".m3u8"):
+                body = b"#EXTM3U\n#EXTINF:2.0,\nseg_00001.ts\n"
+                ctype = "application/vnd.apple.mpegurl"
+            elif self.path.endswith(".ts"):
+                body, ctype = payload, "video/mp2t"
+            else:
+                self.send_error(404)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", ctype)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -1,42 +1,141 @@
+import time
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
 from django.core.management.base import BaseCommand
 from django.utils import timezone
-from django.conf import settings
-from datetime import timedelta
 
-from pi_devices.models import Device
 from HomePiWeb.mongo import device_ping_logs
+from notifications.services import notify_user_offline
+from pi_devices.models import Device
 
 
 class Command(BaseCommand):
-    help = "檢查裝置是否掉線，並補一筆 offline 紀錄到 MongoDB"
+    help = (
+        "檢查裝置是否掉線：補一筆 offline 紀錄到 MongoDB，"
+        "並通知「最後一台裝置也離線」的使用者。可用 --loop 常駐。"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--loop", action="store_true", help="常駐，定期執行")
+        parser.add_argument(
+            "--interval",
+            type=float,
+            default=getattr(settings, "DEVICE_OFFLINE_SWEEP_SECONDS", 30),
+            help="--loop 時的間隔秒數",
+        )
+        parser.add_argument(
+            "--lookback-hours",
+            type=float,
+            default=24,
+            help="只檢查最後心跳在這段時間內的裝置（更早掉線的早已記過）",
+        )
 
     def handle(self, *args, **options):
-        window = getattr(settings, "DEVICE_ONLINE_WINDOW_SECONDS", 60)
-        threshold = timezone.now() - timedelta(seconds=window)
-
-        devices = Device.objects.all()
-        offline_count = 0
-
-        for device in devices:
-            if not device.last_ping or device.last_ping < threshold:
-                # 查 MongoDB 最後一筆紀錄
-                last_log = (
-                    device_ping_logs.find({"device_id": device.serial_number})
-                    .sort("ping_at", -1)
-                    .limit(1)
-                )
-                last_log = list(last_log)
-                if last_log and last_log[0].get("status") == "offline":
-                    continue  # 已經有 offline 紀錄，就不要再補
-
-                # 補一筆 offline 紀錄
-                device_ping_logs.insert_one(
-                    {
-                        "device_id": device.serial_number,
-                        "ping_at": timezone.now().utcnow(),  # 紀錄掉線時間
-                        "status": "offline",
-                    }
-                )
-                offline_count += 1
-
-        self.stdout.write(self.style.SUCCESS(f"補了 {offline_count} 筆 offline 紀錄"))
+        lookback = timedelta(hours=options["lookback_hours"])
+        if not options["loop"]:
+            self._sweep_once(lookback)
+            return
+        try:
+            while True:
+                self._sweep_once(lookback)
+                time.sleep(max(1.0, options["interval"]))
+        except KeyboardInterrupt:
+            pass
+
+    def _sweep_once(self, lookback):
+        result = sweep_offline(lookback=lookback)
+        self.stdout.write(
+            self.style.SUCCESS(
+                f"補了 {result['offline']} 筆 offline 紀錄，"
+                f"通知 {result['notified']} 位使用者離線"
+            )
+        )
+
+
+def sweep_offline(now=None, lookback=timedelta(hours=24)) -> dict:
+    """
+    一次掃完所有剛掉線的裝置：
+      1. 一條 SQL 找出 last_ping 落在 [now - lookback, now - window) 的裝置
+      2. 一次 $group 取得它們在 Mongo 的最新狀態，已是 offline 的略過
+      3. 一次 insert_many 補 offline 紀錄
+      4. 名下已沒有任何在線裝置的使用者 → notify_user_offline
+    """
+    now = now or timezone.now()
+    window = getattr(settings, "DEVICE_ONLINE_WINDOW_SECONDS", 60)
+    threshold = now - timedelta(seconds=window)
+
+    stale = list(
+        Device.objects.filter(
+            last_ping__lt=threshold, last_ping__gte=now - lookback
+        ).only("id", "serial_number", "user_id", "last_ping")
+    )
+    if not stale:
+        return {"offline": 0, "notified": 0}
+
+    latest = _latest_status(stale)
+    dropped = [d for d in stale if latest.get(d.pk) != "offline"]
+    if not dropped:
+        return {"offline": 0, "notified": 0}
+
+    ping_at = datetime.now(dt_timezone.utc).replace(tzinfo=None)  # 與 ping 相同用 naive UTC
+    device_ping_logs.insert_many(
+        [
+            {
+                "device_id": str(d.pk),
+                "ping_at": ping_at,
+                "status": "offline",
+                "last_ping": d.last_ping,
+            }
+            for d in dropped
+        ],
+        ordered=False,
+    )
+
+    # 名下還有其他在線裝置的使用者不算離線
+    owner_ids = {d.user_id for d in dropped if d.user_id}
+    still_online = set(
+        Device.objects.filter(user_id__in=owner_ids, last_ping__gte=threshold)
+        .values_list("user_id", flat=True)
+        .distinct()
+    )
+    users = get_user_model().objects.filter(pk__in=owner_ids - still_online)
+    notified = 0
+    for user in users:
+        notify_user_offline(user=user)
+        notified += 1
+
+    return {"offline": len(dropped), "notified": notified}
+
+
+def _latest_status(devices) -> dict:
+    """{device.pk: 最新一筆紀錄的 status}；舊版 offline 紀錄以序號當 device_id，一併納入"""
+    key_to_pk = {}
+    for d in devices:
+        key_to_pk[str(d.pk)] = d.pk
+        key_to_pk[d.serial_number] = d.pk
+
+    rows = device_ping_logs.aggregate(
+        [
+            {"$match": {"device_id": {"$in": list(key_to_pk)}}},
+            {"$sort": {"device_id": 1, "ping_at": -1}},
+            {
+                "$group": {
+                    "_id": "$device_id",
+                    "status": {"$first": "$status"},
+                    "ping_at": {"$first": "$ping_at"},
+                }
+            },
+        ]
+    )
+
+    latest = {}
+    for row in rows:
+        pk = key_to_pk.get(row["_id"])
+        if pk is None:
+            continue
+        prev = latest.get(pk)
+        if prev is None or (row.get("ping_at") or datetime.min) > prev[0]:
+            latest[pk] = (row.get("ping_at") or datetime.min, row.get("status"))
+    return {pk: status for pk, (_, status) in latest.items()}
@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand
+
+from HomePiWeb.mongo_indexes import collection_report, ensure_indexes
+
+
+def _human(n) -> str:
+    n = float(n or 0)
+    for unit in ("B", "KB", "MB", "GB"):
+        if n < 1024:
+            return f"{n:.1f}{unit}"
+        n /= 1024
+    return f"{n:.1f}TB"
+
+
+class Command(BaseCommand):
+    help = (
+        "確保 MongoDB 索引（device_ping_logs 複合索引 + TTL、彙總集合索引），可重複執行；"
+        "附帶各集合大小與索引使用次數報表"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--report-only", action="store_true", help="只印報表，不動索引"
+        )
+
+    def handle(self, *args, **opts):
+        if not opts["report_only"]:
+            for line in ensure_indexes():
+                self.stdout.write(self.style.SUCCESS(line))
+            self.stdout.write("")
+
+        for item in collection_report():
+            self.stdout.write(
+                f"{item['collection']}: {item['count']} 筆，"
+                f"資料 {_human(item['size'])} / 儲存 {_human(item['storage'])} / "
+                f"索引 {_human(item.get('index_size'))}"
+            )
+            if item.get("error"):
+                self.stdout.write(
+                    self.style.WARNING(f"  無法取得統計：{item['error']}")
+                )
+                continue
+            for idx in item.get("indexes", []):
+                self.stdout.write(
+                    f"  - {idx['name']}: 使用 {idx['ops']} 次（自 {idx['since']}）"
+                )
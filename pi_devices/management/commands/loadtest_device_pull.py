@@ -0,0 +1,122 @@
+import asyncio
+import json
+import statistics
+import time
+from urllib.parse import urlsplit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from pi_devices.models import Device
+
+
+class Command(BaseCommand):
+    help = (
+        "對 device_pull 同時發出 N 條長輪詢，估算伺服器可同時掛住的連線數。\n"
+        "比較方式（同一台機器、同一個 DB）：\n"
+        "  之前：gunicorn HomePiWeb.wsgi -w 4 --threads 8 -b :8800\n"
+        "  之後：uvicorn HomePiWeb.asgi:application --port 8800\n"
+        "  再各跑一次：python manage.py loadtest_device_pull -n 1000 --max-wait 10"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="http://127.0.0.1:8800")
+        parser.add_argument("--path", default="/api/device/pull/")
+        parser.add_argument("-n", "--concurrency", type=int, default=200)
+        parser.add_argument("--max-wait", type=int, default=10)
+        parser.add_argument(
+            "--serial", help="測試用裝置序號；不給就暫時建立一台，跑完刪除"
+        )
+        parser.add_argument("--token")
+
+    def handle(self, *args, **opts):
+        _raise_nofile_limit()
+
+        temp_device = None
+        serial, token = opts["serial"], opts["token"]
+        if not serial:
+            temp_device = Device.objects.create(display_name="loadtest")
+            serial, token = temp_device.serial_number, temp_device.token
+        elif not token:
+            raise CommandError("--serial 需搭配 --token")
+
+        try:
+            results, elapsed = asyncio.run(
+                _run(
+                    opts["url"],
+                    opts["path"],
+                    opts["concurrency"],
+                    opts["max_wait"],
+                    serial,
+                    token,
+                )
+            )
+        finally:
+            if temp_device is not None:
+                temp_device.delete()
+
+        self._report(results, elapsed, opts["concurrency"], opts["max_wait"])
+
+    def _report(self, results, elapsed, n, max_wait):
+        ok = [lat for status, lat in results if status in (200, 204)]
+        errors = len(results) - len(ok)
+        self.stdout.write(f"長輪詢數      : {n}（max_wait={max_wait}s）")
+        self.stdout.write(f"總耗時        : {elapsed:.2f}s")
+        self.stdout.write(f"成功 / 失敗   : {len(ok)} / {errors}")
+        if ok:
+            ok.sort()
+            p95 = ok[min(len(ok) - 1, int(len(ok) * 0.95))]
+            self.stdout.write(
+                f"延遲 p50/p95/max: {statistics.median(ok):.2f}s / {p95:.2f}s / {ok[-1]:.2f}s"
+            )
+        # 全部同時被掛住時 elapsed ≈ max_wait；被 worker 數卡住時 elapsed ≈ ceil(n/k) * max_wait
+        capacity = min(n, n * max_wait / elapsed) if elapsed > 0 else 0
+        self.stdout.write(
+            self.style.SUCCESS(f"估計可同時掛住的長輪詢：約 {capacity:.0f} 條")
+        )
+
+
+async def _run(url, path, n, max_wait, serial, token):
+    parts = urlsplit(url)
+    host = parts.hostname or "127.0.0.1"
+    port = parts.port or 80
+    body = json.dumps(
+        {"serial_number": serial, "token": token, "max_wait": max_wait}
+    ).encode("utf-8")
+    request = (
+        f"POST {path} HTTP/1.1\r\n"
+        f"Host: {host}:{port}\r\n"
+        "Content-Type: application/json\r\n"
+        f"Content-Length: {len(body)}\r\n"
+        "Connection: close\r\n\r\n"
+    ).encode("ascii") + body
+
+    async def one():
+        t0 = time.monotonic()
+        try:
+            reader, writer = await asyncio.open_connection(host, port)
+            writer.write(request)
+            await writer.drain()
+            status_line = await asyncio.wait_for(
+                reader.readline(), timeout=max_wait * 10 + 30
+            )
+            await reader.read()
+            writer.close()
+            status = int(status_line.split()[1])
+        except Exception:
+            status = 0
+        return status, time.monotonic() - t0
+
+    t0 = time.monotonic()
+    results = await asyncio.gather(*(one() for _ in range(n)))
+    return results, time.monotonic() - t0
+
+
+def _raise_nofile_limit():
+    # 上千條連線會撞到預設 1024 個 fd
+    try:
+        import resource
+
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except Exception:
+        pass
@@ -0,0 +1,42 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from pi_devices.models import DeviceCommand
+
+
+class Command(BaseCommand):
+    help = (
+        "把逾期未被取走的 pending 指令標成 expired（device_pull 不再每次順手做）。\n"
+        "可交給 cron 每分鐘跑一次，或用 --loop 常駐。"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--loop", action="store_true", help="常駐，定期執行")
+        parser.add_argument(
+            "--interval", type=float, default=10, help="--loop 時的間隔秒數"
+        )
+
+    def handle(self, *args, **opts):
+        if not opts["loop"]:
+            self._reap_once()
+            return
+        try:
+            while True:
+                self._reap_once()
+                time.sleep(max(1.0, opts["interval"]))
+        except KeyboardInterrupt:
+            pass
+
+    def _reap_once(self):
+        n = reap_expired()
+        if n:
+            self.stdout.write(self.style.SUCCESS(f"標記 {n} 筆過期指令"))
+
+
+def reap_expired() -> int:
+    # 走 devcmd_pending_idx 的部分索引，只碰 pending 列
+    return DeviceCommand.objects.filter(
+        status="pending", expires_at__lte=timezone.now()
+    ).update(status="expired")
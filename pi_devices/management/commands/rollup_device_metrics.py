@@ -0,0 +1,47 @@
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from pi_devices.utils.metrics_rollup import run_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        "把 device_ping_logs 增量彙總成 1m / 1h / 1d 指標（min/max/avg/count、上線比例）。\n"
+        "可交給 cron 每分鐘跑一次，或用 --loop 常駐。"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--loop", action="store_true", help="常駐，定期執行")
+        parser.add_argument(
+            "--interval", type=float, default=60, help="--loop 時的間隔秒數"
+        )
+        parser.add_argument(
+            "--backfill-hours",
+            type=float,
+            default=24,
+            help="第一次執行（尚無進度紀錄）時往回補幾小時",
+        )
+
+    def handle(self, *args, **opts):
+        backfill = timedelta(hours=opts["backfill_hours"])
+        if not opts["loop"]:
+            self._run_once(backfill)
+            return
+        try:
+            while True:
+                self._run_once(backfill)
+                time.sleep(max(5.0, opts["interval"]))
+        except KeyboardInterrupt:
+            pass
+
+    def _run_once(self, backfill):
+        t0 = time.monotonic()
+        done = run_rollups(backfill=backfill)
+        spans = ", ".join(
+            f"{name} 從 {start:%Y-%m-%d %H:%M}" for name, (start, _) in done.items()
+        )
+        self.stdout.write(
+            self.style.SUCCESS(f"彙總完成（{time.monotonic() - t0:.1f}s）：{spans}")
+        )
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:17
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pi_devices', '0018_add_locker_capability'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='devicecommand',
+            name='status',
+            field=models.CharField(choices=[('pending', 'pending'), ('taken', 'taken'), ('done', 'done'), ('failed', 'failed'), ('expired', 'expired'), ('superseded', 'superseded')], db_index=True, default='pending', max_length=20),
+        ),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:18
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pi_devices', '0019_devicecommand_superseded'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='devicecommand',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['device', 'created_at'], name='devcmd_pending_idx'),
+        ),
+    ]
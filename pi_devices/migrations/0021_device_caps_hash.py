@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-17 02:24
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('pi_devices', '0020_devicecommand_pending_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='device',
+            name='caps_hash',
+            field=models.CharField(blank=True, default='', help_text='最近一次同步的能力清單雜湊', max_length=64),
+        ),
+    ]
@@ -1,11 +1,13 @@
 from django.conf import settings
 from django.db import models
+from django.db.models import Q
 from django.core.validators import RegexValidator
 from django.utils import timezone
 import uuid, secrets, string
 from datetime import timedelta
 from django.urls import reverse, NoReverseMatch
 from django.utils.text import slugify
+from .utils import presence
 
 
 def _make_unique_slug(instance, base, max_len=50):
@@ -79,13 +81,20 @@ class Device(models.Model):
         max_length=100, blank=True, help_text="自訂裝置顯示名稱；若留空則顯示序號"
     )
 
+    caps_hash = models.CharField(
+        max_length=64, blank=True, default="", help_text="最近一次同步的能力清單雜湊"
+    )
+
     is_streaming = models.BooleanField(default=False)
     last_hls_url = models.URLField(blank=True, default="")
 
     def is_online(self, window_seconds: int = 60) -> bool:
-        if not self.last_ping:
-            return False
-        return self.last_ping >= timezone.now() - timedelta(seconds=window_seconds)
+        threshold = timezone.now() - timedelta(seconds=window_seconds)
+        # 先問 presence 的最後心跳（記憶體，心跳可能還在緩衝中尚未寫回 last_ping）
+        seen = presence.device_last_seen(self.pk) if self.pk else None
+        if seen is not None and seen >= threshold.timestamp():
+            return True
+        return bool(self.last_ping and self.last_ping >= threshold)
 
     def name(self) -> str:
         return self.display_name or self.serial_number
@@ -120,6 +129,7 @@ class DeviceCommand(models.Model):
         ("done", "done"),
         ("failed", "failed"),
         ("expired", "expired"),
+        ("superseded", "superseded"),  # 被較新的同能力指令合併掉
     ]
 
     device = models.ForeignKey(
@@ -145,6 +155,12 @@ class DeviceCommand(models.Model):
             models.Index(fields=["device", "status"]),
             models.Index(fields=["req_id"]),
             models.Index(fields=["device", "created_at"]),  # 取最舊 pending 會快很多
+            # device_pull 只掃 pending；部分索引不含已完成的大量歷史列
+            models.Index(
+                fields=["device", "created_at"],
+                condition=Q(status="pending"),
+                name="devcmd_pending_idx",
+            ),
         ]
         constraints = [
             models.UniqueConstraint(
@@ -36,6 +36,9 @@ urlpatterns = [
     path("api/device/ping/", api_views.device_ping, name="device_ping"),
     path("api/device/pull/", api_views.device_pull, name="device_pull_api"),
     path("api/device/ack/", api_views.device_ack, name="device_ack_api"),
+    path(
+        "api/device/ack_batch/", api_views.device_ack_batch, name="device_ack_batch"
+    ),
     # 面板狀態連動
     path(
         "api/device/<int:device_id>/status/", api_views.api_device_status, name="api_device_status"
@@ -43,27 +46,35 @@ urlpatterns = [
     path(
         "api/cap/<int:cap_id>/status/", api_views.api_cap_status, name="api_cap_status"
     ),
+    path("api/caps/status/", api_views.api_caps_status, name="api_caps_status"),
     # 若你有既有 agent 用到無斜線版本，保留兼容
     path("device_pull/", api_views.device_pull, name="device_pull"),
     # path("device_pull", api_views.device_pull),
     path("device_ack/", api_views.device_ack, name="device_ack"),
     # Camera 控制/查詢
-    path(
-        "devices/<str:serial>/camera/<str:action>/",
-        api_views.camera_action,
-        name="camera_action",
-    ),
+    # status 要放在 <action> 前面，不然會被當成 action（只收 POST）
     path(
         "devices/<str:serial>/camera/status/",
         api_views.camera_status,
         name="camera_status",
     ),
+    path(
+        "devices/<str:serial>/camera/<str:action>/",
+        api_views.camera_action,
+        name="camera_action",
+    ),
     # 直播新視窗頁
     path(
         "live/<int:device_id>/<int:cap_id>/",
         capability_views.live_player,
         name="cap_live_player",
     ),
+    # 直播頁的播放來源（區網直連簽章網址 / hls_proxy）
+    path(
+        "live/<int:device_id>/<int:cap_id>/source/",
+        capability_views.live_source,
+        name="cap_live_source",
+    ),
     path("api/device/schedules/", api_views.device_schedules, name="device_schedules"),
     path(
         "api/device/schedule_ack/",
@@ -0,0 +1,99 @@
+# pi_devices/utils/command_coalesce.py
+# -*- coding: utf-8 -*-
+"""
+指令合併（_queue_command 入列前呼叫）
+
+使用者狂按開關時，佇列裡同一個能力（payload.slug）還沒被 agent 取走的指令
+會依 settings.DEVICE_COMMAND_COALESCE 的規則合併：
+- set 指令（on/off、lock/unlock、start/stop）：新的一筆取代同能力所有 pending
+- toggle 遇到 pending 的 toggle：兩筆互相抵銷（新的一筆直接記成 superseded）
+- toggle 遇到 pending 的 set：改寫成該 set 的反向指令（on + toggle → off）
+被取代的舊指令標成 status="superseded"，不會再被 device_pull 取走。
+"""
+from django.conf import settings
+from django.utils import timezone
+
+DEFAULT_RULES = {
+    "light": {"set": ["light_on", "light_off"], "toggle": "light_toggle"},
+    "locker": {"set": ["locker_lock", "locker_unlock"], "toggle": "locker_toggle"},
+    "camera": {"set": ["camera_start", "camera_stop"]},
+}
+
+
+def _rules() -> dict:
+    return getattr(settings, "DEVICE_COMMAND_COALESCE", DEFAULT_RULES) or {}
+
+
+def _rule_for(command: str) -> dict | None:
+    for rule in _rules().values():
+        if command in (rule.get("set") or ()) or command == rule.get("toggle"):
+            return rule
+    return None
+
+
+def _key(payload: dict | None) -> str:
+    payload = payload or {}
+    return str(payload.get("slug") or payload.get("target") or "")
+
+
+def _inverse(rule: dict, command: str) -> str | None:
+    pair = list(rule.get("set") or ())
+    if len(pair) != 2 or command not in pair:
+        return None
+    return pair[1] if command == pair[0] else pair[0]
+
+
+def coalesce(device, command: str, payload: dict | None) -> tuple[str, str]:
+    """
+    依規則處理同能力的 pending 指令（需在交易內、鎖住 Device 列後呼叫，見 _queue_command）。
+    回傳 (實際要入列的指令, 狀態)；狀態為 "pending" 或 "superseded"。
+    """
+    from ..models import DeviceCommand
+
+    rule = _rule_for(command)
+    if rule is None:
+        return command, "pending"
+
+    family = set(rule.get("set") or ())
+    if rule.get("toggle"):
+        family.add(rule["toggle"])
+
+    key = _key(payload)
+    pending = [
+        c
+        for c in DeviceCommand.objects.select_for_update()
+        .filter(
+            device=device,
+            status="pending",
+            command__in=family,
+            expires_at__gt=timezone.now(),
+        )
+        .order_by("created_at")
+        .only("id", "command", "payload")
+        if _key(c.payload) == key
+    ]
+    if not pending:
+        return command, "pending"
+
+    last = pending[-1]
+    if command == rule.get("toggle"):
+        if last.command == command:
+            # 兩次 toggle 互相抵銷
+            _supersede([last.pk])
+            return command, "superseded"
+        inverse = _inverse(rule, last.command)
+        if inverse is None:
+            return command, "pending"
+        _supersede([c.pk for c in pending])
+        return inverse, "pending"
+
+    _supersede([c.pk for c in pending])
+    return command, "pending"
+
+
+def _supersede(ids: list[int]) -> None:
+    from ..models import DeviceCommand
+
+    DeviceCommand.objects.filter(pk__in=ids, status="pending").update(
+        status="superseded", done_at=timezone.now()
+    )
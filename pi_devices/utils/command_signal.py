@@ -0,0 +1,249 @@
+# pi_devices/utils/command_signal.py
+# -*- coding: utf-8 -*-
+"""
+指令佇列的喚醒機制（取代 device_pull 每 200ms 查一次 DB 的輪詢）
+
+流程：
+- device_pull 先記下 version(device_id)，查不到指令就 wait(device_id, since, timeout)
+  （ASGI 版 views/api_async.py 用 wait_async，不佔執行緒）
+- _queue_command 在交易 commit 後呼叫 notify(device_id)，等待中的長輪詢立即醒來再查一次
+
+後端（settings.DEVICE_COMMAND_SIGNAL_BACKEND）：
+- "local"    ：同一行程內的 Condition；runserver / 單一 worker 足夠（預設）
+- "postgres" ：PostgreSQL LISTEN/NOTIFY；多個 worker / 多台機器時用
+- 也可填 dotted path 指向自訂類別（需提供 version / notify / wait / wait_async）
+"""
+import asyncio
+import logging
+import select
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.utils.module_loading import import_string
+
+logger = logging.getLogger(__name__)
+
+BACKEND_ALIASES = {
+    "local": "pi_devices.utils.command_signal.LocalSignalBackend",
+    "postgres": "pi_devices.utils.command_signal.PostgresSignalBackend",
+}
+
+
+class LocalSignalBackend:
+    """
+    行程內喚醒：每台裝置一個版本號 + 一個 Condition（共用同一把鎖）。
+    等待端比對版本號，避免「查完 DB 到開始等待之間」漏掉通知。
+    Condition 只在有人等時存在，最後一個等待者離開就丟掉（裝置多也不會一直長）。
+    async 等待者登記成 (loop, future)，由 _bump 以 call_soon_threadsafe 喚醒。
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versions: dict[int, int] = {}
+        self._conds: dict[int, threading.Condition] = {}
+        self._waiting: dict[int, int] = {}  # 裝置 -> 同步等待者數
+        self._async_waiters: dict[int, set] = {}
+
+
+    def version(self, device_id: int) -> int:
+        with self._lock:
+            return self._versions.get(device_id, 0)
+
+    def notify(self, device_id: int) -> None:
+        self._bump(device_id)
+
+    def _bump(self, device_id: int) -> None:
+        with self._lock:
+            self._versions[device_id] = self._versions.get(device_id, 0) + 1
+            cond = self._conds.get(device_id)
+            if cond is not None:
+                cond.notify_all()
+            waiters = self._async_waiters.pop(device_id, ())
+        for loop, fut in waiters:
+            try:
+                loop.call_soon_threadsafe(_resolve, fut)
+            except RuntimeError:
+                pass  # event loop 已關閉
+
+    def wait(self, device_id: int, since: int, timeout: float) -> bool:
+        """等到版本號不同於 since 或逾時；回傳是否有新通知"""
+        if timeout <= 0:
+            return self.version(device_id) != since
+        with self._lock:
+            cond = self._conds.get(device_id)
+            if cond is None:
+                cond = self._conds[device_id] = threading.Condition(self._lock)
+            self._waiting[device_id] = self._waiting.get(device_id, 0) + 1
+            try:
+                return cond.wait_for(
+                    lambda: self._versions.get(device_id, 0) != since, timeout=timeout
+                )
+            finally:
+                left = self._waiting[device_id] - 1
+                if left:
+                    self._waiting[device_id] = left
+                else:
+                    del self._waiting[device_id]
+                    del self._conds[device_id]
+
+    async def wait_async(self, device_id: int, since: int, timeout: float) -> bool:
+        """wait 的 async 版：在 event loop 上等待，不佔用執行緒"""
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        entry = (loop, fut)
+        with self._lock:
+            if self._versions.get(device_id, 0) != since:
+                return True
+            if timeout <= 0:
+                return False
+            self._async_waiters.setdefault(device_id, set()).add(entry)
+        try:
+            await asyncio.wait_for(fut, timeout=timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                waiters = self._async_waiters.get(device_id)
+                if waiters is not None:
+                    waiters.discard(entry)
+                    if not waiters:
+                        del self._async_waiters[device_id]
+
+
+def _resolve(fut) -> None:
+    if not fut.done():
+        fut.set_result(True)
+
+
+class PostgresSignalBackend(LocalSignalBackend):
+    """
+    跨行程喚醒：notify 走 pg_notify，背景執行緒 LISTEN 後轉成本地的 _bump。
+    listener 使用獨立連線，不佔 Django 連線；psycopg2（environment.yml 已列）
+    與 psycopg 3 都支援，兩者收通知的 API 不同，由 _drain 分開處理。
+    """
+
+    channel = "homepi_device_cmd"
+
+    def __init__(self):
+        from django.db import connections
+
+        if connections["default"].vendor != "postgresql":
+            raise ImproperlyConfigured(
+                "DEVICE_COMMAND_SIGNAL_BACKEND='postgres' 需要 PostgreSQL 資料庫"
+            )
+        super().__init__()
+        self._listener: threading.Thread | None = None
+        self._listener_lock = threading.Lock()
+
+    def notify(self, device_id: int) -> None:
+        from django.db import connection
+
+        try:
+            with connection.cursor() as cur:
+                cur.execute("SELECT pg_notify(%s, %s)", [self.channel, str(device_id)])
+        except Exception as e:
+            # 發不出去就至少喚醒本行程，其他行程靠 DEVICE_COMMAND_RECHECK_SECONDS 保底
+            logger.warning(f"pg_notify failed: {e}")
+            self._bump(device_id)
+
+    def wait(self, device_id: int, since: int, timeout: float) -> bool:
+        self._ensure_listener()
+        return super().wait(device_id, since, timeout)
+
+    async def wait_async(self, device_id: int, since: int, timeout: float) -> bool:
+        self._ensure_listener()
+        return await super().wait_async(device_id, since, timeout)
+
+    def _ensure_listener(self) -> None:
+        if self._listener is not None:
+            return
+        with self._listener_lock:
+            if self._listener is None:
+                self._listener = threading.Thread(
+                    target=self._listen_forever, name="device-cmd-listen", daemon=True
+                )
+                self._listener.start()
+
+    def _connect(self):
+        from django.db import connections
+
+        wrapper = connections["default"]
+        conn = wrapper.get_new_connection(wrapper.get_connection_params())
+        conn.autocommit = True
+        return conn
+
+    @staticmethod
+    def _drain(conn, timeout: float) -> list[str]:
+        """等最多 timeout 秒，回傳這段時間收到的通知 payload"""
+        if hasattr(conn, "poll"):
+            # psycopg2：select 等 socket 可讀，poll() 後從 conn.notifies 取出
+            if select.select([conn], [], [], timeout) == ([], [], []):
+                return []
+            conn.poll()
+            payloads = []
+            while conn.notifies:
+                payloads.append(conn.notifies.pop(0).payload)
+            return payloads
+        # psycopg 3：notifies() 是 generator，3.2 起可給 timeout
+        try:
+            gen = conn.notifies(timeout=timeout)
+        except TypeError:
+            gen = conn.notifies()  # 3.0 / 3.1：一直等到有通知為止（daemon 執行緒，可接受）
+            return [next(gen).payload]
+        return [n.payload for n in gen]
+
+    def _listen_forever(self) -> None:
+        while True:
+            conn = None
+            try:
+                conn = self._connect()
+                with conn.cursor() as cur:
+                    cur.execute(f"LISTEN {self.channel}")
+                while True:
+                    for payload in self._drain(conn, 5.0):
+                        try:
+                            self._bump(int(payload))
+                        except (TypeError, ValueError):
+                            continue
+            except Exception as e:
+                logger.warning(f"device command listener error: {e}")
+                time.sleep(1.0)
+            finally:
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        with _backend_lock:
+            if _backend is None:
+                name = getattr(settings, "DEVICE_COMMAND_SIGNAL_BACKEND", "local")
+                _backend = import_string(BACKEND_ALIASES.get(name, name))()
+    return _backend
+
+
+def version(device_id: int) -> int:
+    return get_backend().version(device_id)
+
+
+def notify(device_id: int) -> None:
+    get_backend().notify(device_id)
+
+
+def wait(device_id: int, since: int, timeout: float) -> bool:
+    return get_backend().wait(device_id, since, timeout)
+
+
+async def wait_async(device_id: int, since: int, timeout: float) -> bool:
+    return await get_backend().wait_async(device_id, since, timeout)
@@ -0,0 +1,237 @@
+# pi_devices/utils/device_auth.py
+# -*- coding: utf-8 -*-
+"""
+agent 端點的裝置驗證快取（serial_number + token）
+
+每個 Pi 每次 ping / pull / ack 都要驗證一次，原本都是 Device 表依序號查一筆只為了比 token。
+這裡把 {serial: (id, token 雜湊, user_id, ip_address, caps_hash)} 放在本行程的 LRU：
+- 上限 DEVICE_AUTH_CACHE_SIZE 筆，超過踢掉最久沒用的
+- 每筆最多活 DEVICE_AUTH_CACHE_TTL 秒
+- Device 存檔 / 刪除（綁定、解除綁定、admin 編輯、ping 寫 IP/caps_hash）由 signals
+  在共用 cache（DEVICE_AUTH_VERSION_CACHE）換掉該序號的版本號；
+  使用者刪除（SET_NULL 不發 Device 的 signal）則換掉全域版本號
+- 每次驗證用一次 get_many 讀這兩個版本號，和 LRU 裡記的不同就重查 DB，
+  所以其他 worker 解除綁定 / 換 token 後立刻生效，不會拿舊的 user_id / caps_hash
+  （多 worker 時 cache 必須是共用的，見 settings.CACHES）
+- 只存 token 的 sha256，比對用 hmac.compare_digest
+- 查無此序號不快取，避免亂打的序號把 LRU 擠爆
+命中時回傳的 Device 是 from_db 建的 deferred 實例，與原本 .only() 查出來的用法相同。
+DEVICE_AUTH_CACHE_SIZE = 0 時關閉快取，每次都查 DB。
+"""
+import hashlib
+import hmac
+import threading
+import time
+from collections import OrderedDict, namedtuple
+
+from django.conf import settings
+
+VERSION_PREFIX = "homepi:device_auth:v:"
+ALL_KEY = VERSION_PREFIX + "*"
+
+AuthEntry = namedtuple(
+    "AuthEntry", "id serial_number token_digest user_id ip_address caps_hash"
+)
+
+FIELDS = ("id", "serial_number", "token", "user_id", "ip_address", "caps_hash")
+
+# authenticate 的結果
+OK = "ok"
+NOT_FOUND = "not_found"
+UNAUTHORIZED = "unauthorized"
+
+
+def _digest(token) -> bytes:
+    return hashlib.sha256(str(token or "").encode("utf-8")).digest()
+
+
+class DeviceAuthCache:
+    def __init__(self, max_size: int = 10000, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # serial -> (到期時間, 版本號, entry)
+        self._data: OrderedDict[str, tuple] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, serial: str, version=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(serial)
+            if item is None or item[0] <= now or item[1] != version:
+                if item is not None:
+                    del self._data[serial]
+                self.misses += 1
+                return None
+            self._data.move_to_end(serial)
+            self.hits += 1
+            return item[2]
+
+    def put(self, entry: AuthEntry, version=None) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._data[entry.serial_number] = (
+                time.monotonic() + self.ttl,
+                version,
+                entry,
+            )
+            self._data.move_to_end(entry.serial_number)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def invalidate(self, serial: str) -> None:
+        with self._lock:
+            self._data.pop(serial, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+_cache = DeviceAuthCache(
+    max_size=int(getattr(settings, "DEVICE_AUTH_CACHE_SIZE", 10000)),
+    ttl=float(getattr(settings, "DEVICE_AUTH_CACHE_TTL", 300)),
+)
+
+
+def _versions():
+    from django.core.cache import caches
+
+    return caches[getattr(settings, "DEVICE_AUTH_VERSION_CACHE", "default")]
+
+
+def _version_keys(serial: str) -> list:
+    return [VERSION_PREFIX + serial, ALL_KEY]
+
+
+def _version_of(found: dict, serial: str):
+    return (found.get(ALL_KEY), found.get(VERSION_PREFIX + serial))
+
+
+def _version(serial: str):
+    return _version_of(_versions().get_many(_version_keys(serial)), serial)
+
+
+async def _aversion(serial: str):
+    found = await _versions().aget_many(_version_keys(serial))
+    return _version_of(found, serial)
+
+
+def _bump(key: str) -> None:
+    # 版本號被 cache 淘汰也沒關係：和 LRU 記的不同就只是多查一次 DB
+    _versions().set(key, time.time_ns(), timeout=None)
+
+
+def _entry(row: dict) -> AuthEntry:
+    return AuthEntry(
+        id=row["id"],
+        serial_number=row["serial_number"],
+        token_digest=_digest(row["token"]),
+        user_id=row["user_id"],
+        ip_address=row["ip_address"],
+        caps_hash=row["caps_hash"],
+    )
+
+
+def _check(entry, token):
+    """回傳 (device, 結果)"""
+    if entry is None:
+        return None, NOT_FOUND
+    if not hmac.compare_digest(entry.token_digest, _digest(token)):
+        return None, UNAUTHORIZED
+    from ..models import Device
+
+    device = Device.from_db(
+        "default",
+        ["id", "serial_number", "user_id", "ip_address", "caps_hash"],
+        [
+            entry.id,
+            entry.serial_number,
+            entry.user_id,
+            entry.ip_address,
+            entry.caps_hash,
+        ],
+    )
+    return device, OK
+
+
+def authenticate(serial: str, token: str):
+    """驗證 serial/token，回傳 (device, OK | NOT_FOUND | UNAUTHORIZED)"""
+    # 版本號要在查 DB 之前讀：查詢途中被別人改掉時，記下的是舊版本號，下次就會重查
+    version = _version(serial)
+    entry = _cache.get(serial, version)
+    if entry is None:
+        from ..models import Device
+
+        row = Device.objects.filter(serial_number=serial).values(*FIELDS).first()
+        if row is not None:
+            entry = _entry(row)
+            _cache.put(entry, version)
+    return _check(entry, token)
+
+
+async def aauthenticate(serial: str, token: str):
+    """authenticate 的 async 版（命中快取時不碰 DB，只讀一次 cache 的版本號）"""
+    version = await _aversion(serial)
+    entry = _cache.get(serial, version)
+    if entry is None:
+        from ..models import Device
+
+        rows = Device.objects.filter(serial_number=serial).values(*FIELDS)
+        row = await rows.afirst()
+        if row is not None:
+            entry = _entry(row)
+            _cache.put(entry, version)
+    return _check(entry, token)
+
+
+def invalidate(serial: str) -> None:
+    """本行程直接清掉，其他行程靠版本號"""
+    _cache.invalidate(serial)
+    _bump(VERSION_PREFIX + serial)
+
+
+def clear() -> None:
+    _cache.clear()
+    _bump(ALL_KEY)
+
+
+def stats() -> dict:
+    return {"size": len(_cache), "hits": _cache.hits, "misses": _cache.misses}
+
+
+# ---------- signals（PiDevicesConfig.ready 註冊） ----------
+def _on_device_changed(sender, instance, **kwargs):
+    from django.db import transaction
+
+    serial = instance.serial_number
+    invalidate(serial)
+    # 交易中途被別的請求重新載入舊值時，commit 後再清一次
+    transaction.on_commit(lambda: invalidate(serial))
+
+
+def _on_user_deleted(sender, instance, **kwargs):
+    # 裝置的 user 被 SET_NULL（不會發 Device 的 signal），直接全部重載
+    clear()
+
+
+def connect_signals() -> None:
+    from django.contrib.auth import get_user_model
+    from django.db.models.signals import post_delete, post_save
+
+    from ..models import Device
+
+    post_save.connect(
+        _on_device_changed, sender=Device, dispatch_uid="device_auth_save"
+    )
+    post_delete.connect(
+        _on_device_changed, sender=Device, dispatch_uid="device_auth_delete"
+    )
+    post_delete.connect(
+        _on_user_deleted, sender=get_user_model(), dispatch_uid="device_auth_user"
+    )
@@ -0,0 +1,129 @@
+# pi_devices/utils/heartbeat.py
+# -*- coding: utf-8 -*-
+"""
+心跳寫入緩衝（device_ping 快速路徑用）
+
+原本每 30 秒一次 ping 都對 Device 列 select_for_update + save(last_ping, ip)，
+裝置一多 DB 寫入幾乎全被心跳吃掉。現在：
+- 沒有狀態轉換的 ping 只呼叫 record(device_id, ts)，先記在緩衝
+- 背景執行緒每 DEVICE_HEARTBEAT_FLUSH_SECONDS 秒把緩衝用一次 bulk_update 寫回 last_ping
+- IP 變更 / 離線→上線 / caps 變更 才走原本鎖列的慢路徑（views/api.py::_ping_device）
+
+在線判斷不看這裡：device_ping 每次都會 presence.touch()（utils/presence.py）。
+DEVICE_HEARTBEAT_FLUSH_SECONDS = 0 時不緩衝，record 直接寫 DB（仍不鎖列）。
+行程結束時（atexit）再寫一次；測試跑完時測試資料庫已刪除，這時的緩衝直接丟掉。
+"""
+import atexit
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+
+def _flush_seconds() -> float:
+    return float(getattr(settings, "DEVICE_HEARTBEAT_FLUSH_SECONDS", 5))
+
+
+class HeartbeatBuffer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: dict[int, object] = {}  # device_id -> 尚未寫回的最新心跳
+        self._thread: threading.Thread | None = None
+        self._db_name = None  # 開始緩衝時的資料庫名稱（測試期間是測試資料庫）
+
+    def record(self, device_id: int, ts) -> None:
+        with self._lock:
+            prev = self._pending.get(device_id)
+            if prev is None or ts > prev:
+                self._pending[device_id] = ts
+
+    def flush(self) -> int:
+        """把緩衝寫回 DB，回傳寫入筆數；失敗時放回緩衝等下次"""
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return 0
+        try:
+            self._write(batch)
+        except Exception as e:
+            logger.warning(f"heartbeat flush failed: {e}")
+            with self._lock:
+                for pk, ts in batch.items():
+                    cur = self._pending.get(pk)
+                    if cur is None or ts > cur:
+                        self._pending[pk] = ts
+            return 0
+        return len(batch)
+
+    @staticmethod
+    def _write(batch: dict) -> None:
+        from ..models import Device
+
+        Device.objects.bulk_update(
+            [Device(pk=pk, last_ping=ts) for pk, ts in batch.items()],
+            ["last_ping"],
+            batch_size=500,
+        )
+
+    def flush_at_exit(self) -> int:
+        """
+        atexit 用：資料庫已不是開始緩衝時那一個（測試資料庫已刪、連線換回正式設定）
+        就丟掉緩衝；寫入失敗只記 log，不再放回緩衝。
+        """
+        from django.db import connections
+
+        with self._lock:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return 0
+        if connections["default"].settings_dict.get("NAME") != self._db_name:
+            logger.debug(f"heartbeat: dropped {len(batch)} pings (database changed)")
+            return 0
+        try:
+            self._write(batch)
+        except Exception as e:
+            logger.info(f"heartbeat exit flush skipped ({len(batch)}): {e}")
+            return 0
+        return len(batch)
+
+    def ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is None:
+                from django.db import connections
+
+                self._db_name = connections["default"].settings_dict.get("NAME")
+                self._thread = threading.Thread(
+                    target=self._run, name="device-heartbeat-flush", daemon=True
+                )
+                self._thread.start()
+                atexit.register(self.flush_at_exit)
+
+    def _run(self) -> None:
+        from django.db import close_old_connections
+
+        while True:
+            time.sleep(max(0.5, _flush_seconds()))
+            close_old_connections()
+            self.flush()
+
+
+_buffer = HeartbeatBuffer()
+
+
+def record(device_id: int, ts) -> None:
+    if _flush_seconds() <= 0:
+        from ..models import Device
+
+        Device.objects.filter(pk=device_id).update(last_ping=ts)
+        return
+    _buffer.record(device_id, ts)
+    _buffer.ensure_started()
+
+
+def flush() -> int:
+    return _buffer.flush()
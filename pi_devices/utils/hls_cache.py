@@ -0,0 +1,456 @@
+# pi_devices/utils/hls_cache.py
+# -*- coding: utf-8 -*-
+"""
+hls_proxy 的共用快取：同一台攝影機有 N 個人在看，Pi 的上行只出一份
+
+- 快取 key 是 (序號, 檔名)；segment 內容不會變，存 SEGMENT_TTL 秒
+  （攝影機重啟後檔名會從頭編號，TTL 避免拿到上一輪的舊片段）
+- playlist（.m3u8）會一直更新，只存 PLAYLIST_TTL 秒（預設 0.5）
+- single-flight：同一個 key 同時只會有一個上游請求，其他人等它的結果
+- 容量以 bytes 計（MAX_BYTES），超過就從最久沒用的開始丟；
+  設 DISK_DIR 時 segment 內容寫成檔案（適合大容量），記憶體只留索引；
+  檔案可能在拿到索引後、開檔前被淘汰刪掉，讀內容請用 read_or_fetch() / aread_or_fetch()
+  （檔案不見就當沒命中重抓）
+- 片段整段讀進記憶體後才快取 / 回應（Range 由快取內容切），所以單一片段有硬上限
+  MAX_SEGMENT_BYTES（預設 8 MB，約為 1080p 2 秒片段的數倍）；上游讀取時邊讀邊數，
+  超過就中止並回 502，不會因為一個異常大的檔案把 worker 記憶體吃光
+- stats()：每台裝置的 hits / misses / coalesced（等別人抓的）與 hit_ratio
+- aget_or_fetch()：ASGI 版（api_async.hls_proxy）用，等待時不佔執行緒；
+  與 sync 版共用同一份快取內容與統計
+- prefetch() / aprefetch()：playlist 從上游更新後，背景先抓最新的 PREFETCH_SEGMENTS 段，
+  player 接著要的片段就直接命中；每台裝置同時最多 PREFETCH_SEGMENTS 個預抓
+- LL-HLS：阻塞式重新載入的 playlist 以「檔名?_HLS_msn=..&_HLS_part=..」為 key，
+  等同一個小段的 viewer 共用一次上游請求；預抓改抓最新的小段（EXT-X-PART）
+設定見 settings.HLS_PROXY_CACHE。
+"""
+import asyncio
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    "MAX_BYTES": 64 * 1024 * 1024,
+    "PLAYLIST_TTL": 0.5,
+    "SEGMENT_TTL": 120,
+    "DISK_DIR": None,
+    "WAIT_SECONDS": 20,
+    "PREFETCH_SEGMENTS": 2,
+    "PREFETCH_WORKERS": 4,
+    "MAX_SEGMENT_BYTES": 8 * 1024 * 1024,
+}
+
+
+def _conf(key):
+    return (getattr(settings, "HLS_PROXY_CACHE", None) or {}).get(key, DEFAULTS[key])
+
+
+# LL-HLS 把小段 / 預載提示的 URI 放在屬性裡
+LL_URI_TAGS = ("#EXT-X-PART:", "#EXT-X-PRELOAD-HINT:")
+URI_ATTR = re.compile(r'URI="([^"]+)"')
+
+
+def is_playlist(name: str) -> bool:
+    return name.split("?", 1)[0].endswith(".m3u8")
+
+
+def ttl_for(name: str) -> float:
+    return _conf("PLAYLIST_TTL") if is_playlist(name) else _conf("SEGMENT_TTL")
+
+
+def max_segment_bytes() -> int:
+    """單一片段的硬上限；上游邊讀邊數，超過就中止回 502（不整段讀進記憶體）"""
+    return int(_conf("MAX_SEGMENT_BYTES"))
+
+
+def playlist_segments(body: bytes) -> list[str]:
+    """
+    playlist 內的片段檔名（依出現順序，最新的在最後）。
+    LL-HLS playlist 回傳的是小段（EXT-X-PART 與 PRELOAD-HINT），player 拿的是這些。
+    """
+    names, parts = [], []
+    for line in body.decode("utf-8", "replace").splitlines():
+        t = line.strip()
+        if t.startswith(LL_URI_TAGS):
+            m = URI_ATTR.search(t)
+            if m and m.group(1).endswith(".ts"):
+                parts.append(os.path.basename(m.group(1)))
+        elif t and not t.startswith("#") and t.endswith(".ts"):
+            names.append(os.path.basename(t))
+    return parts or names
+
+
+class UpstreamError(Exception):
+    """上游抓取失敗（不快取）；同一次失敗會傳給所有等待者，各自用 response() 產生回應"""
+
+    def __init__(self, status: int, message: str, headers: dict | None = None):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+        self.headers = headers or {}
+
+    def response(self):
+        from django.http import HttpResponse
+
+        resp = HttpResponse(self.message, status=self.status)
+        for k, v in self.headers.items():
+            resp[k] = v
+        return resp
+
+
+class CachedObject:
+    __slots__ = ("body", "path", "size", "content_type", "headers", "expires_at")
+
+    def __init__(self, body, content_type, headers=None, ttl=None, path=None):
+        self.body = body
+        self.path = path
+        self.size = len(body) if body is not None else os.path.getsize(path)
+        self.content_type = content_type
+        self.headers = headers or {}
+        self.expires_at = time.monotonic() + ttl if ttl else None
+
+    def read(self) -> bytes:
+        """內容；磁碟檔已被淘汰刪掉時丟 FileNotFoundError"""
+        if self.body is not None:
+            return self.body
+        with open(self.path, "rb") as f:
+            return f.read()
+
+
+class _Flight:
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+
+class SegmentCache:
+    def __init__(self, max_bytes: int, disk_dir: str | None = None):
+        self.max_bytes = int(max_bytes)
+        self.disk_dir = str(disk_dir) if disk_dir else None
+        self._lock = threading.Lock()
+        self._items: OrderedDict[tuple, CachedObject] = OrderedDict()
+        self._bytes = 0
+        self._inflight: dict[tuple, _Flight] = {}
+        self._ainflight: dict[tuple, asyncio.Task] = {}
+        self._prefetching: dict[str, int] = {}  # 序號 -> 進行中的預抓數
+        self._tasks: set = set()  # aprefetch 的 task（保留參照避免被回收）
+        self._executor: ThreadPoolExecutor | None = None
+        self._stats: dict[str, dict] = {}
+
+    # ---------- 讀取 ----------
+    def _hit(self, key):
+        # 呼叫端已持有 self._lock
+        obj = self._items.get(key)
+        if obj is not None and (
+            obj.expires_at is None or obj.expires_at > time.monotonic()
+        ):
+            self._items.move_to_end(key)
+            self._bump(key[0], "hits")
+            return obj
+        return None
+
+    def get_or_fetch(
+        self, serial: str, name: str, fetch, ttl=None, wait=None, miss="misses"
+    ):
+        """
+        命中就回傳快取；否則只讓一個請求呼叫 fetch()（回傳 CachedObject），
+        其他同 key 的請求等結果。fetch 丟 UpstreamError 會原樣傳給所有等待者。
+        ttl 預設依副檔名（ttl_for）。
+        """
+        key = (serial.upper(), name)
+        ttl = ttl_for(name) if ttl is None else ttl
+        with self._lock:
+            obj = self._hit(key)
+            if obj is not None:
+                return obj
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._inflight[key] = _Flight()
+                self._bump(key[0], miss)
+            else:
+                self._bump(key[0], "coalesced")
+
+        if not leader:
+            if not flight.done.wait(wait or _conf("WAIT_SECONDS")):
+                raise TimeoutError(f"waiting for {name} timed out")
+            if flight.error is not None:
+                raise flight.error
+            return flight.value
+
+        try:
+            obj = fetch()
+            if ttl:
+                obj.expires_at = time.monotonic() + ttl
+            self._store(key, obj)
+            flight.value = obj
+            return obj
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            flight.done.set()
+
+    async def aget_or_fetch(
+        self, serial: str, name: str, afetch, ttl=None, wait=None, miss="misses"
+    ):
+        """get_or_fetch 的 async 版：afetch 在快取自己的 task 裡跑，大家 await 同一個 task
+
+        領頭的請求被取消（viewer 斷線）不會取消抓取，其他等待者照樣拿到結果。
+        """
+        key = (serial.upper(), name)
+        ttl = ttl_for(name) if ttl is None else ttl
+        with self._lock:
+            obj = self._hit(key)
+            if obj is not None:
+                return obj
+            task = self._ainflight.get(key)
+            leader = task is None
+            if leader:
+                task = asyncio.get_running_loop().create_task(
+                    self._afetch(key, afetch, ttl)
+                )
+                self._ainflight[key] = task
+                # 沒人等時失敗也不要噴 "exception was never retrieved"
+                task.add_done_callback(lambda t: t.cancelled() or t.exception())
+                self._bump(key[0], miss)
+            else:
+                self._bump(key[0], "coalesced")
+
+        if leader:
+            return await asyncio.shield(task)
+        try:
+            return await asyncio.wait_for(
+                asyncio.shield(task), wait or _conf("WAIT_SECONDS")
+            )
+        except asyncio.TimeoutError:
+            raise TimeoutError(f"waiting for {name} timed out")
+
+    async def _afetch(self, key, afetch, ttl) -> CachedObject:
+        try:
+            obj = await afetch()
+            if ttl:
+                obj.expires_at = time.monotonic() + ttl
+            self._store(key, obj)
+            return obj
+        finally:
+            with self._lock:
+                self._ainflight.pop(key, None)
+
+    def _forget(self, key, obj: CachedObject) -> None:
+        """key 仍指向 obj 就拿掉（磁碟檔已不在）；已被換成新的就不動"""
+        with self._lock:
+            if self._items.get(key) is obj:
+                del self._items[key]
+                self._bytes -= obj.size
+
+    def read_or_fetch(self, serial: str, name: str, fetch, **kw):
+        """
+        get_or_fetch 後直接讀出內容，回傳 (CachedObject, bytes)。
+        磁碟檔在開檔前被淘汰（或被外部清掉）就當沒命中重抓一次；
+        重抓的檔又剛好被淘汰時不再排隊，直接用 fetch() 的記憶體內容。
+        """
+        key = (serial.upper(), name)
+        for _ in range(2):
+            obj = self.get_or_fetch(serial, name, fetch, **kw)
+            try:
+                return obj, obj.read()
+            except FileNotFoundError:
+                self._forget(key, obj)
+                logger.debug(f"hls cache {serial}/{name} evicted before read")
+        obj = fetch()
+        return obj, obj.read()
+
+    async def aread_or_fetch(self, serial: str, name: str, afetch, **kw):
+        """read_or_fetch 的 async 版"""
+        key = (serial.upper(), name)
+        for _ in range(2):
+            obj = await self.aget_or_fetch(serial, name, afetch, **kw)
+            try:
+                return obj, obj.read()
+            except FileNotFoundError:
+                self._forget(key, obj)
+                logger.debug(f"hls cache {serial}/{name} evicted before read")
+        obj = await afetch()
+        return obj, obj.read()
+
+    # ---------- 預抓 ----------
+    def _prefetch_targets(self, serial: str, names: list[str]) -> list[str]:
+        """挑出要預抓的片段（最新的幾段、還沒快取也沒人在抓），並佔用該裝置的名額"""
+        serial = serial.upper()
+        limit = int(_conf("PREFETCH_SEGMENTS"))
+        picked = []
+        now = time.monotonic()
+        with self._lock:
+            room = limit - self._prefetching.get(serial, 0)
+            for name in reversed(names[-limit:] if limit > 0 else []):
+                if room <= 0:
+                    break
+                key = (serial, name)
+                obj = self._items.get(key)
+                fresh = obj is not None and (
+                    obj.expires_at is None or obj.expires_at > now
+                )
+                if fresh or key in self._inflight or key in self._ainflight:
+                    continue
+                picked.append(name)
+                room -= 1
+            if picked:
+                self._prefetching[serial] = self._prefetching.get(serial, 0) + len(picked)
+        return picked
+
+    def _prefetch_done(self, serial: str) -> None:
+        serial = serial.upper()
+        with self._lock:
+            left = self._prefetching.get(serial, 0) - 1
+            if left > 0:
+                self._prefetching[serial] = left
+            else:
+                self._prefetching.pop(serial, None)
+
+    def prefetch(self, serial: str, names: list[str], make_fetch) -> int:
+        """背景執行緒預抓；make_fetch(name) 回傳該片段的 fetch()。回傳排入的數量"""
+        picked = self._prefetch_targets(serial, names)
+        if not picked:
+            return 0
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        max_workers=int(_conf("PREFETCH_WORKERS")),
+                        thread_name_prefix="hls-prefetch",
+                    )
+
+        def run(name):
+            try:
+                self.get_or_fetch(serial, name, make_fetch(name), miss="prefetched")
+            except Exception as e:
+                logger.debug(f"hls prefetch {serial}/{name} failed: {e}")
+            finally:
+                self._prefetch_done(serial)
+
+        for name in picked:
+            self._executor.submit(run, name)
+        return len(picked)
+
+    def aprefetch(self, serial: str, names: list[str], make_afetch) -> int:
+        """prefetch 的 async 版：在目前的 event loop 上開 task"""
+        picked = self._prefetch_targets(serial, names)
+
+        async def run(name):
+            try:
+                await self.aget_or_fetch(
+                    serial, name, make_afetch(name), miss="prefetched"
+                )
+            except Exception as e:
+                logger.debug(f"hls prefetch {serial}/{name} failed: {e}")
+            finally:
+                self._prefetch_done(serial)
+
+        for name in picked:
+            task = asyncio.get_running_loop().create_task(run(name))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        return len(picked)
+
+    # ---------- 寫入 / 淘汰 ----------
+    def _store(self, key, obj: CachedObject) -> None:
+        if obj.size > self.max_bytes:
+            return  # 比整個快取還大，不存
+        if self.disk_dir and obj.body is not None and not is_playlist(key[1]):
+            obj = self._to_disk(key, obj)
+        evicted = []
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self._bytes -= old.size
+                evicted.append(old)
+            self._items[key] = obj
+            self._bytes += obj.size
+            while self._bytes > self.max_bytes and self._items:
+                victim_key, victim = self._items.popitem(last=False)
+                self._bytes -= victim.size
+                evicted.append(victim)
+                self._bump(victim_key[0], "evicted")
+        for victim in evicted:
+            if victim.path and victim.path != obj.path:
+                try:
+                    os.remove(victim.path)
+                except OSError:
+                    pass
+
+    def _to_disk(self, key, obj: CachedObject) -> CachedObject:
+        os.makedirs(self.disk_dir, exist_ok=True)
+        digest = hashlib.sha1(f"{key[0]}/{key[1]}".encode("utf-8")).hexdigest()
+        path = os.path.join(self.disk_dir, digest)
+        tmp = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(obj.body)
+        os.replace(tmp, path)
+        disk = CachedObject(None, obj.content_type, obj.headers, path=path)
+        disk.expires_at = obj.expires_at
+        return disk
+
+    def clear(self) -> None:
+        with self._lock:
+            items = list(self._items.values())
+            self._items.clear()
+            self._bytes = 0
+            self._stats.clear()
+        for obj in items:
+            if obj.path:
+                try:
+                    os.remove(obj.path)
+                except OSError:
+                    pass
+
+    # ---------- 統計 ----------
+    def _bump(self, serial: str, key: str) -> None:
+        # 呼叫端已持有 self._lock
+        s = self._stats.setdefault(
+            serial,
+            {"hits": 0, "misses": 0, "coalesced": 0, "prefetched": 0, "evicted": 0},
+        )
+        s[key] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            devices = {k: dict(v) for k, v in self._stats.items()}
+            data = {
+                "items": len(self._items),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes,
+                "inflight": len(self._inflight) + len(self._ainflight),
+            }
+        for s in devices.values():
+            total = s["hits"] + s["misses"] + s["coalesced"]
+            # 等別人抓的也算沒打到上游
+            s["hit_ratio"] = (
+                round((s["hits"] + s["coalesced"]) / total, 4) if total else None
+            )
+        data["devices"] = devices
+        return data
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache() -> SegmentCache:
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = SegmentCache(_conf("MAX_BYTES"), _conf("DISK_DIR"))
+    return _cache
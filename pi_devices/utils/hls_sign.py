@@ -0,0 +1,107 @@
+# pi_devices/utils/hls_sign.py
+# -*- coding: utf-8 -*-
+"""
+向 Pi 要 HLS 的簽章網址（區網直連與 hls_proxy 都用）
+
+網址長這樣：http://<pi-ip>:8088/s/<exp>/<stream>/<sig>/index.m3u8
+- stream 是哪一路串流（index：一般 HLS；ll：LL-HLS），只能拿這一路的 playlist 與片段
+  （STREAM_FILES），一個網址外洩不會連別的檔案都打開
+- sig = HMAC-SHA256(key, "<序號（大寫）>:<exp>:<stream>")，key 由裝置 token 推出
+  （Pi 的 .env 也有 TOKEN），Pi 端 stream/signing.py 用同樣的方式驗證，過期或不符回 403
+- 簽章放在路徑裡：playlist 內的相對片段路徑（seg_*.ts / LL 小段）會自動帶上同一個前綴
+- 有效期 TTL 秒；live_player 播放失敗時會重新要一個新的網址
+- Pi 預設只收簽章網址（HLS_REQUIRE_SIGNATURE），所以 hls_proxy 向 Pi 要檔案也要簽
+設定見 settings.HLS_DIRECT。
+"""
+import hashlib
+import hmac
+import ipaddress
+import re
+import time
+from urllib.parse import urlsplit
+
+from django.conf import settings
+
+DEFAULTS = {
+    "ENABLED": True,
+    "TTL": 600,
+    "PROBE_TIMEOUT_MS": 1500,
+    "KEEPALIVE_SECONDS": 20,
+}
+
+
+def _conf(key):
+    return (getattr(settings, "HLS_DIRECT", None) or {}).get(key, DEFAULTS[key])
+
+
+# 每一路串流可以拿的檔案（與 pi_agent/stream/signing.py 相同）
+STREAM_FILES = {
+    "index": re.compile(r"index\.m3u8|seg_\d+\.ts"),
+    "ll": re.compile(r"ll\.m3u8|ll[0-9a-f]+_\d+(?:_\d+)?\.ts"),
+}
+
+
+def stream_of(name: str) -> str | None:
+    """檔名屬於哪一路串流；都不是回 None"""
+    for stream, files in STREAM_FILES.items():
+        if files.fullmatch(name):
+            return stream
+    return None
+
+
+def signing_key(token: str) -> bytes:
+    """裝置 token → 簽章用的 key（不直接拿 token 當 key，網址外洩也推不回 token）"""
+    return hmac.new(token.encode("utf-8"), b"homepi-hls", hashlib.sha256).digest()
+
+
+def signature(token: str, serial: str, exp: int, stream: str) -> str:
+    msg = f"{serial.upper()}:{int(exp)}:{stream}".encode("utf-8")
+    return hmac.new(signing_key(token), msg, hashlib.sha256).hexdigest()
+
+
+def signed_path(token: str, serial: str, name: str, ttl=None, now=None) -> str:
+    """/s/<exp>/<stream>/<sig>/<name>；name 不屬於任何一路串流丟 ValueError"""
+    stream = stream_of(name)
+    if stream is None:
+        raise ValueError(f"not an HLS stream file: {name}")
+    now = time.time() if now is None else now
+    exp = int(now + (_conf("TTL") if ttl is None else ttl))
+    return f"/s/{exp}/{stream}/{signature(token, serial, exp, stream)}/{name}"
+
+
+def upstream_path(token: str, serial: str, name: str) -> str:
+    """hls_proxy 向 Pi 要檔案的路徑（name 可帶 LL-HLS 的 query）；沒 token 或不認得的檔名不簽"""
+    file, sep, query = name.partition("?")
+    if not token or stream_of(file) is None:
+        return f"/{name}"
+    return signed_path(token, serial, file) + sep + query
+
+
+def client_config() -> dict:
+    """給 live_player 的參數：直連探測逾時與 keepalive 間隔"""
+    return {
+        "probe_timeout_ms": int(_conf("PROBE_TIMEOUT_MS")),
+        "keepalive": int(_conf("KEEPALIVE_SECONDS")),
+    }
+
+
+def is_lan_address(ip: str | None) -> bool:
+    try:
+        addr = ipaddress.ip_address((ip or "").strip())
+    except ValueError:
+        return False
+    return addr.is_private and not addr.is_loopback
+
+
+def direct_url(request, device, base: str, name: str) -> str | None:
+    """
+    可以直連時回傳簽章網址，否則 None（呼叫端改用 hls_proxy）：
+    - 功能關閉、Pi 的位址不是區網 IP
+    - 頁面走 HTTPS（瀏覽器會擋 http:// 的混合內容，試了也白試）
+    瀏覽器實際連不連得到由 live_player 自己試（PROBE_TIMEOUT_MS），不通就退回代理。
+    """
+    if not _conf("ENABLED") or request.is_secure():
+        return None
+    if not is_lan_address(urlsplit(base).hostname) or not device.token:
+        return None
+    return base.rstrip("/") + signed_path(device.token, device.serial_number, name)
@@ -0,0 +1,228 @@
+# pi_devices/utils/metrics_rollup.py
+# -*- coding: utf-8 -*-
+"""
+裝置指標的增量彙總（device_ping_logs → 1m → 1h → 1d）
+
+每一層都是「上一層 $match 時間範圍 → $group 依 (device_id, 時間桶) → $merge 覆寫」：
+- 1m 由原始 device_ping_logs 算，1h 由 1m 算，1d 由 1h 算
+- 每個桶整桶重算後 replace，重跑不會重複累加；watermark 停在目前這個桶的開頭，
+  下次會把還沒結束的桶再算一次
+- 每個指標存 min/max/sum/count/avg，另有 count / online / online_seconds / online_ratio
+- 上線比例不能用「online 筆數 / 總筆數」：離線時根本沒有紀錄（只有轉換當下一筆），
+  那樣幾乎每個桶都是 1.0。改成用 ping 間隔估上線秒數：
+  1m 桶 online_seconds = min(60, online 筆數 × DEVICE_PING_INTERVAL_SECONDS)，
+  上層加總子桶（沒有紀錄的分鐘算 0），online_ratio = online_seconds / 桶秒數
+需要 MongoDB 5.0+（$dateTrunc）。由 manage.py rollup_device_metrics 定期執行；
+查詢端用 query_series() 依時間範圍與點數上限自動挑解析度。
+"""
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+
+from HomePiWeb.mongo import (
+    device_metrics_rollup_state,
+    device_metrics_rollups,
+    device_ping_logs,
+)
+
+# (名稱, 桶秒數, $dateTrunc unit, 來源層)
+RESOLUTIONS = [
+    ("1m", 60, "minute", None),
+    ("1h", 3600, "hour", "1m"),
+    ("1d", 86400, "day", "1h"),
+]
+
+# 指標名稱 -> 舊版欄位名（相容 device_logs 的 cpu/memory/temp）
+METRICS = {
+    "cpu_percent": "cpu",
+    "memory_percent": "memory",
+    "temperature": "temp",
+    "disk_percent": None,
+}
+
+
+def _utc(dt: datetime) -> datetime:
+    # pymongo 預設回傳 naive UTC
+    return dt.replace(tzinfo=dt_timezone.utc) if dt.tzinfo is None else dt
+
+
+def _floor(dt: datetime, step: int) -> datetime:
+    ts = int(_utc(dt).timestamp())
+    return datetime.fromtimestamp(ts - ts % step, tz=dt_timezone.utc)
+
+
+def _ping_interval() -> float:
+    """agent 的心跳間隔（pi_agent/http_agent.py 每 30 秒 ping 一次）"""
+    return float(getattr(settings, "DEVICE_PING_INTERVAL_SECONDS", 30) or 30)
+
+
+def _raw_stages(unit: str, step: int) -> list:
+    values = {}
+    for name, legacy in METRICS.items():
+        src = f"${name}" if not legacy else {"$ifNull": [f"${name}", f"${legacy}"]}
+        values[name] = {
+            "$convert": {"input": src, "to": "double", "onError": None, "onNull": None}
+        }
+    group = {
+        "_id": {
+            "device_id": "$device_id",
+            "bucket": {"$dateTrunc": {"date": "$ping_at", "unit": unit}},
+        },
+        "count": {"$sum": 1},
+        "online": {"$sum": {"$cond": [{"$eq": ["$status", "online"]}, 1, 0]}},
+    }
+    for name in METRICS:
+        v = f"$_v.{name}"
+        group[f"{name}_min"] = {"$min": v}
+        group[f"{name}_max"] = {"$max": v}
+        group[f"{name}_sum"] = {"$sum": v}
+        group[f"{name}_count"] = {
+            "$sum": {"$cond": [{"$eq": [{"$type": v}, "double"]}, 1, 0]}
+        }
+    # 狀態推送也會多送 ping，一個桶最多算滿 step 秒
+    online_seconds = {"$min": [step, {"$multiply": ["$online", _ping_interval()]}]}
+    return [
+        {"$addFields": {"_v": values}},
+        {"$group": group},
+        {"$addFields": {"online_seconds": online_seconds}},
+    ]
+
+
+def _child_stages(unit: str) -> list:
+    group = {
+        "_id": {
+            "device_id": "$device_id",
+            "bucket": {"$dateTrunc": {"date": "$bucket", "unit": unit}},
+        },
+        "count": {"$sum": "$count"},
+        "online": {"$sum": "$online"},
+        "online_seconds": {"$sum": {"$ifNull": ["$online_seconds", 0]}},
+    }
+    for name in METRICS:
+        group[f"{name}_min"] = {"$min": f"${name}.min"}
+        group[f"{name}_max"] = {"$max": f"${name}.max"}
+        group[f"{name}_sum"] = {"$sum": f"${name}.sum"}
+        group[f"{name}_count"] = {"$sum": f"${name}.count"}
+    return [{"$group": group}]
+
+
+def _shape_stage(step: int) -> dict:
+    project = {
+        "_id": 0,
+        "device_id": "$_id.device_id",
+        "bucket": "$_id.bucket",
+        "count": 1,
+        "online": 1,
+        "online_seconds": 1,
+        "online_ratio": {"$min": [1, {"$divide": ["$online_seconds", step]}]},
+    }
+    for name in METRICS:
+        cnt = f"${name}_count"
+        project[name] = {
+            "min": f"${name}_min",
+            "max": f"${name}_max",
+            "sum": f"${name}_sum",
+            "count": cnt,
+            "avg": {
+                "$cond": [
+                    {"$gt": [cnt, 0]},
+                    {"$divide": [f"${name}_sum", cnt]},
+                    None,
+                ]
+            },
+        }
+    return {"$project": project}
+
+
+def rollup_level(name: str, start: datetime, end: datetime) -> None:
+    """重算 name 這一層在 [start, end) 內的所有桶"""
+    _, step, unit, source = next(r for r in RESOLUTIONS if r[0] == name)
+    target = device_metrics_rollups[name]
+
+    if source is None:
+        coll, time_field, stages = device_ping_logs, "ping_at", _raw_stages(unit, step)
+    else:
+        coll, time_field, stages = (
+            device_metrics_rollups[source],
+            "bucket",
+            _child_stages(unit),
+        )
+
+    pipeline = [
+        {"$match": {time_field: {"$gte": start, "$lt": end}}},
+        *stages,
+        _shape_stage(step),
+        {
+            "$merge": {
+                "into": target.name,
+                "on": ["device_id", "bucket"],
+                "whenMatched": "replace",
+                "whenNotMatched": "insert",
+            }
+        },
+    ]
+    list(coll.aggregate(pipeline, allowDiskUse=True))
+
+
+_indexes_ready = False
+
+
+def _ensure_indexes() -> None:
+    """$merge 需要 (device_id, bucket) 唯一索引；每個行程只建一次"""
+    global _indexes_ready
+    if _indexes_ready:
+        return
+    for coll in device_metrics_rollups.values():
+        coll.create_index(
+            [("device_id", 1), ("bucket", 1)], unique=True, name="device_id_1_bucket_1"
+        )
+    _indexes_ready = True
+
+
+def run_rollups(now: datetime | None = None, backfill: timedelta = timedelta(days=1)):
+    """
+    依序跑 1m → 1h → 1d，各層從自己的 watermark 接著算到 now。
+    第一次執行（沒有 watermark）往回補 backfill。回傳 {層: (start, end)}。
+    """
+    now = _utc(now or datetime.now(dt_timezone.utc))
+    _ensure_indexes()
+    done = {}
+    for name, step, _, _ in RESOLUTIONS:
+        state = device_metrics_rollup_state.find_one({"_id": name}) or {}
+        mark = state.get("watermark")
+        start = _floor(_utc(mark) if mark else now - backfill, step)
+        rollup_level(name, start, now)
+        device_metrics_rollup_state.update_one(
+            {"_id": name},
+            {"$set": {"watermark": _floor(now, step), "updated_at": now}},
+            upsert=True,
+        )
+        done[name] = (start, now)
+    return done
+
+
+def pick_resolution(span_seconds: float, max_points: int) -> str:
+    """挑能在 max_points 點內畫完 span 的最細解析度；都塞不下就用最粗的"""
+    for name, step, _, _ in RESOLUTIONS:
+        if span_seconds / step <= max_points:
+            return name
+    return RESOLUTIONS[-1][0]
+
+
+def query_series(device_id: str, start: datetime, end: datetime, max_points: int):
+    """回傳 (解析度, [彙總點…])，點依時間排序"""
+    start, end = _utc(start), _utc(end)
+    name = pick_resolution((end - start).total_seconds(), max_points)
+    step = next(r[1] for r in RESOLUTIONS if r[0] == name)
+    start = _floor(start, step)  # 包含 start 所在的那個桶
+    cursor = (
+        device_metrics_rollups[name]
+        .find(
+            {"device_id": device_id, "bucket": {"$gte": start, "$lt": end}},
+            {"_id": 0},
+        )
+        .sort("bucket", -1)
+        .limit(max_points)
+    )
+    # 範圍太大、最粗一層也超過點數時保留最新的部分
+    return name, list(cursor)[::-1]
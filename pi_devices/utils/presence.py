@@ -0,0 +1,260 @@
+# pi_devices/utils/presence.py
+# -*- coding: utf-8 -*-
+"""
+裝置 / 使用者在線狀態（取代到處查 last_ping >= now - window）
+
+- touch(device_id, owner_id)：device_ping 每次心跳呼叫，記下 last-seen
+- 過期用時間輪（TimingWheel）：每台裝置排一個 now + window 的到期點，
+  時間推進時只看到期的那幾格，不必掃全部裝置
+- touch() 回傳這次觸發的狀態轉換（device_online / owner_online / ...），
+  目前只給測試與除錯看；上線通知仍由 views/api.py::_ping_transition 依 DB 狀態發送
+  （多 worker 時每個行程各自的事件會重複，不適合拿來發通知）
+- is_device_online / is_owner_online：O(1) 查記憶體，不打 DB（視窗 = DEVICE_ONLINE_WINDOW_SECONDS）
+- device_last_seen / owner_last_seen：最後心跳時間，給要用其他視窗判斷的呼叫端
+
+多 worker 部署：
+- settings.DEVICE_PRESENCE_BACKEND = "cache" 時另外把 last-seen 寫進 Django cache，
+  本行程沒看到的心跳可從 cache 補查（仍是 O(1) 的 get）
+- 每 DEVICE_PRESENCE_RESYNC_SECONDS 秒用一條 SQL 從 last_ping 重新同步（不發事件），
+  同時負責行程剛啟動時的暖機；設 0 關閉
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+CACHE_PREFIX = "homepi:presence:"
+
+
+def _window() -> float:
+    return float(getattr(settings, "DEVICE_ONLINE_WINDOW_SECONDS", 60))
+
+
+def _cache():
+    if getattr(settings, "DEVICE_PRESENCE_BACKEND", "memory") != "cache":
+        return None
+    from django.core.cache import caches
+
+    return caches[getattr(settings, "DEVICE_PRESENCE_CACHE", "default")]
+
+
+def _latest(*values):
+    values = [v for v in values if v is not None]
+    return max(values) if values else None
+
+
+class TimingWheel:
+    """單層時間輪：以 tick 秒為一格，schedule 的 key 在到期那一格被 advance 取出"""
+
+    def __init__(self, tick: float = 1.0, slots: int = 128):
+        self.tick = tick
+        self._slots: list[list] = [[] for _ in range(max(2, slots))]
+        self._current: int | None = None
+
+    def schedule(self, key, expire_at: float) -> None:
+        idx = int(expire_at // self.tick) + 1  # 無條件進位，寧可晚一格
+        if self._current is not None and idx <= self._current:
+            idx = self._current + 1  # 已經過去的時間點，下一格就處理
+        self._slots[idx % len(self._slots)].append((idx, key))
+
+    def advance(self, now: float) -> list:
+        """推進到 now，回傳這段期間到期的 key（可能含已被續期的舊項目，由呼叫端判斷）"""
+        target = int(now // self.tick)
+        if self._current is None:
+            self._current = target
+        expired = []
+        steps = min(target - self._current, len(self._slots))
+        for i in range(1, steps + 1):
+            pos = (self._current + i) % len(self._slots)
+            keep = []
+            for idx, key in self._slots[pos]:
+                (expired if idx <= target else keep).append(key)
+            self._slots[pos] = keep
+        self._current = max(self._current, target)
+        return expired
+
+
+class PresenceTracker:
+    def __init__(self, window: float | None = None, tick: float = 1.0):
+        self.window = window
+        self._lock = threading.RLock()
+        self._seen: dict[int, float] = {}  # device_id -> last-seen（epoch 秒）
+        self._owner: dict[int, int | None] = {}  # device_id -> owner_id
+        self._online: set[int] = set()
+        self._owner_online: dict[int, set[int]] = {}  # owner_id -> 在線裝置
+        self._owner_seen: dict[int, float] = {}  # owner_id -> 名下裝置最後心跳
+        win = window or _window()
+        self._wheel = TimingWheel(tick, slots=int(win / tick) + 4)
+        self._last_sync = 0.0
+
+    # ---------- 寫入 ----------
+    def touch(self, device_id: int, owner_id: int | None, ts: float | None = None):
+        """記一次心跳，回傳觸發的事件 [(event, device_id, owner_id), ...]"""
+        ts = ts or time.time()
+        events = []
+        with self._lock:
+            self._advance(time.time(), events)
+            self._mark(device_id, owner_id, ts, events)
+        cache = _cache()
+        if cache is not None:
+            timeout = int(self._win() * 2)
+            cache.set(f"{CACHE_PREFIX}dev:{device_id}", ts, timeout)
+            if owner_id:
+                cache.set(f"{CACHE_PREFIX}owner:{owner_id}", ts, timeout)
+        return events
+
+    def _mark(self, device_id, owner_id, ts, events) -> None:
+        prev = self._seen.get(device_id)
+        if prev is not None and ts <= prev and self._owner.get(device_id) == owner_id:
+            return
+        self._seen[device_id] = max(ts, prev or ts)
+
+        old_owner = self._owner.get(device_id)
+        if device_id in self._online and old_owner != owner_id:
+            self._drop_owner(device_id, old_owner, events)  # 裝置換了主人
+        self._owner[device_id] = owner_id
+
+        if device_id not in self._online:
+            self._online.add(device_id)
+            events.append(("device_online", device_id, owner_id))
+        if owner_id:
+            self._owner_seen[owner_id] = max(
+                self._seen[device_id], self._owner_seen.get(owner_id, 0)
+            )
+            owned = self._owner_online.setdefault(owner_id, set())
+            if not owned:
+                events.append(("owner_online", device_id, owner_id))
+            owned.add(device_id)
+        self._wheel.schedule(device_id, self._seen[device_id] + self._win())
+
+    def _drop_owner(self, device_id, owner_id, events) -> None:
+        owned = self._owner_online.get(owner_id)
+        if not owned:
+            return
+        owned.discard(device_id)
+        if not owned:
+            del self._owner_online[owner_id]
+            events.append(("owner_offline", device_id, owner_id))
+
+    def _advance(self, now: float, events) -> None:
+        threshold = now - self._win()
+        for device_id in self._wheel.advance(now):
+            seen = self._seen.get(device_id)
+            if seen is None or seen > threshold or device_id not in self._online:
+                continue  # 已續期或早就離線
+            self._online.discard(device_id)
+            owner_id = self._owner.get(device_id)
+            events.append(("device_offline", device_id, owner_id))
+            if owner_id:
+                self._drop_owner(device_id, owner_id, events)
+
+    # ---------- 查詢 ----------
+    def is_device_online(self, device_id: int) -> bool:
+        self._refresh()
+        with self._lock:
+            if device_id in self._online:
+                return True
+        return self._cache_recent(f"dev:{device_id}")
+
+    def is_owner_online(self, owner_id: int) -> bool:
+        self._refresh()
+        with self._lock:
+            if self._owner_online.get(owner_id):
+                return True
+        return self._cache_recent(f"owner:{owner_id}")
+
+    def device_last_seen(self, device_id: int) -> float | None:
+        """最後一次心跳（epoch 秒）；本行程與 cache 都沒看過回 None"""
+        self._refresh()
+        with self._lock:
+            ts = self._seen.get(device_id)
+        return _latest(ts, self._cache_ts(f"dev:{device_id}"))
+
+    def owner_last_seen(self, owner_id: int) -> float | None:
+        self._refresh()
+        with self._lock:
+            ts = self._owner_seen.get(owner_id)
+        return _latest(ts, self._cache_ts(f"owner:{owner_id}"))
+
+    def _cache_ts(self, key: str) -> float | None:
+        cache = _cache()
+        return None if cache is None else cache.get(f"{CACHE_PREFIX}{key}")
+
+    def _cache_recent(self, key: str) -> bool:
+        ts = self._cache_ts(key)
+        return ts is not None and ts >= time.time() - self._win()
+
+    def _refresh(self) -> None:
+        events = []  # 到期轉換只更新記憶體狀態，不對外發送
+        now = time.time()
+        resync = float(getattr(settings, "DEVICE_PRESENCE_RESYNC_SECONDS", 30))
+        with self._lock:
+            self._advance(now, events)
+            due = resync > 0 and now - self._last_sync >= resync
+            if due:
+                self._last_sync = now
+        if due:
+            self._resync()
+
+    def _resync(self) -> None:
+        """用 DB 的 last_ping 補上其他行程看到的心跳（不發事件）"""
+        from django.utils import timezone
+        from datetime import timedelta
+
+        from ..models import Device
+
+        try:
+            rows = list(
+                Device.objects.filter(
+                    last_ping__gte=timezone.now() - timedelta(seconds=self._win())
+                ).values_list("id", "user_id", "last_ping")
+            )
+        except Exception as e:
+            logger.warning(f"presence resync failed: {e}")
+            return
+        ignored = []
+        with self._lock:
+            for device_id, owner_id, last_ping in rows:
+                self._mark(device_id, owner_id, last_ping.timestamp(), ignored)
+
+    def _win(self) -> float:
+        return self.window or _window()
+
+    def reset(self) -> None:
+        with self._lock:
+            self._seen.clear()
+            self._owner.clear()
+            self._online.clear()
+            self._owner_online.clear()
+            self._owner_seen.clear()
+            self._last_sync = 0.0
+
+
+_tracker = PresenceTracker()
+
+
+def touch(device_id: int, owner_id: int | None, ts: float | None = None):
+    return _tracker.touch(device_id, owner_id, ts)
+
+
+def is_device_online(device_id: int) -> bool:
+    return _tracker.is_device_online(device_id)
+
+
+def is_owner_online(owner_id: int) -> bool:
+    return _tracker.is_owner_online(owner_id)
+
+
+def device_last_seen(device_id: int) -> float | None:
+    return _tracker.device_last_seen(device_id)
+
+
+def owner_last_seen(owner_id: int) -> float | None:
+    return _tracker.owner_last_seen(owner_id)
+
+
+def reset() -> None:
+    _tracker.reset()
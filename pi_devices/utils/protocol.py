@@ -0,0 +1,109 @@
+# pi_devices/utils/protocol.py
+# -*- coding: utf-8 -*-
+"""
+agent ↔ 伺服器的請求格式（所有 agent 端點共用同一個解碼入口）
+
+v1（舊 agent）：JSON，ping 會把 extra 的內容同時放在頂層與 "extra" 裡（送兩次）
+v2：每個欄位只送一次（caps / caps_hash / state / metrics 都在頂層），另外支援
+- Content-Encoding: gzip
+- Content-Type: application/msgpack（伺服器有裝 msgpack 時）
+協商：ping 的 pong 帶 "protocol"（見 capabilities()），agent 看到 2 以上才改送 v2。
+
+decode_request(request) 一律回傳扁平的 dict：v1 的 "extra" 會被攤平到頂層
+（頂層已有的欄位優先），views 不必再分 data / extra 兩處找。
+"""
+import json
+import zlib
+
+from django.conf import settings
+from django.http import JsonResponse
+
+try:
+    import msgpack
+except ImportError:  # 選配：沒裝就只收 JSON
+    msgpack = None
+
+PROTOCOL_VERSION = 2
+
+MSGPACK_TYPES = ("application/msgpack", "application/x-msgpack")
+
+
+class ProtocolError(ValueError):
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+def _max_body() -> int:
+    return int(getattr(settings, "DEVICE_PROTOCOL_MAX_BODY", 1024 * 1024))
+
+
+def _gunzip(raw: bytes) -> bytes:
+    """解 gzip，解開後超過 DEVICE_PROTOCOL_MAX_BODY 就拒絕（防壓縮炸彈）"""
+    limit = _max_body()
+    d = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    try:
+        out = d.decompress(raw, limit + 1)
+    except zlib.error as e:
+        raise ProtocolError(f"bad gzip body: {e}")
+    if len(out) > limit or d.unconsumed_tail:
+        raise ProtocolError("body too large", status=413)
+    return out
+
+
+def decode_body(raw: bytes, content_type: str = "", content_encoding: str = ""):
+    """bytes → dict；格式錯誤丟 ProtocolError"""
+    encoding = (content_encoding or "").strip().lower()
+    if encoding in ("gzip", "x-gzip"):
+        raw = _gunzip(raw)
+    elif encoding not in ("", "identity"):
+        raise ProtocolError(f"unsupported encoding: {encoding}", status=415)
+
+    ctype = (content_type or "").split(";")[0].strip().lower()
+    if ctype in MSGPACK_TYPES:
+        if msgpack is None:
+            raise ProtocolError("msgpack not supported", status=415)
+        try:
+            data = msgpack.unpackb(raw, raw=False)
+        except Exception:
+            raise ProtocolError("Invalid msgpack")
+    else:
+        # 其他一律當 JSON（舊 agent / curl -d 常帶 form 的 Content-Type）
+        try:
+            data = json.loads(raw.decode("utf-8")) if raw else {}
+        except (UnicodeDecodeError, json.JSONDecodeError):
+            raise ProtocolError("Invalid JSON")
+
+    if not isinstance(data, dict):
+        raise ProtocolError("body must be an object")
+    return normalize(data)
+
+
+def normalize(data: dict) -> dict:
+    """把 v1 的 "extra" 攤平到頂層（頂層優先），回傳 v2 形狀"""
+    extra = data.pop("extra", None)
+    if isinstance(extra, dict):
+        for key, value in extra.items():
+            data.setdefault(key, value)
+    return data
+
+
+def decode_request(request):
+    """回傳 (data, error_response)；所有 agent 端點共用"""
+    try:
+        data = decode_body(
+            request.body,
+            request.META.get("CONTENT_TYPE", ""),
+            request.META.get("HTTP_CONTENT_ENCODING", ""),
+        )
+    except ProtocolError as e:
+        return None, JsonResponse({"error": str(e)}, status=e.status)
+    return data, None
+
+
+def capabilities() -> dict:
+    """放進 pong 給 agent 協商用"""
+    types = ["application/json"]
+    if msgpack is not None:
+        types.append("application/msgpack")
+    return {"protocol": PROTOCOL_VERSION, "encodings": ["gzip"], "content_types": types}
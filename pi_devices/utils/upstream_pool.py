@@ -0,0 +1,318 @@
+# pi_devices/utils/upstream_pool.py
+# -*- coding: utf-8 -*-
+"""
+hls_proxy → 樹莓派 的上游連線池
+
+原本每個片段都 requests.get()，每次都重新 TCP 握手；這裡每台 Pi（scheme://host:port）
+各一個 requests.Session，底下的 urllib3 連線池保持 keep-alive：
+- 每台保留最多 MAX_SIZE 條閒置連線，同時最多 MAX_PER_HOST 個請求（其餘排隊，
+  排隊時間算在連線逾時內），一台卡住不會把 worker 全吃掉
+- 超過 IDLE_SECONDS 沒用的 Session 會被關掉（裝置換 IP / 下線後不佔 socket）
+- 最多同時保留 MAX_HOSTS 台，超過就關掉最久沒用的；還有請求在用的不關，
+  先從池裡拿掉，最後一個請求用完才關
+ASGI 版（api_async.hls_proxy）用 get_async_pool()：同樣的規則，每台 Pi 一個
+httpx.AsyncClient（max_connections = MAX_PER_HOST，等連線算在 pool timeout 內）。
+get(url, max_bytes=N)：邊讀邊數，超過 N bytes 就中止並丟 BodyTooLarge，
+不會把超大的回應整個讀進記憶體（hls_proxy 用它擋異常大的片段）。
+設定見 settings.HLS_PROXY_POOL；manage.py bench_hls_proxy 可比較有無連線池的延遲。
+"""
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+
+DEFAULTS = {
+    "MAX_SIZE": 4,
+    "MAX_PER_HOST": 8,
+    "IDLE_SECONDS": 60,
+    "MAX_HOSTS": 256,
+}
+
+
+def _conf(key):
+    return (getattr(settings, "HLS_PROXY_POOL", None) or {}).get(key, DEFAULTS[key])
+
+
+class BodyTooLarge(Exception):
+    """上游回應超過 max_bytes（已中止讀取）"""
+
+
+def _check_length(headers, max_bytes: int, url: str) -> None:
+    length = headers.get("Content-Length", "")
+    if length.isdigit() and int(length) > max_bytes:
+        raise BodyTooLarge(f"{url}: {length} bytes > {max_bytes}")
+
+
+def _append(buf: bytearray, chunk: bytes, max_bytes: int, url: str) -> None:
+    buf += chunk
+    if len(buf) > max_bytes:
+        raise BodyTooLarge(f"{url}: > {max_bytes} bytes")
+
+
+def _origin(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
+class _Host:
+    """一台 Pi 的 Session / AsyncClient 與使用中的請求數"""
+
+    __slots__ = ("client", "used", "busy", "evicted", "slots")
+
+    def __init__(self, client, now: float, slots=None):
+        self.client = client
+        self.used = now
+        self.busy = 0
+        self.evicted = False  # 已從池拿掉，最後一個請求用完就關
+        self.slots = slots
+
+
+class _HostPool:
+    """依 origin 分的 LRU；sync / async 版共用，子類只負責建立與關閉連線"""
+
+    def __init__(
+        self,
+        max_size: int = 4,
+        idle_seconds: float = 60,
+        max_hosts: int = 256,
+        max_per_host: int = 8,
+    ):
+        self.max_size = max(1, int(max_size))
+        self.idle_seconds = float(idle_seconds)
+        self.max_hosts = max(1, int(max_hosts))
+        self.max_per_host = max(1, int(max_per_host))
+        self._lock = threading.Lock()
+        self._hosts: OrderedDict[str, _Host] = OrderedDict()
+        self._last_sweep = time.monotonic()
+
+    def _new_host(self, now: float) -> _Host:
+        raise NotImplementedError
+
+    def _checkout(self, url: str) -> tuple[_Host, list]:
+        """借出這台的連線（busy + 1）；回傳 (host, 要關掉的舊連線)"""
+        origin = _origin(url)
+        now = time.monotonic()
+        closing = []
+        with self._lock:
+            host = self._hosts.get(origin)
+            if host is None:
+                host = self._hosts[origin] = self._new_host(now)
+            host.used = now
+            host.busy += 1
+            self._hosts.move_to_end(origin)
+            sweep = now - self._last_sweep >= min(self.idle_seconds, 30)
+            if sweep or len(self._hosts) > self.max_hosts:
+                closing = self._evict(now, sweep)
+        return host, closing
+
+    def _checkin(self, host: _Host) -> bool:
+        """歸還；True = 已被移出池且沒人在用，呼叫端要關掉它"""
+        with self._lock:
+            host.busy -= 1
+            return host.evicted and host.busy == 0
+
+    def _evict(self, now: float, sweep: bool) -> list:
+        # 呼叫端已持有 self._lock；OrderedDict 依使用時間排序，使用中的跳過
+        if sweep:
+            self._last_sweep = now
+        over = len(self._hosts) - self.max_hosts
+        closing = []
+        for origin, host in list(self._hosts.items()):
+            if host.busy:
+                continue
+            if over > 0:
+                over -= 1
+            elif not sweep or now - host.used < self.idle_seconds:
+                break
+            del self._hosts[origin]
+            host.evicted = True
+            closing.append(host.client)
+        return closing
+
+    def _drain(self) -> list:
+        """整池清空；使用中的等最後一個請求歸還時再關"""
+        with self._lock:
+            hosts = list(self._hosts.values())
+            self._hosts.clear()
+            for host in hosts:
+                host.evicted = True
+            return [host.client for host in hosts if not host.busy]
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                "hosts": len(self._hosts),
+                "idle_seconds": {
+                    origin: round(now - host.used, 1)
+                    for origin, host in self._hosts.items()
+                },
+                "busy": {
+                    origin: host.busy
+                    for origin, host in self._hosts.items()
+                    if host.busy
+                },
+            }
+
+
+class UpstreamPool(_HostPool):
+    def _new_session(self) -> requests.Session:
+        s = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=self.max_size,
+            pool_block=False,  # 池滿時臨時多開的連線用完就關，不放回池
+            max_retries=0,
+        )
+        s.mount("http://", adapter)
+        s.mount("https://", adapter)
+        s.trust_env = False  # 內網直連，不走環境變數的 proxy
+        return s
+
+    def _new_host(self, now: float) -> _Host:
+        return _Host(
+            self._new_session(), now, threading.BoundedSemaphore(self.max_per_host)
+        )
+
+    @contextmanager
+    def lease(self, url: str, wait: float | None = None):
+        """借用這台 Pi 的 Session；同時超過 max_per_host 個請求時最多等 wait 秒"""
+        host, closing = self._checkout(url)
+        for s in closing:
+            s.close()
+        try:
+            if not host.slots.acquire(timeout=wait):
+                raise requests.ConnectionError(f"too many requests to {_origin(url)}")
+            try:
+                yield host.client
+            finally:
+                host.slots.release()
+        finally:
+            if self._checkin(host):
+                host.client.close()
+
+    def request(
+        self, method: str, url: str, max_bytes: int | None = None, **kwargs
+    ) -> requests.Response:
+        timeout = kwargs.get("timeout")
+        wait = timeout[0] if isinstance(timeout, tuple) else timeout
+        with self.lease(url, wait) as session:
+            if max_bytes is None:
+                return session.request(method, url, **kwargs)
+            with session.request(method, url, stream=True, **kwargs) as r:
+                _check_length(r.headers, max_bytes, url)
+                buf = bytearray()
+                for chunk in r.iter_content(64 * 1024):
+                    _append(buf, chunk, max_bytes, url)
+                # 讀完的內容放回 Response，呼叫端照常用 r.content
+                r._content = bytes(buf)
+            return r
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        return self.request("GET", url, **kwargs)
+
+    def close(self) -> None:
+        for s in self._drain():
+            s.close()
+
+
+class AsyncUpstreamPool(_HostPool):
+    """ASGI 版；httpx.AsyncClient 不能跨 event loop，一個 loop 一個池"""
+
+    def _new_host(self, now: float) -> _Host:
+        import httpx
+
+        client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=self.max_per_host,
+                max_keepalive_connections=self.max_size,
+                keepalive_expiry=self.idle_seconds,
+            ),
+            follow_redirects=False,
+            trust_env=False,
+        )
+        return _Host(client, now)
+
+    async def request(self, method: str, url: str, max_bytes=None, **kwargs):
+        host, closing = self._checkout(url)
+        for client in closing:
+            await client.aclose()
+        try:
+            if max_bytes is None:
+                return await host.client.request(method, url, **kwargs)
+            return await _read_capped(host.client, method, url, max_bytes, **kwargs)
+        finally:
+            if self._checkin(host):
+                await host.client.aclose()
+
+    async def get(self, url: str, **kwargs):
+        return await self.request("GET", url, **kwargs)
+
+    async def aclose(self) -> None:
+        for client in self._drain():
+            await client.aclose()
+
+
+async def _read_capped(client, method: str, url: str, max_bytes: int, **kwargs):
+    import httpx
+
+    req = client.build_request(method, url, **kwargs)
+    r = await client.send(req, stream=True)
+    try:
+        _check_length(r.headers, max_bytes, url)
+        buf = bytearray()
+        async for chunk in r.aiter_bytes():
+            _append(buf, chunk, max_bytes, url)
+    finally:
+        await r.aclose()
+    # aiter_bytes 已解壓，不再帶原本的 Content-Encoding / Content-Length
+    headers = [
+        (k, v)
+        for k, v in r.headers.multi_items()
+        if k.lower() not in ("content-encoding", "content-length")
+    ]
+    return httpx.Response(
+        r.status_code, headers=headers, content=bytes(buf), request=req
+    )
+
+
+def _from_settings(cls):
+    return cls(
+        _conf("MAX_SIZE"),
+        _conf("IDLE_SECONDS"),
+        _conf("MAX_HOSTS"),
+        _conf("MAX_PER_HOST"),
+    )
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> UpstreamPool:
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = _from_settings(UpstreamPool)
+    return _pool
+
+
+_async_pools = {}  # event loop -> AsyncUpstreamPool
+
+
+def get_async_pool() -> AsyncUpstreamPool:
+    """目前 event loop 專用的上游連線池"""
+    loop = asyncio.get_running_loop()
+    pool = _async_pools.get(loop)
+    if pool is None:
+        for old in [lp for lp in _async_pools if lp.is_closed()]:
+            del _async_pools[old]  # 已結束的 loop（測試 / 重啟）
+        pool = _async_pools[loop] = _from_settings(AsyncUpstreamPool)
+    return pool
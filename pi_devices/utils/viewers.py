@@ -0,0 +1,191 @@
+# pi_devices/utils/viewers.py
+# -*- coding: utf-8 -*-
+"""
+依觀看者自動開關攝影機
+
+- on_viewer(serial)：已登入、看得到該裝置的使用者在看直播（live_source 與
+  live_player 的 keepalive 呼叫）；記下最後觀看時間，前 IDLE_SECONDS 秒都沒人看
+  （冷啟動）就排一筆 camera_start，START_COOLDOWN 秒內不重複排
+- hls_proxy 不驗證身分，只讀 starting()，不會叫醒攝影機
+- sweep()：背景執行緒每隔幾秒檢查，超過 IDLE_SECONDS 沒人看就排 camera_stop
+- starting(serial)：剛排了 camera_start、Pi 還沒產生 playlist，
+  hls_proxy 用它回 503 + Retry-After，讓 player 很快重試而不是當成錯誤
+
+最後觀看時間寫在 Django cache，同一行程每 TOUCH_INTERVAL 秒最多寫一次；
+每個行程只巡自己看過的裝置，停之前會再看 cache 有沒有別的 worker 記到觀看。
+所以多 worker 部署時 CACHE 一定要是共用的 cache（settings.REDIS_URL），
+HOMEPI_WORKERS > 1 而 CACHE 是行程內 cache 時 manage.py check 會報錯（pi_devices.E001）。
+設定見 settings.HLS_ON_DEMAND。
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+CACHE_PREFIX = "homepi:viewers:"
+
+DEFAULTS = {
+    "ENABLED": True,
+    "IDLE_SECONDS": 60,
+    "START_COOLDOWN": 20,
+    "TOUCH_INTERVAL": 1,
+    "CACHE": "default",
+}
+
+
+def _conf(key):
+    return (getattr(settings, "HLS_ON_DEMAND", None) or {}).get(key, DEFAULTS[key])
+
+
+def _cache():
+    from django.core.cache import caches
+
+    return caches[_conf("CACHE")]
+
+
+def _queue(serial: str, command: str) -> bool:
+    from django.db.models import Q
+
+    from ..models import Device
+    from ..views.api import _queue_command
+
+    device = Device.objects.filter(serial_number__iexact=serial).first()
+    if device is None:
+        return False
+    # 帶上攝影機能力的 slug（和 capability_action 一樣），command_coalesce 才會把
+    # 觀看者排的 start/stop 和使用者按的當成同一個目標，只留最新的一筆
+    slug = (
+        device.capabilities.filter(Q(kind__icontains="camera") | Q(kind="cam"))
+        .order_by("order", "id")
+        .values_list("slug", flat=True)
+        .first()
+    )
+    payload = {"reason": "viewers"}
+    if slug:
+        payload.update(target=slug, slug=slug)
+    _queue_command(device, command, payload)
+    return True
+
+
+_lock = threading.Lock()
+_watched: dict[str, float] = {}  # 序號 -> 本行程最後一次寫 cache 的時間
+_sweeper: threading.Thread | None = None
+
+
+def due(serial: str, now: float | None = None) -> bool:
+    """本行程距離上次記錄已超過 TOUCH_INTERVAL（純記憶體，async view 可直接呼叫）"""
+    if not _conf("ENABLED"):
+        return False
+    now = time.time() if now is None else now
+    last = _watched.get(serial.upper())
+    return last is None or now - last >= float(_conf("TOUCH_INTERVAL"))
+
+
+def on_viewer(serial: str, now: float | None = None) -> bool:
+    """記錄一次觀看（呼叫端要先確認使用者看得到這台）；冷啟動時排 camera_start 並回傳 True"""
+    if not due(serial, now):
+        return False
+    serial = serial.upper()
+    now = time.time() if now is None else now
+    cache = _cache()
+    idle = float(_conf("IDLE_SECONDS"))
+    last = cache.get(f"{CACHE_PREFIX}seen:{serial}")
+    # 過期時間留一倍餘裕，sweep 才看得到「多久沒人看」
+    cache.set(f"{CACHE_PREFIX}seen:{serial}", now, timeout=idle * 2)
+    with _lock:
+        _watched[serial] = now
+    _ensure_sweeper()
+
+    if last is not None and now - last < idle:
+        return False
+    cooldown = float(_conf("START_COOLDOWN"))
+    if not cache.add(f"{CACHE_PREFIX}starting:{serial}", now, timeout=cooldown):
+        return False  # 別的請求 / worker 剛排過
+    cache.delete(f"{CACHE_PREFIX}stopping:{serial}")
+    try:
+        started = _queue(serial, "camera_start")
+    except Exception as e:
+        logger.warning(f"camera_start for {serial} failed: {e}")
+        return False
+    if started:
+        logger.info(f"viewer arrived, camera_start queued for {serial}")
+    return started
+
+
+def starting(serial: str) -> bool:
+    """剛因觀看者排了 camera_start、還在冷啟動期間"""
+    if not _conf("ENABLED"):
+        return False
+    return _cache().get(f"{CACHE_PREFIX}starting:{serial.upper()}") is not None
+
+
+def sweep(now: float | None = None) -> list[str]:
+    """閒置超過 IDLE_SECONDS 的裝置排 camera_stop，回傳這次停掉的序號"""
+    now = time.time() if now is None else now
+    idle = float(_conf("IDLE_SECONDS"))
+    cache = _cache()
+    with _lock:
+        candidates = [s for s, t in _watched.items() if now - t >= idle]
+    stopped = []
+    for serial in candidates:
+        last = cache.get(f"{CACHE_PREFIX}seen:{serial}")
+        if last is not None and now - last < idle:
+            continue  # 其他 worker 還有人在看
+        with _lock:
+            _watched.pop(serial, None)
+        if last is None:
+            continue  # 別的 worker 已經停掉（停的時候會刪 seen）
+        # 只讓一個 worker 排 camera_stop；下一個 viewer 進來會重新冷啟動
+        cooldown = float(_conf("START_COOLDOWN"))
+        if not cache.add(f"{CACHE_PREFIX}stopping:{serial}", now, timeout=cooldown):
+            continue
+        cache.delete_many(
+            [f"{CACHE_PREFIX}seen:{serial}", f"{CACHE_PREFIX}starting:{serial}"]
+        )
+        try:
+            if _queue(serial, "camera_stop"):
+                stopped.append(serial)
+                logger.info(f"no viewers for {idle:.0f}s, camera_stop for {serial}")
+        except Exception as e:
+            logger.warning(f"camera_stop for {serial} failed: {e}")
+    return stopped
+
+
+def _sweep_loop():
+    while True:
+        time.sleep(max(1.0, min(10.0, float(_conf("IDLE_SECONDS")) / 4)))
+        try:
+            sweep()
+        except Exception as e:
+            logger.warning(f"viewer sweep failed: {e}")
+        finally:
+            from django.db import close_old_connections
+
+            close_old_connections()
+
+
+def _ensure_sweeper() -> None:
+    global _sweeper
+    if _sweeper is not None:
+        return
+    with _lock:
+        if _sweeper is None:
+            _sweeper = threading.Thread(
+                target=_sweep_loop, name="hls-viewers", daemon=True
+            )
+            _sweeper.start()
+
+
+def stats(now: float | None = None) -> dict:
+    """本行程追蹤中的裝置與距離上次觀看的秒數"""
+    now = time.time() if now is None else now
+    with _lock:
+        return {s: round(now - t, 1) for s, t in _watched.items()}
+
+
+def reset() -> None:
+    with _lock:
+        _watched.clear()
@@ -1,7 +1,9 @@
 # pi_devices/views/api.py
 # -*- coding: utf-8 -*-
 import os
+import functools
 import json, time
+import hashlib
 from datetime import timedelta
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST, require_GET, require_http_methods
@@ -15,15 +17,32 @@ from django.http import (
     HttpResponseForbidden,
 )
 from django.utils import timezone
-from django.db import transaction
+from django.db import connection, transaction
 from django.conf import settings
 from django.utils.text import slugify
 import requests
 from django.http import Http404
-from django.db.models import Q
+from django.db.models import F, Q, Window
+from django.db.models.fields.json import KT
+from django.db.models.functions import RowNumber
 from django.shortcuts import get_object_or_404
+from django.urls import reverse
 from django.contrib.auth.decorators import login_required
+from django.contrib.admin.views.decorators import staff_member_required
 from ..models import Device, DeviceCommand, DeviceCapability, DeviceSchedule
+from ..utils import (
+    command_coalesce,
+    command_signal,
+    device_auth,
+    heartbeat,
+    hls_cache,
+    hls_sign,
+    metrics_rollup,
+    presence,
+    protocol,
+    upstream_pool,
+    viewers,
+)
 from notifications.services import notify_device_ip_changed, notify_user_online
 from django.utils.encoding import iri_to_uri
 import re
@@ -33,7 +52,9 @@ from django.utils import timezone as djtz
 from groups.models import Group
 from django.views.decorators.cache import never_cache
 from HomePiWeb.mongo import device_ping_logs
+from HomePiWeb.mongo_writer import get_ping_log_writer
 from django.utils.timezone import localtime, is_naive, make_aware
+from django.utils.dateparse import parse_datetime
 from datetime import datetime, timezone as dt_timezone
 import logging
 
@@ -63,15 +84,25 @@ def _queue_command(device: Device, command: str, payload: dict | None = None) ->
     for _ in range(6):
         req_id = _gen_req_id()
         try:
-            cmd = DeviceCommand.objects.create(
-                device=device,
-                req_id=req_id,  # ← 明確指定，不依賴模型 default
-                command=command,
-                payload=payload or {},
-                status="pending",
-                created_at=now,
-                expires_at=expires_at,
-            )
+            with transaction.atomic():
+                # 先鎖 Device 列，同一台的入列依序進行；只鎖 pending 列擋不住
+                # 兩個請求同時看到「沒有 pending」再各自插入
+                Device.objects.select_for_update().only("id").get(pk=device.pk)
+                # 同能力還沒被取走的指令先合併（可能改寫指令或直接記成 superseded）
+                final, status = command_coalesce.coalesce(device, command, payload)
+                cmd = DeviceCommand.objects.create(
+                    device=device,
+                    req_id=req_id,  # ← 明確指定，不依賴模型 default
+                    command=final,
+                    payload=payload or {},
+                    status=status,
+                    created_at=now,
+                    expires_at=expires_at,
+                    done_at=now if status == "superseded" else None,
+                )
+            if status == "pending":
+                # commit 後喚醒正在 device_pull 等待的長輪詢
+                transaction.on_commit(lambda: command_signal.notify(device.pk))
             return cmd.req_id
         except IntegrityError:
             continue  # 罕見碰撞，換一個 req_id 再試
@@ -85,11 +116,12 @@ def sync_caps(device, caps: list[dict], auto_disable_unseen: bool = False) -> in
     依據裝置回報的 capabilities（list of dict）做 upsert：
       key = (slug)（你模型 unique_together 已是 (device, slug)）
       欄位：kind/name/config/order/enabled
+    新增一次 bulk_create、變更一次 bulk_update，能力數量多也是固定幾條 SQL。
     回傳：此次處理的項目數（含 create/update）
     """
     current = {c.slug: c for c in device.capabilities.all()}
     seen = set()
-    changed = 0
+    to_create, to_update = [], []
 
     for item in caps:
         if not isinstance(item, dict):
@@ -101,6 +133,8 @@ def sync_caps(device, caps: list[dict], auto_disable_unseen: bool = False) -> in
         order = int(item.get("order") or 0)
         enabled = bool(item.get("enabled", True))
 
+        if slug in seen:
+            continue  # 同一份清單重複的 slug 只取第一筆
         seen.add(slug)
 
         if slug in current:
@@ -122,241 +156,346 @@ def sync_caps(device, caps: list[dict], auto_disable_unseen: bool = False) -> in
                 obj.enabled = enabled
                 dirty = True
             if dirty:
-                obj.save()
-                changed += 1
+                to_update.append(obj)
         else:
-            DeviceCapability.objects.create(
-                device=device,
-                kind=kind,
-                name=name,
-                slug=slug,
-                config=config,
-                order=order,
-                enabled=enabled,
+            to_create.append(
+                DeviceCapability(
+                    device=device,
+                    kind=kind,
+                    name=name,
+                    slug=slug,
+                    config=config,
+                    order=order,
+                    enabled=enabled,
+                )
             )
-            changed += 1
 
     if auto_disable_unseen:
         for slug, obj in current.items():
             if slug not in seen and obj.enabled:
                 obj.enabled = False
-                obj.save(update_fields=["enabled"])
-                changed += 1
+                to_update.append(obj)
+
+    if to_create:
+        DeviceCapability.objects.bulk_create(to_create)
+    if to_update:
+        DeviceCapability.objects.bulk_update(
+            to_update, ["kind", "name", "config", "order", "enabled"]
+        )
+    return len(to_create) + len(to_update)
+
+
+def _merge_state_map(by_slug: dict, state_map: dict, dirty: dict) -> None:
+    """
+    把 {slug: state} 淺合併進 by_slug 內各能力的 cached_state（只改記憶體），
+    有變動的能力放進 dirty（pk -> cap），由呼叫端一次 bulk_update。
+    """
+    for slug, st in state_map.items():
+        cap = by_slug.get(slug)
+        if not cap or not isinstance(st, dict):
+            continue
+        merged = cap.cached_state if isinstance(cap.cached_state, dict) else {}
+        merged = merged.copy()
+        merged.update(st)
+        cap.cached_state = merged
+        dirty[cap.pk] = cap
+
+
+# PostgreSQL：一條 UPDATE … RETURNING 完成「挑最舊 pending + 標成 taken」
+# 子查詢走 devcmd_pending_idx；SKIP LOCKED 讓同一台裝置的並行 pull 不互等
+_CLAIM_SQL = """
+UPDATE {table} SET status = 'taken', taken_at = %s
+WHERE id IN (
+    SELECT id FROM {table}
+    WHERE device_id = %s AND status = 'pending' AND expires_at > %s
+    ORDER BY created_at
+    LIMIT %s
+    FOR UPDATE SKIP LOCKED
+)
+RETURNING *
+"""
 
-    return changed
+
+def _claim_commands(device: Device, limit: int = 1) -> list[DeviceCommand]:
+    """
+    依建立順序取出該裝置最舊的 limit 筆 pending 指令並標成 taken。
+    過期的 pending 不會被取走；把它們標成 expired 交給 reap_device_commands。
+    """
+    now = timezone.now()
+    if connection.vendor == "postgresql":
+        sql = _CLAIM_SQL.format(table=DeviceCommand._meta.db_table)
+        cmds = list(DeviceCommand.objects.raw(sql, [now, device.pk, now, limit]))
+        # RETURNING 不保證順序
+        return sorted(cmds, key=lambda c: c.created_at)
+
+    with transaction.atomic():
+        cmds = list(
+            DeviceCommand.objects.select_for_update(skip_locked=True)
+            .filter(device=device, status="pending", expires_at__gt=now)
+            .order_by("created_at")[:limit]
+        )
+        if cmds:
+            DeviceCommand.objects.filter(pk__in=[c.pk for c in cmds]).update(
+                status="taken", taken_at=now
+            )
+        return cmds
+
+
+def _pull_limit(data: dict) -> int | None:
+    """agent 有帶 max_batch 才回批次格式；回傳 None 代表舊版單筆格式"""
+    raw = data.get("max_batch")
+    if raw is None:
+        return None
+    try:
+        n = int(raw)
+    except (TypeError, ValueError):
+        n = 1
+    cap = int(getattr(settings, "DEVICE_COMMAND_MAX_BATCH", 10))
+    return max(1, min(n, cap))
+
+
+def _max_wait(data: dict) -> float:
+    """長輪詢等待秒數：agent 帶的 max_wait 夾在 0 ~ 上限之間；沒帶或不是數字用上限"""
+    cap = float(getattr(settings, "DEVICE_COMMAND_MAX_WAIT_SECONDS", 20))
+    try:
+        n = float(data.get("max_wait") or cap)
+    except (TypeError, ValueError):
+        return cap
+    if n != n:  # NaN
+        return cap
+    return max(0.0, min(n, cap))
+
+
+def _pull_response(cmds: list[DeviceCommand], batch: int | None) -> JsonResponse:
+    items = [{"cmd": c.command, "req_id": c.req_id, "payload": c.payload} for c in cmds]
+    if batch is None:
+        return JsonResponse(items[0])
+    return JsonResponse({"cmds": items})
 
 
 # ---------- APIs ----------
 @csrf_exempt
 @require_POST
 def device_ping(request):
-    body = request.body.decode("utf-8") if request.body else ""
-    if not body:
-        return JsonResponse({"error": "Empty body"}, status=400)
-    try:
-        data = json.loads(body)
-    except json.JSONDecodeError:
-        return JsonResponse({"error": "Invalid JSON"}, status=400)
+    data, err = _load_ping_data(request)
+    if err:
+        return err
+    return _ping_device(data, _client_ip(request))
 
-    serial = data.get("serial_number")
-    token = data.get("token")
-    if not serial:
-        return JsonResponse({"error": "No serial_number"}, status=400)
-    if not token:
-        return JsonResponse({"error": "No token"}, status=401)
 
-    # 允許 agent 以頂層或 extra 帶更多資訊
-    extra = data.get("extra") or {}
-    caps = data.get("caps") or extra.get("caps")
-    state_map = data.get("state") or extra.get("state")
+def _load_ping_data(request):
+    """解析 ping body；回傳 (data, error_response)"""
+    if not request.body:
+        return None, JsonResponse({"error": "Empty body"}, status=400)
+    data, err = protocol.decode_request(request)
+    if err:
+        return None, err
+
+    if not data.get("serial_number"):
+        return None, JsonResponse({"error": "No serial_number"}, status=400)
+    if not data.get("token"):
+        return None, JsonResponse({"error": "No token"}, status=401)
+    return data, None
+
 
+def _client_ip(request) -> str:
     xff = request.META.get("HTTP_X_FORWARDED_FOR")
-    # client_ip = xff.split(",")[0].strip() if xff else request.META.get("REMOTE_ADDR")
-    client_ip = (
+    return (
         xff.split(",")[0].strip() if xff else request.META.get("REMOTE_ADDR")
     ) or ""
 
-    try:
-        with transaction.atomic():
-            device = (
-                Device.objects.select_for_update()
-                .only(
-                    "id", "serial_number", "token", "ip_address", "user_id", "last_ping"
-                )
-                .get(serial_number=serial)
-            )
-            if device.token != token:
-                return JsonResponse({"error": "Unauthorized"}, status=401)
-
-            owner_id = device.user_id
-            now = timezone.now()
-            window = getattr(settings, "DEVICE_ONLINE_WINDOW_SECONDS", 60)
-            threshold = now - timedelta(seconds=window)
-
-            was_online = False
-            if owner_id:
-                was_online = bool(device.last_ping and device.last_ping >= threshold)
-                if not was_online:
-                    was_online = (
-                        Device.objects.filter(
-                            user_id=owner_id, last_ping__gte=threshold
-                        )
-                        .exclude(pk=device.pk)
-                        .exists()
-                    )
-
-            old_ip = device.ip_address or None
-            ip_changed = old_ip != client_ip
-
-            # 更新心跳/IP
-            device.last_ping = now
-            device.ip_address = client_ip
-            device.save(update_fields=["last_ping", "ip_address"])
-
-            # (1) upsert capabilities（若有帶）
-            if isinstance(caps, list) and caps:
-                sync_caps(device, caps, auto_disable_unseen=False)
-            print(f"[DEBUG] device_ack merge state_map={state_map}")
-            # (2) merge 即時狀態到 cached_state（若有帶）
-            if isinstance(state_map, dict) and state_map:
-                # 先檢查模型是否真的有 cached_state 欄位；沒有就整段跳過（避免 500）
-                try:
-                    has_cached_state = any(
-                        f.name == "cached_state"
-                        for f in DeviceCapability._meta.get_fields()
-                    )
-                except Exception:
-                    has_cached_state = False
-
-                if has_cached_state:
-                    slugs = list(state_map.keys())
-                    if slugs:
-                        cap_qs = DeviceCapability.objects.filter(
-                            device=device, slug__in=slugs
-                        )
-                        cap_by_slug = {c.slug: c for c in cap_qs}
-
-                        def _as_dict(v):
-                            return v if isinstance(v, dict) else {}
-
-                        for slug, st in state_map.items():
-                            cap = cap_by_slug.get(slug)
-                            if not cap or not isinstance(st, dict):
-                                continue
-                            merged = _as_dict(getattr(cap, "cached_state", {}))
-                            # 嘗試淺合併；不可序列化或型別錯誤則略過該 slug
-                            try:
-                                merged.update({k: v for k, v in st.items()})
-                            except Exception:
-                                continue
-                            try:
-                                cap.cached_state = merged
-                                cap.save(update_fields=["cached_state"])
-                            except Exception:
-                                # 欄位存在但 DB 層出錯（例如 migration 未套用），也不要讓整個 ping 失敗
-                                pass
-                else:
-                    # 欄位不存在：什麼都不做（避免 500）
-                    pass
-
-            # 上線/變更 IP 通知（照原邏輯）
-            if owner_id and not was_online:
-                from django.contrib.auth import get_user_model
-
-                User = get_user_model()
-                subject_user = User.objects.filter(pk=owner_id).first()
-                if subject_user:
-                    transaction.on_commit(lambda: notify_user_online(user=subject_user))
-
-            if ip_changed and owner_id:
-                transaction.on_commit(
-                    lambda: notify_device_ip_changed(
-                        device=device,
-                        owner=device.user,  # 允許 lazy load
-                        old_ip=old_ip,
-                        new_ip=client_ip,
-                    )
-                )
 
-            # ⬇️ 新增：把心跳紀錄存到 MongoDB
-            try:
-                doc = {
-                    "device_id": str(device.pk),
-                    "ping_at": datetime.utcnow(),  # 用 UTC 確保時區一致
-                    "ip": client_ip,
-                    "status": "online",
-                }
+def caps_hash(caps: list) -> str:
+    """
+    能力清單的內容雜湊（與 pi_agent/utils/http.py::caps_hash 算法相同）。
+    Device.caps_hash 記最近一次同步的值，相同就不必重跑 sync_caps。
+    """
+    raw = json.dumps(caps, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
 
-                # 如果 extra 有 metrics，就加進去
-                if isinstance(extra.get("metrics"), dict):
-                    doc.update(extra["metrics"])
 
-                device_ping_logs.insert_one(doc)
+def _ping_device(data: dict, client_ip: str) -> JsonResponse:
+    """
+    device_ping 的主體（sync / async 版共用），data 已確認有 serial_number/token
+
+    每次心跳都 presence.touch（記憶體）；一般心跳的 last_ping 只交給 heartbeat 緩衝（不鎖列、不立即寫 DB）；
+    IP 變更、離線→上線、caps 變更才走 _ping_transition 鎖列寫入並發通知。
+
+    caps：agent 平常只帶 caps_hash；與 Device.caps_hash 不同時回 send_caps=True，
+    下一次 ping 才帶完整 caps 清單。
+    """
+    serial = data.get("serial_number")
+    token = data.get("token")
+
+    # v1 的 extra 已由 protocol.decode_request 攤平到頂層
+    caps = data.get("caps")
+    state_map = data.get("state")
+    reported_hash = data.get("caps_hash")
+
+    # 驗證走快取：一般心跳不查 Device 表（ip_address/caps_hash 也一併在快取內）
+    device, result = device_auth.authenticate(serial, token)
+    if result != device_auth.OK:
+        return _auth_error(result)
+
+    try:
+        now = timezone.now()
+        window = getattr(settings, "DEVICE_ONLINE_WINDOW_SECONDS", 60)
+        digest = None
+        if isinstance(caps, list) and caps:
+            digest = caps_hash(caps)
+            if digest == device.caps_hash:
+                digest = None  # 內容沒變，不用重跑 sync_caps
+        send_caps = bool(
+            reported_hash and not caps and reported_hash != device.caps_hash
+        )
+
+        # 在線判斷交給 presence（記憶體），touch 前先記下主人原本是否在線
+        online = device.is_online(window)
+        owner_was_online = bool(
+            device.user_id and presence.is_owner_online(device.user_id)
+        )
+        presence.touch(device.pk, device.user_id, now.timestamp())
+        transition = (
+            (device.ip_address or None) != client_ip
+            or not online
+            or digest is not None
+        )
+        if transition:
+            _ping_transition(device.pk, client_ip, caps, digest, now, owner_was_online)
+        else:
+            heartbeat.record(device.pk, now)
 
+        # merge 即時狀態到 cached_state（若有帶）
+        if isinstance(state_map, dict) and state_map:
+            try:
+                _merge_ping_state(device, state_map)
             except Exception as e:
-                import logging
+                # 狀態快取寫不進去不要讓整個 ping 失敗
+                logger.warning(f"merge ping state failed: {e}")
+
+        # ⬇️ 把心跳紀錄交給背景寫入器（批次 insert_many，不在請求內等 Mongo）
+        doc = {
+            "device_id": str(device.pk),
+            "ping_at": datetime.utcnow(),  # 用 UTC 確保時區一致
+            "ip": client_ip,
+            "status": "online",
+        }
 
-                logging.error(f"MongoDB insert error: {e}")
+        # 如果有帶 metrics，就加進去
+        if isinstance(data.get("metrics"), dict):
+            doc.update(data["metrics"])
+
+        get_ping_log_writer().submit(doc)
 
-    except Device.DoesNotExist:
-        return JsonResponse({"error": "Device not found"}, status=404)
     except Exception as e:
         return JsonResponse(
             {"error": f"server error: {type(e).__name__}: {e}"}, status=500
         )
 
-    # 回傳 pong 與目前 IP
-    return JsonResponse({"status": "pong", "ip": client_ip})
+    # 回傳 pong 與目前 IP；不認得 caps_hash 時請 agent 下次帶完整 caps
+    resp = {"status": "pong", "ip": client_ip, **protocol.capabilities()}
+    if send_caps:
+        resp["send_caps"] = True
+    return JsonResponse(resp)
+
+
+def _ping_transition(
+    device_id, client_ip, caps, digest, now, owner_was_online
+) -> None:
+    """狀態轉換的慢路徑：鎖 Device 列寫 last_ping/IP、同步 caps、發上線/變更 IP 通知"""
+    with transaction.atomic():
+        device = (
+            Device.objects.select_for_update()
+            .only(
+                "id", "serial_number", "token", "ip_address", "user_id", "last_ping"
+            )
+            .get(pk=device_id)
+        )
+        owner_id = device.user_id
+
+        old_ip = device.ip_address or None
+        ip_changed = old_ip != client_ip
+
+        # 更新心跳/IP
+        device.last_ping = now
+        device.ip_address = client_ip
+        fields = ["last_ping", "ip_address"]
+
+        # upsert capabilities（內容有變才會帶 digest 進來）
+        if digest is not None:
+            sync_caps(device, caps, auto_disable_unseen=False)
+            device.caps_hash = digest
+            fields.append("caps_hash")
+        device.save(update_fields=fields)
+
+        # 上線/變更 IP 通知（照原邏輯）
+        if owner_id and not owner_was_online:
+            from django.contrib.auth import get_user_model
+
+            User = get_user_model()
+            subject_user = User.objects.filter(pk=owner_id).first()
+            if subject_user:
+                transaction.on_commit(lambda: notify_user_online(user=subject_user))
+
+        if ip_changed and owner_id:
+            transaction.on_commit(
+                lambda: notify_device_ip_changed(
+                    device=device,
+                    owner=device.user,  # 允許 lazy load
+                    old_ip=old_ip,
+                    new_ip=client_ip,
+                )
+            )
+
+
+def _merge_ping_state(device: Device, state_map: dict) -> None:
+    """把 ping 帶來的 {slug: state} 淺合併進各能力的 cached_state（一次 bulk_update）"""
+    by_slug = {
+        c.slug: c
+        for c in DeviceCapability.objects.filter(
+            device=device, slug__in=list(state_map)
+        ).only("id", "slug", "cached_state")
+    }
+    dirty = {}
+    _merge_state_map(by_slug, state_map, dirty)
+    if dirty:
+        DeviceCapability.objects.bulk_update(list(dirty.values()), ["cached_state"])
 
 
 @csrf_exempt
 @require_POST
 def device_pull(request):
-    try:
-        data = json.loads(request.body.decode("utf-8"))
-    except Exception:
-        return JsonResponse({"error": "Invalid JSON"}, status=400)
+    data, err = protocol.decode_request(request)
+    if err:
+        return err
 
     serial = data.get("serial_number")
     token = data.get("token")
-    max_wait = int(
-        data.get("max_wait") or getattr(settings, "DEVICE_COMMAND_MAX_WAIT_SECONDS", 20)
-    )
+    max_wait = _max_wait(data)
     if not serial or not token:
         return JsonResponse({"error": "serial_number/token required"}, status=400)
 
-    try:
-        device = Device.objects.only("id", "serial_number", "token").get(
-            serial_number=serial
-        )
-    except Device.DoesNotExist:
-        return JsonResponse({"error": "Device not found"}, status=404)
-    if device.token != token:
-        return JsonResponse({"error": "Unauthorized"}, status=401)
+    device, result = device_auth.authenticate(serial, token)
+    if result != device_auth.OK:
+        return _auth_error(result)
 
-    deadline = time.time() + max_wait
+    # 查不到指令就等 _queue_command 的通知；保底每 recheck 秒重查一次（跨行程漏接時）
+    recheck = float(getattr(settings, "DEVICE_COMMAND_RECHECK_SECONDS", 5))
+    deadline = time.monotonic() + max_wait
+    batch = _pull_limit(data)
     while True:
-        with transaction.atomic():
-            now = timezone.now()
-            DeviceCommand.objects.filter(
-                device=device, status="pending", expires_at__lte=now
-            ).update(status="expired")
-            cmd = (
-                DeviceCommand.objects.select_for_update(skip_locked=True)
-                .filter(device=device, status="pending", expires_at__gt=now)
-                .order_by("created_at")
-                .first()
-            )
-            if cmd:
-                cmd.status = "taken"
-                cmd.taken_at = now
-                cmd.save(update_fields=["status", "taken_at"])
-                return JsonResponse(
-                    {"cmd": cmd.command, "req_id": cmd.req_id, "payload": cmd.payload}
-                )
-        if time.time() >= deadline:
+        since = command_signal.version(device.pk)
+        cmds = _claim_commands(device, batch or 1)
+        if cmds:
+            return _pull_response(cmds, batch)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return HttpResponse(status=204)
+        woke = command_signal.wait(
+            device.pk, since, min(remaining, recheck) if recheck > 0 else remaining
+        )
+        if not woke and time.monotonic() >= deadline:
             return HttpResponse(status=204)
-        time.sleep(0.2)
 
 
 # views/api.py
@@ -375,76 +514,97 @@ from pi_devices.models import Device, DeviceCapability, DeviceCommand
 @csrf_exempt
 @require_POST
 def device_ack(request):
-    try:
-        data = json.loads(request.body.decode("utf-8"))
-    except Exception:
-        return JsonResponse({"error": "Invalid JSON"}, status=400)
+    data, err = protocol.decode_request(request)
+    if err:
+        return err
 
     serial = data.get("serial_number")
     token = data.get("token")
     req_id = data.get("req_id")
-    ok = bool(data.get("ok"))
-    error = data.get("error") or ""
-    state_map = data.get("state")  # ★ agent 可帶回即時 state
 
     if not serial or not token or not req_id:
         return JsonResponse(
             {"error": "serial_number/token/req_id required"}, status=400
         )
 
-    try:
-        device = Device.objects.only("id", "serial_number", "token").get(
-            serial_number=serial
-        )
-    except Device.DoesNotExist:
-        return JsonResponse({"error": "Device not found"}, status=404)
+    device, result = device_auth.authenticate(serial, token)
+    if result != device_auth.OK:
+        return _auth_error(result)
+
+    return _ack_command(device, data)
 
-    if device.token != token:
-        return JsonResponse({"error": "Unauthorized"}, status=401)
 
-    from django.utils import timezone as djtz
+def _ack_command(device: Device, data: dict) -> JsonResponse:
+    """device_ack 的主體（sync / async 版共用），device 已通過驗證"""
+    _apply_acks(device, [data])
+    return JsonResponse({"ok": True})
+
+
+LOCKER_COMMANDS = ("locker_lock", "locker_unlock", "locker_toggle")
+
+
+def _apply_acks(device: Device, acks: list[dict]) -> int:
+    """
+    在同一個交易內套用多筆 ack：
+      - 指令狀態 done/failed（一次 bulk_update）
+      - 依序合併每筆 ack 帶回的 state 到 cached_state（每個 capability 只寫一次）
+    每筆 ack：{"req_id", "ok", "error", "state"}；回傳實際更新的指令數
+    """
+    acks = [a for a in acks if isinstance(a, dict) and a.get("req_id")]
+    if not acks:
+        return 0
 
     with transaction.atomic():
         # --- 更新指令狀態 ---
-        cmd = (
-            DeviceCommand.objects.select_for_update()
-            .filter(device=device, req_id=req_id)
-            .first()
-        )
-        if cmd and cmd.status not in ("done", "failed", "expired"):
-            cmd.status = "done" if ok else "failed"
-            cmd.error = "" if ok else (error or "unknown")
-            cmd.done_at = djtz.now()
-            cmd.save(update_fields=["status", "error", "done_at"])
-
-        # --- 合併 agent 回傳的 state ---
-        if isinstance(state_map, dict) and state_map:
-            slugs = list(state_map.keys())
-            caps = DeviceCapability.objects.filter(device=device, slug__in=slugs)
-            by_slug = {c.slug: c for c in caps}
-            for slug, st in state_map.items():
-                cap = by_slug.get(slug)
-                if not cap or not isinstance(st, dict):
-                    continue
-                merged = (cap.cached_state or {}).copy()
-                merged.update(st)
-                cap.cached_state = merged
-                cap.save(update_fields=["cached_state"])
-
-        # --- Fallback：若沒有 state_map，也針對 locker 指令補上狀態 ---
-        if (
-            not state_map
-            and cmd
-            and cmd.command
-            in (
-                "locker_lock",
-                "locker_unlock",
-                "locker_toggle",
+        cmds = {
+            c.req_id: c
+            for c in DeviceCommand.objects.select_for_update().filter(
+                device=device, req_id__in=[a["req_id"] for a in acks]
             )
-        ):
-            slug = (cmd.payload or {}).get("slug")
-            if slug:
-                cap = DeviceCapability.objects.filter(device=device, slug=slug).first()
+        }
+        now = djtz.now()
+        finished = []
+        for a in acks:
+            cmd = cmds.get(a["req_id"])
+            if cmd and cmd.status not in ("done", "failed", "expired"):
+                ok = bool(a.get("ok"))
+                cmd.status = "done" if ok else "failed"
+                cmd.error = "" if ok else (a.get("error") or "unknown")
+                cmd.done_at = now
+                finished.append(cmd)
+        if finished:
+            DeviceCommand.objects.bulk_update(finished, ["status", "error", "done_at"])
+
+        # --- 找出要動到的 capability，一次撈回 ---
+        slugs = set()
+        for a in acks:
+            state_map = a.get("state")  # ★ agent 可帶回即時 state
+            cmd = cmds.get(a["req_id"])
+            if isinstance(state_map, dict) and state_map:
+                slugs.update(state_map.keys())
+            elif cmd and cmd.command in LOCKER_COMMANDS:
+                slug = (cmd.payload or {}).get("slug")
+                if slug:
+                    slugs.add(slug)
+        if not slugs:
+            return len(finished)
+
+        by_slug = {
+            c.slug: c
+            for c in DeviceCapability.objects.filter(device=device, slug__in=slugs)
+        }
+        dirty = {}
+        for a in acks:
+            state_map = a.get("state")
+            cmd = cmds.get(a["req_id"])
+
+            # --- 合併 agent 回傳的 state ---
+            if isinstance(state_map, dict) and state_map:
+                _merge_state_map(by_slug, state_map, dirty)
+
+            # --- Fallback：若沒有 state_map，也針對 locker 指令補上狀態 ---
+            elif cmd and cmd.command in LOCKER_COMMANDS:
+                cap = by_slug.get((cmd.payload or {}).get("slug"))
                 if cap:
                     merged = (cap.cached_state or {}).copy()
                     if cmd.command == "locker_toggle":
@@ -454,9 +614,36 @@ def device_ack(request):
                         merged["locked"] = cmd.command == "locker_lock"
                     merged["last_change_ts"] = int(time.time())
                     cap.cached_state = merged
-                    cap.save(update_fields=["cached_state"])
+                    dirty[cap.pk] = cap
 
-    return JsonResponse({"ok": True})
+        if dirty:
+            DeviceCapability.objects.bulk_update(list(dirty.values()), ["cached_state"])
+
+    return len(finished)
+
+
+@csrf_exempt
+@require_POST
+def device_ack_batch(request):
+    """
+    一次回報多筆指令結果：
+    {"serial_number", "token", "acks": [{"req_id", "ok", "error", "state"}, ...]}
+    """
+    data, err = protocol.decode_request(request)
+    if err:
+        return err
+
+    device, err = _auth_device(data)
+    if err:
+        return err
+    return _ack_batch(device, data)
+
+
+def _ack_batch(device: Device, data: dict) -> JsonResponse:
+    acks = data.get("acks")
+    if not isinstance(acks, list):
+        return JsonResponse({"error": "acks must be a list"}, status=400)
+    return JsonResponse({"ok": True, "acked": _apply_acks(device, acks)})
 
 
 # ---------- Camera control (live stream) ----------
@@ -489,21 +676,28 @@ def camera_action(request, serial: str, action: str):
 @require_GET
 def camera_status(request, serial: str):
     """
-    提供前端播放網址（以該裝置最近 ping 的 IP 推算 HLS 來源）。
+    提供前端播放網址：一律走 hls_proxy（由網站簽章向 Pi 要檔案）。
+    Pi 預設只收簽章網址，直接給 http://<ip>:8088/index.m3u8 會被擋。
     """
     try:
-        device = Device.objects.only("ip_address").get(serial_number=serial)
+        device = Device.objects.only("serial_number", "ip_address").get(
+            serial_number=serial
+        )
     except Device.DoesNotExist:
         return JsonResponse({"error": "Device not found"}, status=404)
 
     ip = device.ip_address or ""
-    hls_url = f"http://{ip}:8088/index.m3u8" if ip else ""
+    hls_url = (
+        request.build_absolute_uri(
+            reverse("hls_proxy", args=[device.serial_number, "index.m3u8"])
+        )
+        if ip
+        else ""
+    )
     return JsonResponse({"ok": True, "ip": ip, "hls_url": hls_url})
 
 
-# 代理 /hls/<serial>/<path> 到樹莓派 8088
-SESSION = requests.Session()
-TIMEOUT = (3, 15)  # connect, read
+# 代理 /hls/<serial>/<path> 到樹莓派 8088（連線走 upstream_pool，每台 Pi 各自 keep-alive）
 
 
 def _device_hls_base(device: Device, cap: DeviceCapability):
@@ -532,126 +726,273 @@ def _rewrite_m3u8(body: str, serial: str) -> str:
     return "\n".join(repl(l) for l in body.splitlines())
 
 
-@csrf_exempt
-@require_http_methods(["GET", "HEAD"])
-def hls_proxy(request, serial: str, subpath: str):
+def _hls_upstream(serial: str, name: str) -> str:
+    """序號 + 檔名 → 樹莓派上的簽章網址（快取沒命中時才會查 DB）"""
     device = (
-        Device.objects.filter(serial_number__iexact=serial).only("ip_address").first()
+        Device.objects.filter(serial_number__iexact=serial)
+        .only("serial_number", "token", "ip_address")
+        .first()
     )
+    return _upstream_url(device, name)
+
+
+def _upstream_url(device, name: str) -> str:
+    # Pi 預設只收簽章網址（serve_hls.py 的 HLS_REQUIRE_SIGNATURE），sync / async 版共用
     if not device or not device.ip_address:
-        return HttpResponseNotFound("device ip not found")
+        raise hls_cache.UpstreamError(404, "device ip not found")
+    name = iri_to_uri(name)
+    path = hls_sign.upstream_path(device.token, device.serial_number, name)
+    return f"http://{device.ip_address}:8088{path}"
 
-    base = f"http://{device.ip_address}:8088"
 
-    # ---- Playlist (.m3u8) ----
-    if subpath.endswith(".m3u8"):
-        upstream = f"{base}/{iri_to_uri(os.path.basename(subpath))}"
-        try:
-            r = requests.get(
-                upstream,
-                timeout=(3, 10),
-                allow_redirects=False,
-                headers={"Accept-Encoding": "identity"},
-            )
-        except requests.RequestException:
-            resp = HttpResponse("m3u8 upstream error", status=502)
-            resp["X-HLS-Proxy"] = "1"
-            resp["X-Upstream-Status"] = "CONN_ERR"
-            return resp
+def _playlist_key(request, name: str) -> str:
+    """
+    LL-HLS 阻塞式重新載入：_HLS_msn / _HLS_part 原樣轉給 Pi（只收整數），
+    並放進快取 key，等同一個小段的 viewer 共用同一次上游請求。
+    """
+    msn = request.GET.get("_HLS_msn", "")
+    if not msn.isdigit():
+        return name
+    key = f"{name}?_HLS_msn={int(msn)}"
+    part = request.GET.get("_HLS_part", "")
+    if part.isdigit():
+        key += f"&_HLS_part={int(part)}"
+    return key
+
+
+def _fetch_playlist(serial: str, name: str) -> hls_cache.CachedObject:
+    upstream = _hls_upstream(serial, name)
+    try:
+        r = upstream_pool.get_pool().get(
+            upstream,
+            timeout=(3, 10),
+            allow_redirects=False,
+            headers={"Accept-Encoding": "identity"},
+        )
+    except requests.RequestException:
+        raise hls_cache.UpstreamError(
+            502,
+            "m3u8 upstream error",
+            {"X-HLS-Proxy": "1", "X-Upstream-Status": "CONN_ERR"},
+        )
 
-        body_bytes = r.content or b""
-        try:
-            body_text = body_bytes.decode(r.encoding or "utf-8", "replace")
-        except Exception:
-            body_text = body_bytes.decode("utf-8", "replace")
+    obj = _playlist_object(serial, r.status_code, r.content, r.encoding)
+    # 背景預抓最新片段，player 接著要的時候直接命中快取
+    hls_cache.get_cache().prefetch(
+        serial,
+        hls_cache.playlist_segments(obj.body),
+        lambda n: functools.partial(_fetch_segment, serial, n),
+    )
+    return obj
 
-        if r.status_code != 200 or not body_text.strip():
-            resp = HttpResponse("m3u8 upstream error", status=502)
-            resp["X-HLS-Proxy"] = "1"
-            resp["X-Upstream-Status"] = str(r.status_code)
-            resp["X-Upstream-Len"] = str(len(body_bytes))
-            return resp
 
-        def rewrite(line: str) -> str:
-            t = line.strip()
-            if not t or t.startswith("#"):
-                return line
-            if t.endswith(".ts"):
-                name = os.path.basename(t)
-                return f"/hls/{serial}/{name}"
-            return line
+def _playlist_object(serial, status, body_bytes, encoding) -> hls_cache.CachedObject:
+    """上游 playlist 回應 → 改寫片段路徑後的快取物件（sync / async 版共用）"""
+    body_bytes = body_bytes or b""
+    try:
+        body_text = body_bytes.decode(encoding or "utf-8", "replace")
+    except Exception:
+        body_text = body_bytes.decode("utf-8", "replace")
 
-        out = "\n".join(rewrite(ln) for ln in body_text.splitlines()) + "\n"
-        resp = HttpResponse(out, content_type="application/vnd.apple.mpegurl")
-        resp["Cache-Control"] = "no-store"
-        resp["X-Accel-Buffering"] = "no"
-        resp["X-HLS-Proxy"] = "1"
-        resp["X-Upstream-Status"] = str(r.status_code)
-        resp["X-Upstream-Len"] = str(len(body_bytes))
-        resp["Content-Length"] = str(len(out.encode("utf-8")))
-        return resp
-
-    # ---- Segment (.ts)：保持你原來的處理，另外加上 X-HLS-Proxy ----
-    name = os.path.basename(subpath)
-    if not name.endswith(".ts"):
-        return HttpResponseNotFound("only ts allowed")
+    if status != 200 or not body_text.strip():
+        raise hls_cache.UpstreamError(
+            502,
+            "m3u8 upstream error",
+            {
+                "X-HLS-Proxy": "1",
+                "X-Upstream-Status": str(status),
+                "X-Upstream-Len": str(len(body_bytes)),
+            },
+        )
 
-    upstream = f"{base}/{iri_to_uri(name)}"
-    fwd_headers = {}
-    rng = request.headers.get("Range")
-    if rng:
-        fwd_headers["Range"] = rng
-    fwd_headers["Accept-Encoding"] = "identity"
+    def local(uri: str) -> str:
+        if uri.endswith(".ts"):
+            return f"/hls/{serial}/{os.path.basename(uri)}"
+        return uri
 
+    def rewrite(line: str) -> str:
+        t = line.strip()
+        if t.startswith(hls_cache.LL_URI_TAGS):
+            return hls_cache.URI_ATTR.sub(
+                lambda m: f'URI="{local(m.group(1))}"', line
+            )
+        if not t or t.startswith("#"):
+            return line
+        return local(t) if t.endswith(".ts") else line
+
+    out = "\n".join(rewrite(ln) for ln in body_text.splitlines()) + "\n"
+    return hls_cache.CachedObject(
+        out.encode("utf-8"),
+        "application/vnd.apple.mpegurl",
+        {
+            "X-Upstream-Status": str(status),
+            "X-Upstream-Len": str(len(body_bytes)),
+        },
+    )
+
+
+def _fetch_segment(serial: str, name: str) -> hls_cache.CachedObject:
+    # 一律抓整段（不轉送 Range），Range 由快取內容切
+    upstream = _hls_upstream(serial, name)
     try:
-        r = requests.request(
-            request.method,
+        r = upstream_pool.get_pool().get(
             upstream,
-            headers=fwd_headers,
-            stream=True,
+            headers={"Accept-Encoding": "identity"},
             timeout=(3, 20),
             allow_redirects=False,
+            max_bytes=hls_cache.max_segment_bytes(),
         )
+    except upstream_pool.BodyTooLarge as e:
+        raise _segment_too_large(e)
     except requests.RequestException:
-        return HttpResponseNotFound("upstream error")
+        raise hls_cache.UpstreamError(404, "upstream error")
 
-    if r.status_code in (200, 206):
-        ct = r.headers.get("Content-Type", "video/mp2t")
-        if request.method == "HEAD":
-            resp = HttpResponse(status=r.status_code, content_type=ct)
-        else:
-            resp = StreamingHttpResponse(
-                r.iter_content(64 * 1024), status=r.status_code, content_type=ct
-            )
-        for h in (
-            "Content-Length",
-            "Content-Range",
-            "Accept-Ranges",
-            "Last-Modified",
-            "ETag",
-        ):
-            if h in r.headers:
-                resp[h] = r.headers[h]
-        resp["Cache-Control"] = "no-store"
-        resp["X-Accel-Buffering"] = "no"
-        resp["X-HLS-Proxy"] = "1"
-        return resp
-
-    if r.status_code == 416:
-        resp = HttpResponse(status=416)
-        if "Content-Range" in r.headers:
-            resp["Content-Range"] = r.headers["Content-Range"]
-        return resp
-
-    if r.status_code == 404:
-        return HttpResponseNotFound("ts not found")
-
-    resp = HttpResponse("upstream error", status=502)
-    resp["X-Upstream-Status"] = str(r.status_code)
+    return _segment_object(r.status_code, r.content, r.headers)
+
+
+def _segment_too_large(e: Exception) -> hls_cache.UpstreamError:
+    logger.warning(f"hls segment too large: {e}")
+    return hls_cache.UpstreamError(
+        502, "segment too large", {"X-Upstream-Status": "TOO_LARGE", "X-HLS-Proxy": "1"}
+    )
+
+
+def _segment_object(status, content, headers) -> hls_cache.CachedObject:
+    """上游片段回應 → 快取物件；非 200 丟 UpstreamError（sync / async 版共用）"""
+    if status == 200:
+        keep = {h: headers[h] for h in ("Last-Modified", "ETag") if h in headers}
+        return hls_cache.CachedObject(
+            content, headers.get("Content-Type", "video/mp2t"), keep
+        )
+    if status == 404:
+        raise hls_cache.UpstreamError(404, "ts not found")
+    raise hls_cache.UpstreamError(
+        502,
+        "upstream error",
+        {"X-Upstream-Status": str(status), "X-HLS-Proxy": "1"},
+    )
+
+
+def _byte_range(header: str, size: int):
+    """解析單一 Range（bytes=a-b / a- / -n），回傳 (start, end)；不支援的格式回 None"""
+    m = re.fullmatch(r"\s*bytes=(\d*)-(\d*)\s*", header or "")
+    if not m or (not m.group(1) and not m.group(2)):
+        return None
+    if m.group(1):
+        start = int(m.group(1))
+        end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+    else:
+        start, end = max(0, size - int(m.group(2))), size - 1
+    return start, end
+
+
+@csrf_exempt
+@require_http_methods(["GET", "HEAD"])
+def hls_proxy(request, serial: str, subpath: str):
+    """
+    /hls/<serial>/<檔名> → 樹莓派 8088。
+    經 hls_cache：同一台裝置的 playlist / 片段不論幾個人在看，上游只抓一次。
+    LL-HLS 的阻塞式重新載入（ll.m3u8?_HLS_msn=..）會在這裡等 Pi 回應，
+    viewer 多時建議走 ASGI 版（api_async.hls_proxy），等待時不佔執行緒。
+    """
+    cache = hls_cache.get_cache()
+    name = os.path.basename(subpath)
+
+    # ---- Playlist (.m3u8) ----
+    if subpath.endswith(".m3u8"):
+        key = _playlist_key(request, name)
+        try:
+            obj = cache.get_or_fetch(serial, key, lambda: _fetch_playlist(serial, key))
+        except hls_cache.UpstreamError as e:
+            if viewers.starting(serial):
+                return _cold_start_response()
+            return e.response()
+        except TimeoutError:
+            return HttpResponse("m3u8 upstream timeout", status=504)
+
+        return _playlist_response(obj)
+
+    # ---- Segment (.ts) ----
+    if not name.endswith(".ts"):
+        return HttpResponseNotFound("only ts allowed")
+
+    try:
+        obj, body = cache.read_or_fetch(
+            serial, name, lambda: _fetch_segment(serial, name)
+        )
+    except hls_cache.UpstreamError as e:
+        return e.response()
+    except TimeoutError:
+        return HttpResponse("ts upstream timeout", status=504)
+
+    return _segment_response(request, obj, body)
+
+
+def _cold_start_response() -> HttpResponse:
+    """攝影機剛被叫醒、Pi 還沒產生 playlist：請 player 一秒後再來"""
+    resp = HttpResponse("camera starting", status=503)
+    resp["Retry-After"] = "1"
+    resp["Cache-Control"] = "no-store"
     resp["X-HLS-Proxy"] = "1"
     return resp
 
 
+def _playlist_response(obj: hls_cache.CachedObject) -> HttpResponse:
+    body = obj.read()
+    resp = HttpResponse(body, content_type=obj.content_type)
+    resp["Cache-Control"] = "no-store"
+    resp["X-Accel-Buffering"] = "no"
+    resp["X-HLS-Proxy"] = "1"
+    for k, v in obj.headers.items():
+        resp[k] = v
+    resp["Content-Length"] = str(len(body))
+    return resp
+
+
+def _segment_response(
+    request, obj: hls_cache.CachedObject, body: bytes
+) -> HttpResponse:
+    """快取片段 → 回應；處理 Range（單一區段）與 HEAD。body 由 read_or_fetch 讀出"""
+    size = len(body)
+    status = 200
+    rng = _byte_range(request.headers.get("Range"), size)
+    if rng:
+        start, end = rng
+        if start >= size or start > end:
+            resp = HttpResponse(status=416)
+            resp["Content-Range"] = f"bytes */{size}"
+            return resp
+        body, status = body[start : end + 1], 206
+
+    resp = HttpResponse(
+        b"" if request.method == "HEAD" else body,
+        status=status,
+        content_type=obj.content_type,
+    )
+    if status == 206:
+        resp["Content-Range"] = f"bytes {start}-{end}/{size}"
+    resp["Content-Length"] = str(len(body))
+    resp["Accept-Ranges"] = "bytes"
+    for k, v in obj.headers.items():
+        resp[k] = v
+    resp["Cache-Control"] = "no-store"
+    resp["X-Accel-Buffering"] = "no"
+    resp["X-HLS-Proxy"] = "1"
+    return resp
+
+
+@staff_member_required
+def hls_cache_metrics(request):
+    """
+    HLS 代理快取狀態、各裝置命中率、上游連線池與觀看中的裝置（僅限 staff）
+    GET /admin/metrics/hls_cache/
+    """
+    data = hls_cache.get_cache().stats()
+    data["pool"] = upstream_pool.get_pool().stats()
+    data["viewers"] = viewers.stats()
+    return JsonResponse(data)
+
+
 # 狀態連動
 
 
@@ -666,6 +1007,106 @@ def _parse_gid(raw: str | None) -> int | None:
     return None
 
 
+# 排程動作 → 狀態欄位（燈：next_on/off；電子鎖：next_unlock/lock）
+_NEXT_FIELDS = {
+    "light": {"light_on": "next_on", "light_off": "next_off"},
+    "locker": {"locker_unlock": "next_unlock", "locker_lock": "next_lock"},
+}
+
+
+def _epoch(value) -> int | None:
+    """cached_state 的時間（datetime / 秒數）→ epoch 秒"""
+    if hasattr(value, "timestamp"):
+        try:
+            return int(value.timestamp())
+        except Exception:
+            return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    return None
+
+
+def _cap_state(cap: DeviceCapability) -> dict:
+    st = cap.cached_state or {}
+    return {
+        "id": cap.id,
+        "name": cap.name,
+        "kind": cap.kind,
+        "slug": cap.slug,
+        "light_is_on": bool(st.get("light_is_on", False)),
+        "auto_light_running": bool(st.get("auto_light_running", False)),
+        "last_lux": st.get("last_lux", None),
+        "locked": bool(st.get("locked", False)),
+        "auto_lock_running": bool(st.get("auto_lock_running", False)),
+        "is_streaming": bool(st.get("is_streaming", False)),
+        # 直播頁（live_player 會要簽章網址）；Pi 回報的原始 hls_url 不帶簽章，不再轉給前端
+        "live_url": (
+            reverse("cap_live_player", args=[cap.device_id, cap.id])
+            if cap.kind == "camera"
+            else None
+        ),
+        "last_change_ts": _epoch(st.get("last_change_ts", None)),
+    }
+
+
+def _next_schedules(caps, now) -> dict:
+    """
+    多個能力的下次排程時間，固定一次查詢：{cap.id: {"next_on": epoch, ...}}
+    PostgreSQL 用 DISTINCT ON 每個 (裝置, slug, 動作) 只取最早一筆；
+    其他資料庫用 ROW_NUMBER() 視窗函式做同樣的事。
+    """
+    wanted = [c for c in caps if c.kind in _NEXT_FIELDS]
+    out = {c.id: dict.fromkeys(_NEXT_FIELDS[c.kind].values()) for c in wanted}
+    if not wanted:
+        return out
+    actions = [a for c in wanted for a in _NEXT_FIELDS[c.kind]]
+    qs = DeviceSchedule.objects.filter(
+        device_id__in={c.device_id for c in wanted},
+        payload__slug__in={c.slug for c in wanted},
+        action__in=set(actions),
+        status="pending",
+        run_at__gt=now,
+    )
+    if connection.vendor == "postgresql":
+        qs = qs.order_by("device_id", "payload__slug", "action", "run_at").distinct(
+            "device_id", "payload__slug", "action"
+        )
+    else:
+        qs = qs.annotate(
+            rn=Window(
+                RowNumber(),
+                partition_by=[F("device_id"), KT("payload__slug"), F("action")],
+                order_by=F("run_at").asc(),
+            )
+        ).filter(rn=1)
+    by_key = {(c.device_id, c.slug): c for c in wanted}
+    for device_id, slug, action, run_at in qs.values_list(
+        "device_id", "payload__slug", "action", "run_at"
+    ):
+        cap = by_key.get((device_id, slug))
+        field = cap and _NEXT_FIELDS[cap.kind].get(action)
+        if field:
+            out[cap.id][field] = int(run_at.timestamp())
+    return out
+
+
+def _pending_caps(caps, now) -> set:
+    """還有未完成指令（pending / taken 且未過期）的能力 id，固定一次查詢"""
+    if not caps:
+        return set()
+    busy = set(
+        DeviceCommand.objects.filter(
+            device_id__in={c.device_id for c in caps},
+            status__in=["pending", "taken"],
+            expires_at__gt=now,
+            payload__slug__in={c.slug for c in caps},
+        )
+        .values_list("device_id", "payload__slug")
+        .distinct()
+    )
+    return {c.id for c in caps if (c.device_id, c.slug) in busy}
+
+
 @never_cache
 @login_required
 def api_device_status(request, device_id: int):
@@ -705,61 +1146,14 @@ def api_device_status(request, device_id: int):
         "server_ts": int(timezone.now().timestamp()),
     }
     
-    # 為每個能力獲取狀態
+    # 為每個能力獲取狀態；電子鎖的下次排程一次查完
+    capabilities = list(capabilities)
+    next_times = _next_schedules(
+        [c for c in capabilities if c.kind == "locker"], timezone.now()
+    )
     for cap in capabilities:
-        st = cap.cached_state or {}
-        
-        cap_status = {
-            "id": cap.id,
-            "name": cap.name,
-            "kind": cap.kind,
-            "slug": cap.slug,
-            "light_is_on": bool(st.get("light_is_on", False)),
-            "auto_light_running": bool(st.get("auto_light_running", False)),
-            "last_lux": st.get("last_lux", None),
-            "locked": bool(st.get("locked", False)),
-            "auto_lock_running": bool(st.get("auto_lock_running", False)),
-            "is_streaming": bool(st.get("is_streaming", False)),
-            "hls_url": st.get("hls_url", None),
-            "last_change_ts": st.get("last_change_ts", None),
-        }
-        
-        # 處理 last_change_ts
-        last_change_ts = cap_status["last_change_ts"]
-        if hasattr(last_change_ts, "timestamp"):
-            try:
-                cap_status["last_change_ts"] = int(last_change_ts.timestamp())
-            except Exception:
-                cap_status["last_change_ts"] = None
-        elif isinstance(last_change_ts, (int, float)):
-            cap_status["last_change_ts"] = int(last_change_ts)
-        else:
-            cap_status["last_change_ts"] = None
-        
-        # 查詢排程資訊（僅電子鎖）
-        if cap.kind == "locker":
-            from pi_devices.models import DeviceSchedule
-            now = timezone.now()
-            
-            unlock_schedule = DeviceSchedule.objects.filter(
-                device=device,
-                payload__slug=cap.slug,
-                action="locker_unlock",
-                status="pending",
-                run_at__gt=now
-            ).order_by('run_at').first()
-            
-            lock_schedule = DeviceSchedule.objects.filter(
-                device=device,
-                payload__slug=cap.slug,
-                action="locker_lock",
-                status="pending",
-                run_at__gt=now
-            ).order_by('run_at').first()
-            
-            cap_status["next_unlock"] = int(unlock_schedule.run_at.timestamp()) if unlock_schedule else None
-            cap_status["next_lock"] = int(lock_schedule.run_at.timestamp()) if lock_schedule else None
-        
+        cap_status = _cap_state(cap)
+        cap_status.update(next_times.get(cap.id, {}))
         device_status["capabilities"][cap.kind] = cap_status
     
     resp = JsonResponse(device_status)
@@ -793,175 +1187,162 @@ def api_cap_status(request, cap_id: int):
         if not visible:
             return HttpResponseForbidden("No permission")
 
-    st = cap.cached_state or {}
-    light_is_on = bool(st.get("light_is_on", False))
-    auto_running = bool(st.get("auto_light_running", False))
-    last_lux = st.get("last_lux", None)
-    last_change_ts = st.get("last_change_ts", None)
-
-    # 電子鎖狀態
-    locked = bool(st.get("locked", False))
-    auto_lock_running = bool(st.get("auto_lock_running", False))
-
-    # last_change_ts → 標準化成 epoch 秒
-    if hasattr(last_change_ts, "timestamp"):
-        try:
-            last_change_ts = int(last_change_ts.timestamp())
-        except Exception:
-            last_change_ts = None
-    elif isinstance(last_change_ts, (int, float)):
-        last_change_ts = int(last_change_ts)
-    else:
-        last_change_ts = None
-
     now = timezone.now()
-    pending = DeviceCommand.objects.filter(
-        device=cap.device,
-        status__in=["pending", "taken"],
-        expires_at__gt=now,
-        payload__slug=cap.slug,
-    ).exists()
-
-    # 查詢排程資訊
-    next_unlock = None
-    next_lock = None
-    next_on = None
-    next_off = None
-    
-    from pi_devices.models import DeviceSchedule
-    
-    if cap.kind == "locker":
-        # 查詢下次開鎖排程
-        unlock_schedule = DeviceSchedule.objects.filter(
-            device=cap.device,
-            payload__slug=cap.slug,
-            action="locker_unlock",
-            status="pending",
-            run_at__gt=now
-        ).order_by('run_at').first()
-        
-        # 查詢下次上鎖排程
-        lock_schedule = DeviceSchedule.objects.filter(
-            device=cap.device,
-            payload__slug=cap.slug,
-            action="locker_lock",
-            status="pending",
-            run_at__gt=now
-        ).order_by('run_at').first()
-        
-        
-        if unlock_schedule:
-            next_unlock = int(unlock_schedule.run_at.timestamp())
-        if lock_schedule:
-            next_lock = int(lock_schedule.run_at.timestamp())
-    
-    elif cap.kind == "light":
-        # 查詢下次開燈排程
-        on_schedule = DeviceSchedule.objects.filter(
-            device=cap.device,
-            payload__slug=cap.slug,
-            action="light_on",
-            status="pending",
-            run_at__gt=now
-        ).order_by('run_at').first()
-        
-        # 查詢下次關燈排程
-        off_schedule = DeviceSchedule.objects.filter(
-            device=cap.device,
-            payload__slug=cap.slug,
-            action="light_off",
-            status="pending",
-            run_at__gt=now
-        ).order_by('run_at').first()
-        
-        
-        if on_schedule:
-            next_on = int(on_schedule.run_at.timestamp())
-        if off_schedule:
-            next_off = int(off_schedule.run_at.timestamp())
-
+    state = _cap_state(cap)
     resp_data = {
         "ok": True,
         "device_name": cap.device.label,
-        "light_is_on": light_is_on,
-        "auto_light_running": auto_running,
-        "last_lux": last_lux,
-        "locked": locked,
-        "auto_lock_running": auto_lock_running,
-        "pending": pending,
-        "last_change_ts": last_change_ts,
+        "light_is_on": state["light_is_on"],
+        "auto_light_running": state["auto_light_running"],
+        "last_lux": state["last_lux"],
+        "locked": state["locked"],
+        "auto_lock_running": state["auto_lock_running"],
+        "pending": cap.id in _pending_caps([cap], now),
+        "last_change_ts": state["last_change_ts"],
         "server_ts": int(now.timestamp()),
     }
-    
-    # 添加排程資訊
-    if cap.kind == "locker":
-        resp_data["next_unlock"] = next_unlock
-        resp_data["next_lock"] = next_lock
-    elif cap.kind == "light":
-        resp_data["next_on"] = next_on
-        resp_data["next_off"] = next_off
+    # 排程資訊（燈：next_on/off；電子鎖：next_unlock/lock）
+    resp_data.update(_next_schedules([cap], now).get(cap.id, {}))
 
-    
     resp = JsonResponse(resp_data)
     resp["Cache-Control"] = "no-store"
     return resp
 
 
+_CAPS_STATUS_MAX = 200
+
+
+@never_cache
+@login_required
+def api_caps_status(request):
+    """
+    多個能力的狀態一次查完（首頁不用一個能力打一次 api_cap_status）
+    GET /api/caps/status/?cap_ids=1,2,3[&group_id=]   指定能力
+    GET /api/caps/status/?group_id=5                   群組內所有裝置的能力
+    權限與 api_cap_status 相同；查詢數固定，不隨能力數增加。
+    """
+    gid_raw = request.GET.get("group_id") or request.GET.get("g") or ""
+    gid = _parse_gid(gid_raw)
+    raw_ids = [x for x in (request.GET.get("cap_ids") or "").split(",") if x.strip()]
+    if not all(x.strip().isdigit() for x in raw_ids):
+        return JsonResponse({"ok": False, "error": "invalid cap_ids"}, status=400)
+    cap_ids = {int(x) for x in raw_ids}
+    if len(cap_ids) > _CAPS_STATUS_MAX:
+        return JsonResponse({"ok": False, "error": "too many cap_ids"}, status=400)
+    if not cap_ids and not gid:
+        return JsonResponse(
+            {"ok": False, "error": "cap_ids or group_id required"}, status=400
+        )
+
+    caps = DeviceCapability.objects.select_related("device").order_by("order", "id")
+    if gid:
+        group = get_object_or_404(Group, pk=gid)
+        is_visible = (group.owner_id == request.user.id) or group.memberships.filter(
+            user=request.user
+        ).exists()
+        if not is_visible:
+            return HttpResponseForbidden("No permission")
+        in_group = caps.filter(device__groups=group)
+        caps = list(in_group.filter(pk__in=cap_ids) if cap_ids else in_group)
+        if cap_ids and len(caps) != len(cap_ids):
+            return HttpResponseForbidden("Device not in group")
+    else:
+        caps = list(caps.filter(pk__in=cap_ids))
+        if len(caps) != len(cap_ids):
+            raise Http404("Capability not found")
+        visible = set(
+            Device.objects.filter(
+                pk__in={c.device_id for c in caps},
+                groups__in=Group.objects.filter(
+                    Q(owner=request.user) | Q(memberships__user=request.user)
+                ),
+            )
+            .values_list("pk", flat=True)
+            .distinct()
+        )
+        if any(c.device_id not in visible for c in caps):
+            return HttpResponseForbidden("No permission")
+
+    now = timezone.now()
+    pending = _pending_caps(caps, now)
+    next_times = _next_schedules(caps, now)
+    items = {}
+    for cap in caps:
+        item = _cap_state(cap)
+        item.update(
+            device_id=cap.device_id,
+            device_name=cap.device.label,
+            is_online=cap.device.is_online(),
+            pending=cap.id in pending,
+            **next_times.get(cap.id, {}),
+        )
+        items[str(cap.id)] = item
+
+    resp = JsonResponse(
+        {"ok": True, "items": items, "server_ts": int(now.timestamp())}
+    )
+    resp["Cache-Control"] = "no-store"
+    return resp
+
+
 def _auth_device(data):
     serial = data.get("serial_number")
     token = data.get("token")
     if not serial or not token:
         return None, JsonResponse({"error": "serial_number/token required"}, status=400)
-    try:
-        dev = Device.objects.only("id", "token").get(serial_number=serial)
-    except Device.DoesNotExist:
-        return None, JsonResponse({"error": "Device not found"}, status=404)
-    if dev.token != token:
-        return None, JsonResponse({"error": "Unauthorized"}, status=401)
+    dev, result = device_auth.authenticate(serial, token)
+    if result != device_auth.OK:
+        return None, _auth_error(result)
     return dev, None
 
 
+def _auth_error(result: str) -> JsonResponse:
+    """device_auth.authenticate 失敗結果 → 回應（與原本的 404/401 相同）"""
+    if result == device_auth.NOT_FOUND:
+        return JsonResponse({"error": "Device not found"}, status=404)
+    return JsonResponse({"error": "Unauthorized"}, status=401)
+
+
 @csrf_exempt
 @require_POST
 def device_schedules(request):
-    try:
-        data = json.loads(request.body.decode("utf-8"))
-    except Exception:
-        return JsonResponse({"error": "Invalid JSON"}, status=400)
+    data, err = protocol.decode_request(request)
+    if err:
+        return err
 
     device, err = _auth_device(data)
     if err:
         return err
 
+    items = [_schedule_item(s) for s in _pending_schedules(device)]
+    return JsonResponse({"ok": True, "items": items})
+
+
+def _pending_schedules(device: Device):
     now = timezone.now()
     # 只給未執行的未來排程（容忍 2 分鐘的時鐘漂移：>= now-120s）
-    qs = DeviceSchedule.objects.filter(
+    return DeviceSchedule.objects.filter(
         device=device, status="pending", run_at__gte=now - timedelta(seconds=120)
     ).order_by("run_at")[:100]
 
-    items = []
-    for s in qs:
-        items.append(
-            {
-                "id": s.id,
-                "action": s.action,
-                "payload": s.payload or {},
-                # 用 epoch 秒，樹梅派好處理
-                "ts": int(s.run_at.timestamp()),
-            }
-        )
 
-    return JsonResponse({"ok": True, "items": items})
+def _schedule_item(s: DeviceSchedule) -> dict:
+    return {
+        "id": s.id,
+        "action": s.action,
+        "payload": s.payload or {},
+        # 用 epoch 秒，樹梅派好處理
+        "ts": int(s.run_at.timestamp()),
+    }
 
 
 @csrf_exempt
 @require_POST
 def device_schedule_ack(request):
-    # 解析 JSON
-    try:
-        data = json.loads(request.body.decode("utf-8"))
-    except Exception:
-        return JsonResponse({"error": "Invalid JSON"}, status=400)
+    # 解析請求（JSON / msgpack / gzip）
+    data, err = protocol.decode_request(request)
+    if err:
+        return err
 
     # 驗證裝置身分
     device, err = _auth_device(data)
@@ -1024,11 +1405,17 @@ from HomePiWeb.mongo import device_ping_logs
 def device_logs(request, device_id):
     """
     查詢某裝置的歷史心跳紀錄
-    GET /api/device/<id>/logs/?limit=10
+    GET /api/device/<id>/logs/?limit=10                      最近幾筆原始紀錄
+    GET /api/device/<id>/logs/?hours=24&points=200           彙總序列
+    GET /api/device/<id>/logs/?start=<ISO>&end=<ISO>&points=200
+    有帶 hours/start 時改查 1m/1h/1d 彙總，依範圍與點數上限自動挑解析度。
     """
     # 確認裝置存在於 PostgreSQL
     device = get_object_or_404(Device, pk=device_id)
 
+    if request.GET.get("hours") or request.GET.get("start"):
+        return _device_log_series(request, device)
+
     # limit：容錯處理
     try:
         limit = int(request.GET.get("limit", 10))
@@ -1072,3 +1459,67 @@ def device_logs(request, device_id):
         )
 
     return JsonResponse({"device": device.serial_number, "logs": results})
+
+
+def _device_log_series(request, device: Device) -> JsonResponse:
+    """device_logs 的彙總模式"""
+    now = djtz.now()
+    try:
+        end = parse_datetime(request.GET.get("end") or "") or now
+        if request.GET.get("start"):
+            start = parse_datetime(request.GET["start"])
+        else:
+            start = end - timedelta(hours=float(request.GET["hours"]))
+        points = int(request.GET.get("points", 200))
+    except (TypeError, ValueError, KeyError):
+        return JsonResponse({"error": "invalid start/end/hours/points"}, status=400)
+    if start is None:
+        return JsonResponse({"error": "invalid start/end/hours/points"}, status=400)
+    if is_naive(start):
+        start = make_aware(start)
+    if is_naive(end):
+        end = make_aware(end)
+    if start >= end:
+        return JsonResponse({"error": "invalid start/end/hours/points"}, status=400)
+    points = max(1, min(points, 2000))
+
+    resolution, rows = metrics_rollup.query_series(str(device.pk), start, end, points)
+
+    def _stat(v):
+        if not isinstance(v, dict):
+            return None
+        return {"min": v.get("min"), "max": v.get("max"), "avg": v.get("avg")}
+
+    series = []
+    for row in rows:
+        bucket = row.get("bucket")
+        if isinstance(bucket, datetime) and is_naive(bucket):
+            bucket = make_aware(bucket, dt_timezone.utc)
+        item = {
+            "t": localtime(bucket).isoformat() if bucket else None,
+            "count": row.get("count", 0),
+            "online_ratio": row.get("online_ratio"),
+        }
+        for name in metrics_rollup.METRICS:
+            item[name] = _stat(row.get(name))
+        series.append(item)
+
+    return JsonResponse(
+        {
+            "device": device.serial_number,
+            "resolution": resolution,
+            "start": localtime(start).isoformat(),
+            "end": localtime(end).isoformat(),
+            "points": series,
+        }
+    )
+
+
+@staff_member_required
+@require_GET
+def mongo_writer_metrics(request):
+    """
+    心跳紀錄背景寫入器的狀態（僅限 staff）
+    GET /admin/metrics/mongo_writer/
+    """
+    return JsonResponse(get_ping_log_writer().stats())
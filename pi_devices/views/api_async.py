@@ -0,0 +1,234 @@
+# pi_devices/views/api_async.py
+# -*- coding: utf-8 -*-
+"""
+給樹莓派 agent 的 async 版 API（經 HomePiWeb/asgi.py + HomePiWeb/urls_asgi.py 提供）
+
+WSGI 版的 device_pull 長輪詢會佔住一個 worker 執行緒直到有指令或逾時，
+裝置一多 worker 就被吃光；這裡的長輪詢在 event loop 上等待 command_signal，
+同一個行程可以同時掛上千條。
+
+- device_pull      ：原生 async 等待；取指令的交易丟給 sync_to_async，查完就關 DB 連線
+- device_ping/ack(_batch)：主體有交易，沿用 api.py 的共用函式，在 sync_to_async 內執行
+- device_schedules ：純讀取，直接用 async ORM
+- hls_proxy        ：httpx 非同步抓上游，等 Pi 回應時不佔執行緒；快取 / 預抓 / Range / HEAD 與 WSGI 版相同；
+                     片段邊讀邊數，超過 HLS_PROXY_CACHE["MAX_SEGMENT_BYTES"] 就中止回 502；
+                     LL-HLS 阻塞式重新載入等 Pi 時也只掛在 event loop 上
+回應格式與 WSGI 版完全相同，agent 不需要改。
+"""
+import functools
+import os
+import time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import connection
+from django.http import HttpResponse, HttpResponseNotFound, JsonResponse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods, require_POST
+
+from ..models import Device
+from ..utils import (
+    command_signal,
+    device_auth,
+    hls_cache,
+    protocol,
+    upstream_pool,
+    viewers,
+)
+from . import api
+
+
+async def _aauth_device(data):
+    """_auth_device 的 async 版"""
+    serial = data.get("serial_number")
+    token = data.get("token")
+    if not serial or not token:
+        return None, JsonResponse({"error": "serial_number/token required"}, status=400)
+    dev, result = await device_auth.aauthenticate(serial, token)
+    if result != device_auth.OK:
+        return None, api._auth_error(result)
+    return dev, None
+
+
+def _load_json(request):
+    # JSON / msgpack / gzip 都由 protocol 處理
+    return protocol.decode_request(request)
+
+
+@csrf_exempt
+@require_POST
+async def device_ping(request):
+    data, err = api._load_ping_data(request)
+    if err:
+        return err
+    return await sync_to_async(api._ping_device)(data, api._client_ip(request))
+
+
+def _claim_and_release(device, limit: int) -> list:
+    """
+    取指令後馬上關掉這條執行緒的 DB 連線：接著要 await 好幾秒，
+    不關的話每個掛著的長輪詢都佔住一條 Postgres 連線（還在交易裡時不關，例如測試）。
+    """
+    try:
+        return api._claim_commands(device, limit)
+    finally:
+        if not connection.in_atomic_block:
+            connection.close()
+
+
+@csrf_exempt
+@require_POST
+async def device_pull(request):
+    data, err = _load_json(request)
+    if err:
+        return err
+
+    max_wait = api._max_wait(data)
+    device, err = await _aauth_device(data)
+    if err:
+        return err
+
+    recheck = float(getattr(settings, "DEVICE_COMMAND_RECHECK_SECONDS", 5))
+    deadline = time.monotonic() + max_wait
+    batch = api._pull_limit(data)
+    claim = sync_to_async(_claim_and_release)
+    while True:
+        since = command_signal.version(device.pk)
+        cmds = await claim(device, batch or 1)
+        if cmds:
+            return api._pull_response(cmds, batch)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return HttpResponse(status=204)
+        woke = await command_signal.wait_async(
+            device.pk, since, min(remaining, recheck) if recheck > 0 else remaining
+        )
+        if not woke and time.monotonic() >= deadline:
+            return HttpResponse(status=204)
+
+
+@csrf_exempt
+@require_POST
+async def device_ack(request):
+    data, err = _load_json(request)
+    if err:
+        return err
+    if not data.get("req_id"):
+        return JsonResponse(
+            {"error": "serial_number/token/req_id required"}, status=400
+        )
+
+    device, err = await _aauth_device(data)
+    if err:
+        return err
+    return await sync_to_async(api._ack_command)(device, data)
+
+
+@csrf_exempt
+@require_POST
+async def device_ack_batch(request):
+    data, err = _load_json(request)
+    if err:
+        return err
+
+    device, err = await _aauth_device(data)
+    if err:
+        return err
+    return await sync_to_async(api._ack_batch)(device, data)
+
+
+@csrf_exempt
+@require_POST
+async def device_schedules(request):
+    data, err = _load_json(request)
+    if err:
+        return err
+
+    device, err = await _aauth_device(data)
+    if err:
+        return err
+
+    items = [api._schedule_item(s) async for s in api._pending_schedules(device)]
+    return JsonResponse({"ok": True, "items": items})
+
+
+async def _ahls_upstream(serial: str, name: str) -> str:
+    device = (
+        await Device.objects.filter(serial_number__iexact=serial)
+        .only("serial_number", "token", "ip_address")
+        .afirst()
+    )
+    return api._upstream_url(device, name)
+
+
+async def _afetch(serial: str, name: str, timeout: float, max_bytes=None):
+    import httpx
+
+    upstream = await _ahls_upstream(serial, name)
+    try:
+        return await upstream_pool.get_async_pool().get(
+            upstream,
+            headers={"Accept-Encoding": "identity"},
+            timeout=httpx.Timeout(timeout, connect=3),
+            max_bytes=max_bytes,
+        )
+    except upstream_pool.BodyTooLarge as e:
+        raise api._segment_too_large(e)
+    except httpx.HTTPError:
+        if hls_cache.is_playlist(name):
+            raise hls_cache.UpstreamError(
+                502,
+                "m3u8 upstream error",
+                {"X-HLS-Proxy": "1", "X-Upstream-Status": "CONN_ERR"},
+            )
+        raise hls_cache.UpstreamError(404, "upstream error")
+
+
+@csrf_exempt
+@require_http_methods(["GET", "HEAD"])
+async def hls_proxy(request, serial: str, subpath: str):
+    cache = hls_cache.get_cache()
+    name = os.path.basename(subpath)
+
+    async def fetch_segment(seg: str):
+        r = await _afetch(serial, seg, 20, hls_cache.max_segment_bytes())
+        return api._segment_object(r.status_code, r.content, r.headers)
+
+    if subpath.endswith(".m3u8"):
+        name = api._playlist_key(request, name)  # LL-HLS 阻塞式重新載入
+
+        async def fetch():
+            r = await _afetch(serial, name, 10)
+            obj = api._playlist_object(serial, r.status_code, r.content, r.encoding)
+            # 背景預抓最新片段
+            cache.aprefetch(
+                serial,
+                hls_cache.playlist_segments(obj.body),
+                lambda seg: functools.partial(fetch_segment, seg),
+            )
+            return obj
+
+    elif name.endswith(".ts"):
+
+        def fetch():
+            return fetch_segment(name)
+
+    else:
+        return HttpResponseNotFound("only ts allowed")
+
+    try:
+        if hls_cache.is_playlist(name):
+            obj = await cache.aget_or_fetch(serial, name, fetch)
+        else:
+            obj, body = await cache.aread_or_fetch(serial, name, fetch)
+    except hls_cache.UpstreamError as e:
+        if hls_cache.is_playlist(name):
+            if await sync_to_async(viewers.starting)(serial):
+                return api._cold_start_response()
+        return e.response()
+    except TimeoutError:
+        return HttpResponse("upstream timeout", status=504)
+
+    if hls_cache.is_playlist(name):
+        return api._playlist_response(obj)
+    return api._segment_response(request, obj, body)
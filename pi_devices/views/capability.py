@@ -14,7 +14,8 @@ from ..forms import DeviceCapabilityForm
 from groups.models import Group, GroupDevice, GroupMembership
 
 # 佇列工具：沿用 api.py 的一致行為（TTL、欄位）
-from .api import _queue_command
+from .api import _device_hls_base, _queue_command
+from ..utils import hls_sign, viewers
 from django.middleware.csrf import get_token
 
 
@@ -429,13 +430,8 @@ def capability_action(request, device_id: int, cap_id: int, action: str):
     return redirect(next_url)
 
 
-@login_required
-def live_player(request, device_id: int, cap_id: int):
-    device = get_object_or_404(Device, pk=device_id)
-    cap = get_object_or_404(DeviceCapability, pk=cap_id, device=device)
-
-    # 權限：裝置需在使用者可見群組
-    gid_raw = request.GET.get("group_id") or request.GET.get("g") or ""
+def _live_forbidden(request, device: Device, gid_raw: str):
+    """直播頁 / 播放來源共用的權限檢查：裝置需在使用者可見群組；沒權限回 403 回應"""
     gid = _parse_gid(gid_raw)
     if gid:
         group = get_object_or_404(Group, pk=gid)
@@ -451,17 +447,78 @@ def live_player(request, device_id: int, cap_id: int):
         ).exists()
         if not visible:
             return HttpResponseForbidden("No permission")
+    return None
+
+
+def _live_playlist(request, cap: DeviceCapability) -> str:
+    # LL-HLS：能力 config 設 ll_hls 或網址帶 ?ll=1 才開（Pi 要跑 LL 模式）
+    ll_param = request.GET.get("ll")
+    if ll_param in ("0", "1"):
+        return "ll.m3u8" if ll_param == "1" else "index.m3u8"
+    return "ll.m3u8" if (cap.config or {}).get("ll_hls") else "index.m3u8"
+
+
+@login_required
+def live_player(request, device_id: int, cap_id: int):
+    device = get_object_or_404(Device, pk=device_id)
+    cap = get_object_or_404(DeviceCapability, pk=cap_id, device=device)
+
+    gid_raw = request.GET.get("group_id") or request.GET.get("g") or ""
+    forbidden = _live_forbidden(request, device, gid_raw)
+    if forbidden:
+        return forbidden
 
+    playlist = _live_playlist(request, cap)
     cam_hls_url = request.build_absolute_uri(
-        reverse("hls_proxy", args=[device.serial_number, "index.m3u8"])
+        reverse("hls_proxy", args=[device.serial_number, playlist])
     )
+    source_url = reverse("cap_live_source", args=[device.id, cap.id])
+    params = [f"ll={int(playlist == 'll.m3u8')}"]
+    if gid_raw:
+        params.append(f"group_id={gid_raw}")
     ctx = {
         "device": device,
         "cap": cap,
         "group_id": gid_raw,
         "cam_hls_url": cam_hls_url,
+        "source_url": source_url + "?" + "&".join(params),
+        "low_latency": playlist == "ll.m3u8",
         "csrf_token": get_token(request),
         "start_url": reverse("capability_action", args=[device.id, cap.id, "start"]),
         "stop_url": reverse("capability_action", args=[device.id, cap.id, "stop"]),
     }
     return render(request, "pi_devices/live_player.html", ctx)
+
+
+@login_required
+def live_source(request, device_id: int, cap_id: int):
+    """
+    直播頁要播哪個網址：
+    {"proxy": 經 hls_proxy 的網址, "direct": 區網直連 Pi 的簽章網址或 null, ...}
+    這裡有驗證身分，所以由這裡（不是 hls_proxy）記錄觀看、冷啟動攝影機；
+    live_player 播放期間每 keepalive 秒帶 keepalive=1 回報還在看，
+    viewers 才不會把攝影機當成沒人看而停掉。
+    """
+    device = get_object_or_404(Device, pk=device_id)
+    cap = get_object_or_404(DeviceCapability, pk=cap_id, device=device)
+    forbidden = _live_forbidden(request, device, request.GET.get("group_id") or "")
+    if forbidden:
+        return forbidden
+
+    viewers.on_viewer(device.serial_number)
+    if request.GET.get("keepalive"):
+        return JsonResponse({"ok": True})
+
+    playlist = _live_playlist(request, cap)
+    return JsonResponse(
+        {
+            "ok": True,
+            "proxy": request.build_absolute_uri(
+                reverse("hls_proxy", args=[device.serial_number, playlist])
+            ),
+            "direct": hls_sign.direct_url(
+                request, device, _device_hls_base(device, cap), playlist
+            ),
+            **hls_sign.client_config(),
+        }
+    )
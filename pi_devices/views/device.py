@@ -100,21 +100,15 @@ def _user_can_control(user, device: Device, group: Group | None) -> bool:
 
 @login_required
 def offcanvas_list(request):
-    threshold = timezone.now() - timedelta(seconds=60)
-    devices = (
-        Device.objects.filter(user=request.user)
-        .annotate(
+    devices = list(
+        Device.objects.filter(user=request.user).annotate(
             sort_name=Coalesce(NullIf("display_name", Value("")), "serial_number")
         )
-        .annotate(
-            online_int=Case(
-                When(last_ping__gte=threshold, then=Value(1)),
-                default=Value(0),
-                output_field=IntegerField(),
-            )
-        )
-        .order_by("-online_int", "sort_name", "id")
     )
+    # 在線狀態問 presence（記憶體），排序改在 Python 做
+    for d in devices:
+        d.online_int = 1 if d.is_online(60) else 0
+    devices.sort(key=lambda d: (-d.online_int, d.sort_name, d.id))
     return render(request, "pi_devices/_offcanvas_devices.html", {"devices": devices})
 
 
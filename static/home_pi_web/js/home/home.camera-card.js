@@ -18,7 +18,7 @@
     const isOnline = !!(state && state.ok);
     const isRecording = !!(state && state.is_streaming);
     const quality = (state && state.quality) || '1080p';
-    const hlsUrl = state && state.hls_url;
+    const liveUrl = state && state.live_url;
     const deviceId = card.dataset.deviceId;
     const groupId = card.dataset.groupId;
 
@@ -46,13 +46,9 @@
 
     // 直播按鈕
     if (liveBtn) {
-      if (isOnline && deviceId && groupId) {
-        // 使用 HLS URL 或預設的直播連結
-        if (hlsUrl) {
-          liveBtn.href = hlsUrl;
-        } else {
-          liveBtn.href = `/live/${deviceId}/${deviceId}/?group_id=${groupId}`;
-        }
+      if (isOnline && deviceId && groupId && liveUrl) {
+        // 直播頁（播放網址由直播頁向伺服器要簽章網址，不直接連 Pi）
+        liveBtn.href = `${liveUrl}?group_id=${encodeURIComponent(groupId)}`;
         liveBtn.style.display = 'inline-block';
         liveBtn.textContent = isRecording ? '觀看直播（開新視窗）' : '開始直播（開新視窗）';
       } else {
@@ -161,7 +157,7 @@
           device_name: deviceData.device_name,
           is_streaming: cameraCap.is_streaming || false,
           quality: '1080p', // 預設品質
-          hls_url: cameraCap.hls_url || null
+          live_url: cameraCap.live_url || null
         };
         
         console.log('更新監控錄影狀態卡片:', cameraState);
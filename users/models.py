@@ -11,6 +11,8 @@ from pi_devices.models import (
 )  # 你的裝置模型（需具備 is_online(window_seconds) 等）
 from django.utils import timezone
 from datetime import timedelta
+import time
+from pi_devices.utils import presence
 
 
 class UserManager(BaseUserManager):
@@ -109,8 +111,15 @@ class User(AbstractBaseUser, PermissionsMixin):
 
     # === 線上狀態判斷 ===
     def is_online(self, window_seconds: int | None = None) -> bool:
-        window = window_seconds or getattr(settings, "DEVICE_ONLINE_WINDOW_SECONDS", 60)
-        # 只要有任一台裝置在線，就視為在線
+        default_window = getattr(settings, "DEVICE_ONLINE_WINDOW_SECONDS", 60)
+        window = window_seconds or default_window
+        # 只要有任一台裝置在 window 內有心跳，就視為在線（presence 記憶體查詢，不打 DB）
+        seen = presence.owner_last_seen(self.pk)
+        if seen is not None and seen >= time.time() - window:
+            return True
+        if window == default_window:
+            # presence 會定期從 last_ping 重新同步，預設視窗不用再查 DB
+            return False
         return self.devices.filter(
             last_ping__gte=timezone.now() - timedelta(seconds=window)
         ).exists()
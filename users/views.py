@@ -161,7 +161,6 @@ def login_view(request):
 @login_required
 def home_view(request):
     window = getattr(settings, "DEVICE_ONLINE_WINDOW_SECONDS", 60)
-    threshold = timezone.now() - timedelta(seconds=window)
 
     groups = (
         Group.objects.filter(Q(owner=request.user) | Q(users=request.user))
@@ -179,7 +178,7 @@ def home_view(request):
 
     for g in groups:
         for d in g.devices.all():
-            d.is_online_now = bool(d.last_ping and d.last_ping >= threshold)
+            d.is_online_now = d.is_online(window)
 
     # return render(request, "home.html", {"groups": groups})
     return render(request, "home/home.html", {"groups": groups})
@@ -219,13 +218,12 @@ def ajax_devices(request):
     if (group.owner_id != request.user.id) and (not is_member):
         return HttpResponseForbidden("No permission")
 
-    # ✅ 補：計算在線狀態
+    # ✅ 補：計算在線狀態（presence 記憶體判斷）
     window = getattr(settings, "DEVICE_ONLINE_WINDOW_SECONDS", 60)
-    threshold = timezone.now() - timedelta(seconds=window)
 
     devices = list(group.devices.select_related("user").all())
     for d in devices:
-        d.is_online_now = bool(d.last_ping and d.last_ping >= threshold)
+        d.is_online_now = d.is_online(window)
 
     return render(request, "home/partials/_device_options.html", {"devices": devices})
 